@@ -12,11 +12,15 @@
 from qgis.PyQt.QtCore import QSettings, QTranslator, QCoreApplication
 from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtWidgets import QAction
+from qgis.core import QgsApplication
 
 # Initialize Qt resources from file resources.py
 from .resources import *
 # Import the code for the dialog
 from .easy_attribute_filter_dialog import EasyAttributeFilterDialog
+from .easy_attribute_filter_processing import EasyAttributeFilterProvider
+from .easy_attribute_filter_table_model import registerSortRankFunction, unregisterSortRankFunction
+from .easy_attribute_filter_relation import registerSemiJoinFunction, unregisterSemiJoinFunction
 import os.path
 
 
@@ -54,6 +58,7 @@ class EasyAttributeFilter:
         # Check if plugin was started the first time in current QGIS session
         # Must be set in initGui() to survive plugin reloads
         self.dlg = None
+        self.provider = None
 
     # noinspection PyMethodMayBeStatic
     def tr(self, message):
@@ -145,8 +150,16 @@ class EasyAttributeFilter:
 
         return action
 
+    def initProcessing(self):
+        """Register the processing provider."""
+        self.provider = EasyAttributeFilterProvider()
+        QgsApplication.processingRegistry().addProvider(self.provider)
+
     def initGui(self):
         """Create the menu entries and toolbar icons inside the QGIS GUI."""
+        self.initProcessing()
+        registerSortRankFunction()
+        registerSemiJoinFunction()
 
         icon_path = ':/plugins/easy_attribute_filter/icon.png'
         self.add_action(
@@ -167,6 +180,16 @@ class EasyAttributeFilter:
                 action)
             self.iface.removeToolBarIcon(action)
 
+        if self.provider is not None:
+            QgsApplication.processingRegistry().removeProvider(self.provider)
+            self.provider = None
+
+        # 並び替えに使う式関数を参照するモデルを破棄してから登録を解除する
+        if self.dlg is not None:
+            self.dlg.close()
+        unregisterSortRankFunction()
+        unregisterSemiJoinFunction()
+
     def onDialogClose(self):
         if self.dlg is not None:
             self.dlg.closed.disconnect(self.onDialogClose)
@@ -0,0 +1,150 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterCacheStats
+                                 A QGIS plugin
+ 行の読み込みのヒット・ミス・再取得の統計
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+ スクロール・並び替え・フィルターで行の属性が必要になった際に、
+ プロバイダから読み込まずに済んだか（ヒット）、読み込んだか（ミス）、
+ 一度読み込んだ行を再び読み込んだか（再取得）を数える。
+ 再取得が多い場合はレイヤキャッシュが小さすぎる（スラッシング）と判断できる。
+ 全行をキャッシュを経由せずに読み込む処理（直接読み込み）は、行ごとにキャッシュを
+ 調べていないためヒット・ミスには含めずに別に数える。
+"""
+from qgis.PyQt.QtCore import QObject, pyqtSignal
+from qgis.core import QgsVectorLayerCache
+
+# 処理の種類
+PHASE_SCROLL = "scroll"
+PHASE_SORT = "sort"
+PHASE_FILTER = "filter"
+
+PHASE_NAMES = {
+    PHASE_SCROLL: "スクロール",
+    PHASE_SORT: "並び替え",
+    PHASE_FILTER: "フィルター",
+}
+
+# 再取得がミスのこの割合を超える場合はスラッシングとみなす
+THRASHING_RATIO = 0.5
+
+
+class EasyAttributeFilterCacheStats(QObject):
+    """
+    行の読み込みの統計
+    """
+
+    # 統計が更新された
+    updated = pyqtSignal()
+
+    def __init__(self, layer_cache: QgsVectorLayerCache, cache_size: int, row_bytes: int, parent=None):
+        """
+        コンストラクタ
+
+        @param  layer_cache:レイヤキャッシュ
+        @param  cache_size:レイヤキャッシュの行数
+        @param  row_bytes:1行あたりの推定メモリ使用量（バイト）
+        """
+        super(EasyAttributeFilterCacheStats, self).__init__(parent)
+        self.layer_cache = layer_cache
+        self.cache_size = cache_size
+        self.row_bytes = row_bytes
+
+        # {処理の種類: [ヒット, ミス, 再取得, 直接読み込み]}
+        self.counts = {phase: [0, 0, 0, 0] for phase in PHASE_NAMES}
+        # スクロールで読み込んだ地物ID
+        self.seen_fids = set()
+
+    def record(self, phase: str, hits: int, misses: int, refetches: int=0):
+        """
+        行数を加算する
+
+        @param  phase:処理の種類
+        @param  hits:読み込まずに済んだ行数
+        @param  misses:プロバイダから読み込んだ行数
+        @param  refetches:読み込んだ行のうち、以前にも読み込んだ行数
+        """
+        counts = self.counts[phase]
+        counts[0] += hits
+        counts[1] += misses
+        counts[2] += refetches
+        self.updated.emit()
+
+    def recordReads(self, phase: str, reads: int):
+        """
+        キャッシュを経由せずにプロバイダから読み込んだ行数を加算する
+
+        @param  phase:処理の種類
+        @param  reads:読み込んだ行数
+        """
+        self.counts[phase][3] += reads
+        self.updated.emit()
+
+    def recordFids(self, phase: str, fids):
+        """
+        表示する地物がレイヤキャッシュにあるかを調べて加算する
+
+        表示前に呼び出す（表示時に読み込まれるとキャッシュに入るため）。
+
+        @param  phase:処理の種類
+        @param  fids:地物IDのリスト
+        """
+        hits = misses = refetches = 0
+        for fid in fids:
+            if self.layer_cache.isFidCached(fid):
+                hits += 1
+                continue
+            misses += 1
+            if fid in self.seen_fids:
+                refetches += 1
+            else:
+                self.seen_fids.add(fid)
+        if hits + misses > 0:
+            self.record(phase, hits, misses, refetches)
+
+    def totals(self) -> list:
+        """
+        全処理の合計 [ヒット, ミス, 再取得, 直接読み込み]
+        """
+        return [sum(counts[i] for counts in self.counts.values()) for i in range(4)]
+
+    def hitRate(self):
+        """
+        ヒット率（行がない場合はNone）
+        """
+        hits, misses, _, _ = self.totals()
+        return hits / (hits + misses) if hits + misses > 0 else None
+
+    def isThrashing(self) -> bool:
+        """
+        一度読み込んだ行の再取得が多いか判定する
+        """
+        _, misses, refetches, _ = self.totals()
+        return misses > self.cache_size and refetches > misses * THRASHING_RATIO
+
+    def text(self) -> str:
+        """
+        表示用の短い文字列
+        """
+        hit_rate = self.hitRate()
+        text = f"キャッシュ{self.cache_size:,}行"
+        if hit_rate is not None:
+            text += f" ヒット率{hit_rate:.0%}"
+        if self.isThrashing():
+            text += "（再取得が多い）"
+        return text
+
+    def description(self) -> str:
+        """
+        処理ごとの統計
+        """
+        memory = self.cache_size * self.row_bytes / (1024 * 1024)
+        lines = [f"レイヤキャッシュ：{self.cache_size:,}行（1行約{self.row_bytes:,}バイト、約{memory:,.0f}MB）"]
+        for phase, (hits, misses, refetches, reads) in self.counts.items():
+            lines.append(f"  {PHASE_NAMES[phase]}：ヒット{hits:,}行 ミス{misses:,}行 再取得{refetches:,}行 直接読み込み{reads:,}行")
+        if self.isThrashing():
+            lines.append("  一度読み込んだ行の再取得が多いため、キャッシュのメモリ上限を増やすと速くなる可能性があります")
+        return "\n".join(lines)
@@ -0,0 +1,1026 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterColumnCache
+                                 A QGIS plugin
+ 列データのキャッシュ
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+"""
+import bisect
+import datetime
+from array import array
+
+from qgis.PyQt.QtCore import QVariant, QDate, QDateTime, QTimer
+from qgis.core import (QgsApplication, QgsTask, QgsFeatureRequest, QgsVectorLayer, QgsVectorLayerFeatureSource,
+                       QgsExpressionContext, QgsExpressionContextUtils)
+
+from .easy_attribute_filter_sketch import ValueSketch, TOP_VALUE_COUNT
+from .easy_attribute_filter_predicate import DateRangePredicate
+
+# ヒストグラムの階級数
+HISTOGRAM_BINS = 50
+# 先読みする固有値の上限件数
+PREFETCH_UNIQUE_LIMIT = 1001
+# 他の列のフィルターを通過した地物IDを保持する件数
+CROSS_FILTER_CACHE_SIZE = 8
+
+def isNullValue(value) -> bool:
+    """
+    NULL判定
+    """
+    return value is None or (isinstance(value, QVariant) and value.isNull())
+
+
+def toPyDate(value):
+    """
+    日付に変換する
+
+    @param  value:属性値（QDate/QDateTime/date/datetime/ISO形式の文字列）
+    @return datetime.date（NULLや変換できない値はNone）
+    """
+    if isNullValue(value):
+        return None
+    if isinstance(value, QDateTime):
+        return value.date().toPyDate() if value.isValid() else None
+    if isinstance(value, QDate):
+        return value.toPyDate() if value.isValid() else None
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+
+class FidValues:
+    """
+    地物IDごとの値（地物IDの昇順に並べた配列）
+
+    編集時に変更前の値を求めるために使用する。
+    """
+
+    def __init__(self, typecode: str):
+        """
+        コンストラクタ
+
+        @param  typecode:値の配列の型
+        """
+        self.fids = array("q")
+        self.values = array(typecode)
+
+    @classmethod
+    def fromPairs(cls, typecode: str, pairs: list):
+        """
+        (地物ID, 値)のリストから作成する
+        """
+        fid_values = cls(typecode)
+        pairs.sort()
+        fid_values.fids = array("q", [fid for fid, _ in pairs])
+        fid_values.values = array(typecode, [value for _, value in pairs])
+        return fid_values
+
+    @classmethod
+    def fromArrays(cls, fids: array, values: array):
+        """
+        地物IDの昇順に並んだ配列から作成する
+        """
+        fid_values = cls(values.typecode)
+        fid_values.fids = fids
+        fid_values.values = values
+        return fid_values
+
+    def get(self, fid: int):
+        """
+        値を取得する（登録されていない場合はNone）
+        """
+        index = bisect.bisect_left(self.fids, fid)
+        if index < len(self.fids) and self.fids[index] == fid:
+            return self.values[index]
+        return None
+
+    def set(self, fid: int, value):
+        """
+        値を登録する
+        """
+        index = bisect.bisect_left(self.fids, fid)
+        if index < len(self.fids) and self.fids[index] == fid:
+            self.values[index] = value
+        else:
+            self.fids.insert(index, fid)
+            self.values.insert(index, value)
+
+    def remove(self, fid: int):
+        """
+        値を削除する
+
+        @return 削除した値（登録されていない場合はNone）
+        """
+        index = bisect.bisect_left(self.fids, fid)
+        if index < len(self.fids) and self.fids[index] == fid:
+            value = self.values[index]
+            del self.fids[index]
+            del self.values[index]
+            return value
+        return None
+
+    def temporaryFids(self) -> list:
+        """
+        未コミットの追加地物（負の地物ID）を取得する
+        """
+        return list(self.fids[0:bisect.bisect_left(self.fids, 0)])
+
+
+class NumericColumn:
+    """
+    数値列（NULLを除いた値を昇順に並べたもの）
+
+    範囲に含まれる件数は二分探索で求める。
+    編集時は変更のあった値のみを入れ替え、ヒストグラムは並べた値から二分探索で求め直す。
+    """
+
+    def __init__(self, values: array, minimum: float, maximum: float, histogram: list, fid_values: FidValues=None):
+        """
+        コンストラクタ
+
+        @param  values:昇順に並べた値
+        @param  minimum:最小値
+        @param  maximum:最大値
+        @param  histogram:階級ごとの件数
+        @param  fid_values:地物IDごとの値
+        """
+        self.values = values
+        self.minimum = minimum
+        self.maximum = maximum
+        self.histogram = histogram
+        self.fid_values = fid_values if fid_values is not None else FidValues("d")
+
+    def setValue(self, fid: int, value):
+        """
+        地物の値を更新する
+
+        @param  fid:地物ID
+        @param  value:値（NULLの場合はNone）
+        """
+        old_value = self.fid_values.remove(fid)
+        if old_value is not None:
+            del self.values[bisect.bisect_left(self.values, old_value)]
+        if value is not None:
+            self.fid_values.set(fid, value)
+            bisect.insort(self.values, value)
+        self.updateHistogram()
+
+    def removeFeature(self, fid: int):
+        """
+        地物の値を削除する
+        """
+        self.setValue(fid, None)
+
+    def updateHistogram(self):
+        """
+        最小値・最大値とヒストグラムを並べた値から求め直す
+        """
+        if len(self.values) == 0:
+            self.minimum = 0.0
+            self.maximum = 0.0
+            self.histogram = [0] * HISTOGRAM_BINS
+            return
+
+        self.minimum = self.values[0]
+        self.maximum = self.values[-1]
+        bin_width = (self.maximum - self.minimum) / HISTOGRAM_BINS
+        if bin_width <= 0:
+            self.histogram = [len(self.values)] + [0] * (HISTOGRAM_BINS - 1)
+            return
+
+        edges = [bisect.bisect_left(self.values, self.minimum + bin_width * index) for index in range(HISTOGRAM_BINS)] + [len(self.values)]
+        self.histogram = [edges[index + 1] - edges[index] for index in range(HISTOGRAM_BINS)]
+
+    def count(self) -> int:
+        return len(self.values)
+
+    def countInRange(self, lower: float, upper: float) -> int:
+        """
+        範囲（両端を含む）に含まれる件数を取得する
+
+        @param  lower:下限
+        @param  upper:上限
+        """
+        if lower > upper:
+            return 0
+        return bisect.bisect_right(self.values, upper) - bisect.bisect_left(self.values, lower)
+
+
+class DateColumn:
+    """
+    日付ごとの件数
+    """
+
+    def __init__(self, counts: dict, null_count: int, fid_values: FidValues):
+        """
+        コンストラクタ
+
+        @param  counts:{datetime.date: 件数}
+        @param  null_count:NULLの件数
+        @param  fid_values:地物IDごとの日付（序数、NULLは0）
+        """
+        self.counts = counts
+        self.null_count = null_count
+        self.fid_values = fid_values
+
+    def setValue(self, fid: int, date):
+        """
+        地物の値を更新する
+
+        @param  fid:地物ID
+        @param  date:日付（NULLの場合はNone）
+        """
+        self.removeFeature(fid)
+        if date is None:
+            self.null_count += 1
+            self.fid_values.set(fid, 0)
+        else:
+            self.counts[date] = self.counts.get(date, 0) + 1
+            self.fid_values.set(fid, date.toordinal())
+
+    def removeFeature(self, fid: int):
+        """
+        地物の値を削除する
+        """
+        ordinal = self.fid_values.remove(fid)
+        if ordinal is None:
+            return
+        if ordinal == 0:
+            self.null_count -= 1
+            return
+
+        date = datetime.date.fromordinal(ordinal)
+        self.counts[date] -= 1
+        if self.counts[date] == 0:
+            del self.counts[date]
+
+
+class FieldSummary:
+    """
+    先読みしたフィールドの固有値・NULL有無・空白有無・最小値・最大値
+
+    固有値は上限件数に達した時点で収集をやめ、以降は固有値の数と頻出値を概算する。
+    """
+
+    def __init__(self, limit: int):
+        """
+        コンストラクタ
+
+        @param  limit:固有値の上限件数
+        """
+        self.limit = limit
+        # {固有値: 件数}
+        self.uniques = dict()
+        # 上限件数に達した後の概算（達していない場合はNone）
+        self.sketch = None
+        self.has_null = False
+        self.null_count = 0
+        self.has_blank = False
+        self.minimum = None
+        self.maximum = None
+
+    def isCapped(self) -> bool:
+        """
+        固有値が上限件数に達したか判定する
+        """
+        return len(self.uniques) >= self.limit
+
+    def add(self, value):
+        """
+        値を集計する
+        """
+        if isNullValue(value):
+            self.has_null = True
+            self.null_count += 1
+            return
+        if isinstance(value, str) and len(value) == 0:
+            self.has_blank = True
+
+        try:
+            if self.sketch is not None:
+                self.sketch.add(value)
+            elif value in self.uniques or not self.isCapped():
+                self.uniques[value] = self.uniques.get(value, 0) + 1
+            else:
+                # 上限件数に達した時点の件数から概算を始める
+                self.sketch = ValueSketch.fromCounts(self.uniques)
+                self.sketch.add(value)
+        except TypeError:
+            # ハッシュできない値は固有値に含めない
+            pass
+
+        try:
+            if self.minimum is None or value < self.minimum:
+                self.minimum = value
+            if self.maximum is None or value > self.maximum:
+                self.maximum = value
+        except TypeError:
+            pass
+
+    def uniqueValues(self, limit: int) -> set:
+        """
+        固有値を取得する（NULLはNoneとして含める）
+
+        @param  limit:上限件数
+        """
+        uniques = set(self.uniques.keys())
+        if self.has_null:
+            uniques.add(None)
+        if len(uniques) > limit:
+            uniques = set(sorted(uniques, key=lambda value: (value is None, str(value)))[0:limit])
+        return uniques
+
+    def countMatching(self, predicate) -> int:
+        """
+        条件に一致する件数を固有値ごとの件数から求める
+
+        @param  predicate:対象フィールドのみを参照する条件
+        @return 件数（上限件数に達している場合はNone）
+        """
+        if self.sketch is not None:
+            return None
+
+        field = next(iter(predicate.fields()))
+        is_date = isinstance(predicate, DateRangePredicate)
+        count = self.null_count if predicate.matches({field: None}) else 0
+        for value, frequency in self.uniques.items():
+            if predicate.matches({field: toPyDate(value) if is_date else value}):
+                count += frequency
+        return count
+
+    def total(self) -> int:
+        """
+        集計した件数（NULLを含む）
+        """
+        return sum(self.uniques.values()) + self.null_count
+
+    def valueFrequencies(self, count: int):
+        """
+        固有値の数と頻出値を取得する（NULLを除く）
+
+        上限件数に達している場合は概算となる。
+
+        @param  count:頻出値の件数
+        @return (固有値の数, [(値, 件数)]（件数の多い順）, 正確な値か)
+        """
+        if self.sketch is not None:
+            top_values = [(value, frequency) for value, frequency, _ in self.sketch.topValues(count)]
+            return (self.sketch.distinctCount(), top_values, False)
+        top_values = sorted(self.uniques.items(), key=lambda item: -item[1])[0:count]
+        return (len(self.uniques), top_values, True)
+
+
+class EasyAttributeFilterPrefetchTask(QgsTask):
+    """
+    全ての表示列の固有値などを1回の読み込みで先読みするタスク
+    """
+
+    def __init__(self, layer: QgsVectorLayer, field_indexes: list, limit: int):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        @param  field_indexes:対象フィールドindexのリスト
+        @param  limit:固有値の上限件数
+        """
+        super(EasyAttributeFilterPrefetchTask, self).__init__(f"固有値の先読み：{layer.name()}", QgsTask.CanCancel)
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.field_indexes = field_indexes
+        self.total = layer.featureCount()
+        self.summaries = {field_index: FieldSummary(limit) for field_index in field_indexes}
+
+    def run(self) -> bool:
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(self.field_indexes)
+
+        count = 0
+        for feature in self.source.getFeatures(request):
+            if self.isCanceled():
+                return False
+
+            attributes = feature.attributes()
+            for field_index, summary in self.summaries.items():
+                summary.add(attributes[field_index])
+
+            count += 1
+            if count % 10000 == 0 and self.total > 0:
+                self.setProgress(100.0 * count / self.total)
+
+        return True
+
+
+class EasyAttributeFilterNumericColumnTask(QgsTask):
+    """
+    数値列の値の収集とヒストグラムの集計を行うタスク
+
+    最小値・最大値はレイヤ（プロバイダ）から求め、値とヒストグラムは1回の読み込みで配列に収集する。
+    """
+
+    def __init__(self, layer: QgsVectorLayer, field_index: int):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        @param  field_index:フィールドindex
+        """
+        super(EasyAttributeFilterNumericColumnTask, self).__init__(f"範囲の集計：{layer.name()}", QgsTask.CanCancel)
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.field_index = field_index
+        self.total = layer.featureCount()
+        # 未コミットの編集を含めた最小値・最大値（プロバイダでは集計関数で求められる）
+        minimum = layer.minimumValue(field_index)
+        maximum = layer.maximumValue(field_index)
+        self.bounds = None if isNullValue(minimum) or isNullValue(maximum) else (float(minimum), float(maximum))
+        self.column = None
+
+    def run(self) -> bool:
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.field_index])
+
+        fids = array("q")
+        values = array("d")
+        histogram = [0] * HISTOGRAM_BINS
+        minimum, maximum = self.bounds if self.bounds is not None else (0.0, 0.0)
+        bin_width = (maximum - minimum) / HISTOGRAM_BINS
+        count = 0
+        for feature in self.source.getFeatures(request):
+            if self.isCanceled():
+                return False
+
+            value = feature.attribute(self.field_index)
+            if not isNullValue(value):
+                value = float(value)
+                fids.append(feature.id())
+                values.append(value)
+                bin_index = int((value - minimum) / bin_width) if bin_width > 0 else 0
+                histogram[min(max(bin_index, 0), HISTOGRAM_BINS - 1)] += 1
+
+            count += 1
+            if count % 10000 == 0 and self.total > 0:
+                self.setProgress(100.0 * count / self.total)
+
+        # 地物IDの昇順に返さないプロバイダでは並べ替える
+        if any(fids[index] > fids[index + 1] for index in range(len(fids) - 1)):
+            order = sorted(range(len(fids)), key=fids.__getitem__)
+            fids = array("q", [fids[index] for index in order])
+            values = array("d", [values[index] for index in order])
+
+        column = NumericColumn(array("d", sorted(values)), minimum, maximum, histogram, FidValues.fromArrays(fids, values))
+        if self.bounds is None or (len(column.values) > 0 and (column.values[0] < minimum or column.values[-1] > maximum)):
+            # 最小値・最大値を求められなかった場合や読み込み中に変更された場合は、並べた値から求め直す
+            column.updateHistogram()
+        self.column = column
+        return True
+
+
+class EasyAttributeFilterColumnCache:
+    """
+    レイヤの列データのキャッシュ
+
+    地物の追加・削除・属性値の変更は、キャッシュ済みの列に対して変更のあった地物のみを反映する。
+    データソースやフィールド構成が変わった場合は破棄する。
+    """
+
+    def __init__(self, layer: QgsVectorLayer):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        """
+        self.layer = layer
+        # 列データの取得元（ディスクキャッシュまたはSQL）
+        self.column_store = None
+        # 式によるフィールドの値の保持
+        self.virtual_columns = None
+        # プレビュー中の標本の地物ID（プレビュー中でない場合はNone）
+        self.sample_fids = None
+        self.numeric_columns = dict()
+        self.date_counts = dict()
+        self.summaries = dict()
+        # {他の列のフィルター式のタプル: 通過した地物IDの集合}（編集時は破棄する）
+        self.cross_fids = dict()
+
+        # キャッシュ破棄の世代（先読み中に破棄された場合は結果を使わない）
+        self.generation = 0
+        self.prefetch_task = None
+        # {フィールドindex: 数値列の集計タスク}
+        self.numeric_tasks = dict()
+
+        # 追加された地物はまとめて読み込む
+        self.pending_fids = set()
+        self.pending_timer = QTimer()
+        self.pending_timer.setSingleShot(True)
+        self.pending_timer.timeout.connect(self.processPendingFeatures)
+
+    def setColumnStore(self, column_store):
+        """
+        列データの取得元を設定する
+
+        @param  column_store:ディスクキャッシュまたはSQL（使用しない場合はNone）
+        """
+        self.column_store = column_store
+
+    def setVirtualColumns(self, virtual_columns):
+        """
+        式によるフィールドの値の保持を設定する
+
+        @param  virtual_columns:式によるフィールドの値の保持（使用しない場合はNone）
+        """
+        self.virtual_columns = virtual_columns
+
+    def usableColumnStore(self, field_index: int):
+        """
+        フィールドの値を取得できる列データの取得元を取得する（ない場合はNone）
+
+        式によるフィールドは初めて使われた際に値を評価して保持する（プレビュー中は全地物を評価しない）。
+        """
+        field_name = self.layer.fields().at(field_index).name()
+        virtual_columns = self.virtual_columns
+        if virtual_columns is not None and (self.sample_fids is None or virtual_columns.isMaterialized(field_name)):
+            if virtual_columns.materialize(field_name):
+                return virtual_columns
+        store = self.column_store
+        if store is None or not store.hasField(field_name):
+            return None
+        return store
+
+    def setSampleFids(self, sample_fids):
+        """
+        プレビュー中の標本を設定する
+
+        先読みや列データの取得元で求められない列は、標本の地物のみから概算する。
+
+        @param  sample_fids:標本の地物IDのリスト（プレビューを終了する場合はNone）
+        """
+        self.sample_fids = sample_fids
+
+    def isApproximate(self, field_index: int) -> bool:
+        """
+        列の集計が標本からの概算となるか判定する
+        """
+        if self.sample_fids is None:
+            return False
+        return self.summary(field_index) is None and self.usableColumnStore(field_index) is None
+
+    def sampleRequest(self, field_index: int) -> QgsFeatureRequest:
+        """
+        標本の地物を読み込むリクエストを作成する
+        """
+        request = QgsFeatureRequest()
+        request.setFilterFids(self.sample_fids)
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([field_index])
+        return request
+
+    def invalidateSignals(self) -> list:
+        """
+        キャッシュを破棄するシグナル
+        """
+        return [self.layer.subsetStringChanged, self.layer.dataSourceChanged, self.layer.updatedFields, self.layer.afterRollBack]
+
+    def connectLayer(self):
+        """
+        データ変更時にキャッシュを更新するよう接続する
+        """
+        self.layer.attributeValueChanged.connect(self.onAttributeValueChanged)
+        self.layer.featureAdded.connect(self.onFeatureAdded)
+        self.layer.featureDeleted.connect(self.onFeatureDeleted)
+        self.layer.committedFeaturesAdded.connect(self.onCommittedFeaturesAdded)
+        for signal in self.invalidateSignals():
+            signal.connect(self.invalidate)
+
+    def disconnectLayer(self):
+        """
+        接続を解除する
+        """
+        self.pending_timer.stop()
+        self.layer.attributeValueChanged.disconnect(self.onAttributeValueChanged)
+        self.layer.featureAdded.disconnect(self.onFeatureAdded)
+        self.layer.featureDeleted.disconnect(self.onFeatureDeleted)
+        self.layer.committedFeaturesAdded.disconnect(self.onCommittedFeaturesAdded)
+        for signal in self.invalidateSignals():
+            signal.disconnect(self.invalidate)
+
+    def cachedFieldIndexes(self) -> set:
+        """
+        キャッシュ済みのフィールドindex
+        """
+        return set(self.numeric_columns.keys()) | set(self.date_counts.keys()) | set(self.summaries.keys())
+
+    def setFeatureValue(self, fid: int, field_index: int, value):
+        """
+        キャッシュ済みの列に地物の値を反映する
+        """
+        if field_index in self.numeric_columns:
+            self.numeric_columns[field_index].setValue(fid, None if isNullValue(value) else float(value))
+        if field_index in self.date_counts:
+            self.date_counts[field_index].setValue(fid, toPyDate(value))
+        if field_index in self.summaries:
+            # 変更前の値が分からないため追加のみ反映する
+            self.summaries[field_index].add(value)
+
+    def removeFeature(self, fid: int):
+        """
+        キャッシュ済みの列から地物を削除する
+        """
+        for column in self.numeric_columns.values():
+            column.removeFeature(fid)
+        for column in self.date_counts.values():
+            column.removeFeature(fid)
+
+    def discardRunningPrefetch(self):
+        """
+        先読み・集計中の結果は編集を反映していないため使わない
+        """
+        if self.prefetch_task is not None or len(self.numeric_tasks) > 0:
+            self.generation += 1
+
+    def onAttributeValueChanged(self, fid: int, field_index: int, value):
+        self.discardRunningPrefetch()
+        self.cross_fids.clear()
+        self.setFeatureValue(fid, field_index, value)
+
+    def onFeatureAdded(self, fid: int):
+        self.discardRunningPrefetch()
+        self.cross_fids.clear()
+        self.pending_fids.add(fid)
+        self.pending_timer.start(0)
+
+    def onFeatureDeleted(self, fid: int):
+        self.discardRunningPrefetch()
+        self.cross_fids.clear()
+        self.pending_fids.discard(fid)
+        self.removeFeature(fid)
+
+    def onCommittedFeaturesAdded(self, layer_id: str, features):
+        """
+        コミットで地物IDが確定した地物を反映する
+        """
+        # 未コミット時の一時的な地物IDを削除する
+        temporary_fids = set()
+        for column in list(self.numeric_columns.values()) + list(self.date_counts.values()):
+            temporary_fids.update(column.fid_values.temporaryFids())
+        for fid in temporary_fids:
+            self.removeFeature(fid)
+
+        field_indexes = self.cachedFieldIndexes()
+        for feature in features:
+            for field_index in field_indexes:
+                self.setFeatureValue(feature.id(), field_index, feature.attribute(field_index))
+
+    def processPendingFeatures(self):
+        """
+        追加された地物を読み込んでキャッシュ済みの列に反映する
+        """
+        fids = list(self.pending_fids)
+        self.pending_fids.clear()
+        field_indexes = list(self.cachedFieldIndexes())
+        if len(fids) == 0 or len(field_indexes) == 0:
+            return
+
+        request = QgsFeatureRequest()
+        request.setFilterFids(fids)
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(field_indexes)
+        for feature in self.layer.getFeatures(request):
+            for field_index in field_indexes:
+                self.setFeatureValue(feature.id(), field_index, feature.attribute(field_index))
+
+    def invalidate(self):
+        """
+        キャッシュを破棄する
+        """
+        self.numeric_columns.clear()
+        self.date_counts.clear()
+        self.summaries.clear()
+        self.cross_fids.clear()
+        self.pending_fids.clear()
+        self.generation += 1
+
+    def prefetch(self, field_indexes: list):
+        """
+        対象フィールドの固有値などをバックグラウンドで先読みする
+
+        @param  field_indexes:対象フィールドindexのリスト
+        """
+        self.cancelPrefetch()
+        if len(field_indexes) == 0:
+            return
+
+        task = EasyAttributeFilterPrefetchTask(self.layer, field_indexes, PREFETCH_UNIQUE_LIMIT)
+        generation = self.generation
+        task.taskCompleted.connect(lambda: self.onPrefetchCompleted(task, generation))
+        task.taskTerminated.connect(lambda: self.onPrefetchTerminated(task))
+        self.prefetch_task = task
+        QgsApplication.taskManager().addTask(task)
+
+    def cancelPrefetch(self):
+        """
+        先読みを中止する
+        """
+        if self.prefetch_task is not None:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+        for task in self.numeric_tasks.values():
+            task.cancel()
+        self.numeric_tasks.clear()
+
+    def onPrefetchCompleted(self, task: EasyAttributeFilterPrefetchTask, generation: int):
+        if self.prefetch_task is task:
+            self.prefetch_task = None
+        if generation == self.generation:
+            self.summaries.update(task.summaries)
+
+    def onPrefetchTerminated(self, task: EasyAttributeFilterPrefetchTask):
+        if self.prefetch_task is task:
+            self.prefetch_task = None
+
+    def summary(self, field_index: int) -> FieldSummary:
+        """
+        先読みした集計結果を取得する（未取得の場合はNone）
+        """
+        return self.summaries.get(field_index)
+
+    def uniqueValues(self, field_index: int, limit: int) -> set:
+        """
+        固有値を取得する
+
+        先読みが済んでいる場合はその結果を使い、済んでいない場合は列データの取得元またはレイヤから取得する。
+
+        @param  field_index:フィールドindex
+        @param  limit:上限件数
+        """
+        summary = self.summary(field_index)
+        if summary is not None and (limit <= summary.limit or not summary.isCapped()):
+            return summary.uniqueValues(limit)
+
+        store = self.usableColumnStore(field_index)
+        if store is not None:
+            uniques = store.uniqueValues(self.layer.fields().at(field_index).name(), limit)
+            if uniques is not None:
+                return uniques
+
+        if self.isApproximate(field_index):
+            summary = FieldSummary(limit)
+            for feature in self.layer.getFeatures(self.sampleRequest(field_index)):
+                summary.add(feature.attribute(field_index))
+            return summary.uniqueValues(limit)
+        return self.layer.uniqueValues(field_index, limit)
+
+    def valueFrequencies(self, field_index: int, count: int=TOP_VALUE_COUNT):
+        """
+        固有値の数と頻出値を取得する（NULLを除く）
+
+        列データの取得元がある場合は正確な値を求める。
+        ない場合は1回の読み込みで概算し、先読みの結果として保持する。
+
+        @param  field_index:フィールドindex
+        @param  count:頻出値の件数
+        @return (固有値の数, [(値, 件数)]（件数の多い順）, 正確な値か)
+        """
+        summary = self.summary(field_index)
+        if summary is None:
+            store = self.usableColumnStore(field_index)
+            if store is not None:
+                frequencies = store.valueFrequencies(self.layer.fields().at(field_index).name(), count)
+                if frequencies is not None:
+                    return frequencies
+
+            summary = FieldSummary(PREFETCH_UNIQUE_LIMIT)
+            if self.isApproximate(field_index):
+                request = self.sampleRequest(field_index)
+            else:
+                request = QgsFeatureRequest()
+                request.setFlags(QgsFeatureRequest.NoGeometry)
+                request.setSubsetOfAttributes([field_index])
+            for feature in self.layer.getFeatures(request):
+                summary.add(feature.attribute(field_index))
+            if not self.isApproximate(field_index):
+                self.summaries[field_index] = summary
+
+        distinct_count, top_values, is_exact = summary.valueFrequencies(count)
+        return (distinct_count, top_values, is_exact and not self.isApproximate(field_index))
+
+    def crossFilterRequest(self, expressions: list, fids, field_index: int) -> QgsFeatureRequest:
+        """
+        他の列のフィルターを通過した地物を読み込むリクエストを作成する
+
+        通過した地物IDが分かっている場合はその地物のみ、分からない場合はフィルター式を
+        プロバイダに渡して抽出させる。
+
+        @param  expressions:他の列のフィルター式のリスト
+        @param  fids:通過した地物IDの集合（分からない場合はNone）
+        @param  field_index:読み込むフィールドindex
+        """
+        request = QgsFeatureRequest()
+        if fids is not None:
+            request.setFilterFids(list(fids))
+        else:
+            request.setFilterExpression(" AND ".join(f"({expression})" for expression in expressions))
+            request.setExpressionContext(QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(self.layer)))
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([field_index])
+        return request
+
+    def storeCrossFids(self, expressions: list, fids: set):
+        """
+        他の列のフィルターを通過した地物IDを保持する（古いものから破棄する）
+        """
+        self.cross_fids[tuple(expressions)] = fids
+        while len(self.cross_fids) > CROSS_FILTER_CACHE_SIZE:
+            del self.cross_fids[next(iter(self.cross_fids))]
+
+    def crossValueCounts(self, field_index: int, expressions: list, fids=None):
+        """
+        他の列のフィルターを通過した地物について、固有値ごとの件数を求める
+
+        列データの取得元がある場合は1回の問い合わせで集計する。
+        ない場合は通過した地物IDを保持し、他の列を開いた際にも使う。
+
+        @param  field_index:フィールドindex
+        @param  expressions:他の列のフィルター式のリスト
+        @param  fids:通過した地物IDの集合（分かっている場合）
+        @return ({値: 件数}, NULLの件数)
+        """
+        store = self.usableColumnStore(field_index)
+        if store is not None:
+            result = store.valueCountsMatching(self.layer.fields().at(field_index).name(), expressions)
+            if result is not None:
+                return result
+
+        if fids is None:
+            fids = self.cross_fids.get(tuple(expressions))
+        collect_fids = fids is None
+        matched_fids = set()
+
+        counts = dict()
+        null_count = 0
+        for feature in self.layer.getFeatures(self.crossFilterRequest(expressions, fids, field_index)):
+            if collect_fids:
+                matched_fids.add(feature.id())
+            value = feature.attribute(field_index)
+            if isNullValue(value):
+                null_count += 1
+                continue
+            counts[value] = counts.get(value, 0) + 1
+
+        if collect_fids:
+            self.storeCrossFids(expressions, matched_fids)
+        return (counts, null_count)
+
+    def crossDateCounts(self, field_index: int, expressions: list, fids=None):
+        """
+        他の列のフィルターを通過した地物について、日付ごとの件数を求める
+
+        日付の列がキャッシュ済みで通過した地物IDが分かっている場合は、地物IDごとの値から集計する。
+
+        @param  field_index:フィールドindex
+        @param  expressions:他の列のフィルター式のリスト
+        @param  fids:通過した地物IDの集合（分かっている場合）
+        @return ({datetime.date: 件数}, NULLの件数)
+        """
+        if fids is None:
+            fids = self.cross_fids.get(tuple(expressions))
+
+        counts = dict()
+        null_count = 0
+        column = self.date_counts.get(field_index)
+        if fids is not None and column is not None:
+            for fid in fids:
+                ordinal = column.fid_values.get(fid)
+                if ordinal is None or ordinal == 0:
+                    null_count += 1
+                    continue
+                date = datetime.date.fromordinal(ordinal)
+                counts[date] = counts.get(date, 0) + 1
+            return (counts, null_count)
+
+        collect_fids = fids is None
+        matched_fids = set()
+        for feature in self.layer.getFeatures(self.crossFilterRequest(expressions, fids, field_index)):
+            if collect_fids:
+                matched_fids.add(feature.id())
+            date = toPyDate(feature.attribute(field_index))
+            if date is None:
+                null_count += 1
+                continue
+            counts[date] = counts.get(date, 0) + 1
+
+        if collect_fids:
+            self.storeCrossFids(expressions, matched_fids)
+        return (counts, null_count)
+
+    def numericColumn(self, field_index: int) -> NumericColumn:
+        """
+        数値列を取得する
+
+        キャッシュ済みの場合や列データの取得元・標本から求められる場合のみ返す。
+        レイヤ全体の読み込みが必要な場合はloadNumericColumnでバックグラウンドで集計する。
+
+        @param  field_index:フィールドindex
+        @return 数値列（集計が必要な場合はNone）
+        """
+        if field_index in self.numeric_columns:
+            return self.numeric_columns[field_index]
+
+        store = self.usableColumnStore(field_index)
+        data = store.numericColumnData(self.layer.fields().at(field_index).name(), HISTOGRAM_BINS) if store is not None else None
+        if data is not None:
+            values, minimum, maximum, histogram, fids, fid_values = data
+            column = NumericColumn(values, minimum, maximum, histogram, FidValues.fromArrays(fids, fid_values))
+            self.numeric_columns[field_index] = column
+            return column
+
+        if self.isApproximate(field_index):
+            # 標本からの概算はキャッシュしない
+            values = [float(feature.attribute(field_index)) for feature in self.layer.getFeatures(self.sampleRequest(field_index))
+                      if not isNullValue(feature.attribute(field_index))]
+            column = NumericColumn(array("d", sorted(values)), 0.0, 0.0, [])
+            column.updateHistogram()
+            return column
+
+        return None
+
+    def loadNumericColumn(self, field_index: int) -> EasyAttributeFilterNumericColumnTask:
+        """
+        数値列をバックグラウンドで集計する
+
+        完了後はnumericColumnで取得できる（集計中に編集された場合を除く）。
+
+        @param  field_index:フィールドindex
+        @return 集計タスク（集計中の場合は実行中のタスク）
+        """
+        task = self.numeric_tasks.get(field_index)
+        if task is not None:
+            return task
+
+        task = EasyAttributeFilterNumericColumnTask(self.layer, field_index)
+        generation = self.generation
+        task.taskCompleted.connect(lambda: self.onNumericColumnFinished(task, generation))
+        task.taskTerminated.connect(lambda: self.onNumericColumnFinished(task, None))
+        self.numeric_tasks[field_index] = task
+        QgsApplication.taskManager().addTask(task)
+        return task
+
+    def onNumericColumnFinished(self, task: EasyAttributeFilterNumericColumnTask, generation):
+        if self.numeric_tasks.get(task.field_index) is task:
+            del self.numeric_tasks[task.field_index]
+        if generation == self.generation and task.column is not None:
+            self.numeric_columns[task.field_index] = task.column
+
+    def dateCounts(self, field_index: int):
+        """
+        日付ごとの件数を取得する
+
+        日時の場合は日付単位に集計する。列データの取得元がない場合、集計は1回の読み込みで行う。
+
+        @param  field_index:フィールドindex
+        @return ({datetime.date: 件数}, NULLの件数)
+        """
+        if field_index in self.date_counts:
+            column = self.date_counts[field_index]
+            return (column.counts, column.null_count)
+
+        store = self.usableColumnStore(field_index)
+        data = store.dateColumnData(self.layer.fields().at(field_index).name()) if store is not None else None
+        if data is not None:
+            counts, null_count, fids, ordinals = data
+            column = DateColumn(counts, null_count, FidValues.fromArrays(fids, ordinals))
+            self.date_counts[field_index] = column
+            return (column.counts, column.null_count)
+
+        if self.isApproximate(field_index):
+            request = self.sampleRequest(field_index)
+        else:
+            request = QgsFeatureRequest()
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+            request.setSubsetOfAttributes([field_index])
+
+        counts = dict()
+        null_count = 0
+        pairs = []
+        for feature in self.layer.getFeatures(request):
+            date = toPyDate(feature.attribute(field_index))
+            if date is None:
+                null_count += 1
+                pairs.append((feature.id(), 0))
+                continue
+            counts[date] = counts.get(date, 0) + 1
+            pairs.append((feature.id(), date.toordinal()))
+
+        column = DateColumn(counts, null_count, FidValues.fromPairs("l", pairs))
+        if self.isApproximate(field_index):
+            # 標本からの概算はキャッシュしない
+            return (column.counts, column.null_count)
+        self.date_counts[field_index] = column
+        return (column.counts, column.null_count)
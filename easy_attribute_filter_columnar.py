@@ -0,0 +1,925 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterColumnStore
+                                 A QGIS plugin
+ ファイルレイヤの列データのディスクキャッシュ
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+ 列ごとの値をNPYファイルに保存し、メモリマップで読み込む。
+ キャッシュはデータソースのパス・サイズ・更新日時ごとに作成するため、
+ 同じファイルを開く別のQGISからも共有され、ページはOSのキャッシュで共有される。
+ numpyが使用できない環境では使用しない。
+"""
+import os
+import copy
+import json
+import bisect
+import glob
+import shutil
+import time
+import hashlib
+import datetime
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from qgis.PyQt.QtCore import QVariant, QDate, QDateTime
+from qgis.core import (QgsApplication, QgsTask, QgsFeatureRequest, QgsFields, QgsProviderRegistry,
+                       QgsVectorLayer, QgsVectorLayerFeatureSource)
+
+from .easy_attribute_filter_predicate import (parsePredicate, compareValues, ValueSetPredicate, NullPredicate,
+                                              ComparisonPredicate, LikePredicate, DateRangePredicate, LogicalPredicate)
+
+# キャッシュの形式（変更した場合は既存のキャッシュを使わない）
+STORE_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+# 一度に書き出す行数
+WRITE_CHUNK_SIZE = 65536
+# 日時の基準
+EPOCH = datetime.datetime(1970, 1, 1)
+# 古いキャッシュを削除するまでの時間（秒）
+OUTDATED_GRACE_SECONDS = 24 * 60 * 60
+
+# フィールドの型：列の種類
+COLUMN_KINDS = {QVariant.Int: "int", QVariant.UInt: "int", QVariant.LongLong: "int", QVariant.Bool: "int",
+                QVariant.Double: "double", QVariant.String: "string",
+                QVariant.Date: "date", QVariant.DateTime: "datetime"}
+# 列の種類：値の配列の型
+VALUE_DTYPES = {"int": "int64", "double": "float64", "string": "int32", "date": "int32", "datetime": "int64"}
+
+
+def isNumpyAvailable() -> bool:
+    return numpy is not None
+
+
+def toColumnValue(kind: str, value):
+    """
+    属性値を列の値に変換する
+
+    @param  kind:列の種類
+    @param  value:属性値
+    @return 列の値（NULLはNone）
+    """
+    if value is None or (isinstance(value, QVariant) and value.isNull()):
+        return None
+    if kind == "int":
+        return int(value)
+    if kind == "double":
+        return float(value)
+    if kind == "string":
+        return str(value)
+    if kind == "date":
+        if isinstance(value, QDateTime):
+            value = value.date()
+        if isinstance(value, QDate):
+            return value.toPyDate().toordinal() if value.isValid() else None
+        return datetime.date.fromisoformat(str(value)[:10]).toordinal()
+    if kind == "datetime":
+        if isinstance(value, QDateTime):
+            if not value.isValid():
+                return None
+            value = value.toPyDateTime()
+        elif isinstance(value, QDate):
+            value = datetime.datetime.combine(value.toPyDate(), datetime.time())
+        elif not isinstance(value, datetime.datetime):
+            value = datetime.datetime.fromisoformat(str(value))
+        return (value.replace(tzinfo=None) - EPOCH) // datetime.timedelta(milliseconds=1)
+    return None
+
+
+def fromColumnValue(kind: str, value):
+    """
+    列の値を属性値（Pythonの値）に変換する
+    """
+    if kind == "date":
+        return datetime.date.fromordinal(int(value))
+    if kind == "datetime":
+        return EPOCH + datetime.timedelta(milliseconds=int(value))
+    return value.item() if hasattr(value, "item") else value
+
+
+def prefixMatches(dictionary: list, prefix: str, limit: int) -> list:
+    """
+    昇順の辞書から前方一致する値を取得する
+
+    二分探索で先頭を求める。
+
+    @param  dictionary:文字列の辞書（昇順）
+    @param  prefix:前方一致させる文字列
+    @param  limit:上限件数
+    @return 前方一致する値の昇順のリスト
+    """
+    values = []
+    for index in range(bisect.bisect_left(dictionary, prefix), len(dictionary)):
+        text = dictionary[index]
+        if not text.startswith(prefix) or len(values) >= limit:
+            break
+        values.append(text)
+    return values
+
+
+def toArray(typecode: str, values) -> array:
+    """
+    numpyの配列をarrayに変換する
+    """
+    result = array(typecode)
+    result.frombytes(numpy.ascontiguousarray(values, dtype=numpy.dtype(typecode)).tobytes())
+    return result
+
+
+class ColumnWriter:
+    """
+    列の値を一時ファイルに追記し、最後にNPYファイルに変換する
+
+    書き出し中にメモリに保持するのは一定行数のみとする。
+    """
+
+    def __init__(self, directory: str, name: str, kind: str):
+        self.directory = directory
+        self.name = name
+        self.kind = kind
+        self.dtype = numpy.dtype(VALUE_DTYPES[kind])
+        self.values = []
+        self.nulls = []
+        self.value_file = open(os.path.join(directory, f"{name}.values.raw"), "wb")
+        self.null_file = open(os.path.join(directory, f"{name}.null.raw"), "wb")
+        # 文字列の辞書 {値: 仮の符号}
+        self.dictionary = dict()
+
+    def append(self, value):
+        """
+        値を追加する
+
+        @param  value:列の値（NULLはNone）
+        """
+        if value is None:
+            self.values.append(-1 if self.kind == "string" else 0)
+            self.nulls.append(True)
+        else:
+            if self.kind == "string":
+                value = self.dictionary.setdefault(value, len(self.dictionary))
+            self.values.append(value)
+            self.nulls.append(False)
+
+        if len(self.values) >= WRITE_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        numpy.array(self.values, dtype=self.dtype).tofile(self.value_file)
+        numpy.array(self.nulls, dtype=numpy.bool_).tofile(self.null_file)
+        self.values.clear()
+        self.nulls.clear()
+
+    def finish(self, order) -> dict:
+        """
+        NPYファイルに変換する
+
+        文字列は辞書を昇順に並べ、符号の大小が値の大小と一致するよう振り直す。
+
+        @param  order:地物IDの昇順に並べ替える行の順序（並べ替えが不要な場合はNone）
+        @return マニフェストに記録する列の情報
+        """
+        self.flush()
+        self.value_file.close()
+        self.null_file.close()
+
+        info = {"kind": self.kind, "file": self.name}
+        for suffix, dtype in (("values", self.dtype), ("null", numpy.bool_)):
+            raw_path = os.path.join(self.directory, f"{self.name}.{suffix}.raw")
+            data = numpy.fromfile(raw_path, dtype=dtype)
+            if suffix == "values" and self.kind == "string" and len(self.dictionary) > 0:
+                texts = list(self.dictionary.keys())
+                sorted_codes = sorted(range(len(texts)), key=texts.__getitem__)
+                remap = numpy.empty(len(texts) + 1, dtype=self.dtype)
+                remap[numpy.array(sorted_codes, dtype=numpy.int64)] = numpy.arange(len(texts), dtype=self.dtype)
+                # NULL（-1）は末尾の要素で-1のまま残す
+                remap[-1] = -1
+                data = remap[data]
+                with open(os.path.join(self.directory, f"{self.name}.dict.json"), "w", encoding="utf-8") as file:
+                    json.dump([texts[code] for code in sorted_codes], file, ensure_ascii=False)
+            elif suffix == "values" and self.kind == "string":
+                with open(os.path.join(self.directory, f"{self.name}.dict.json"), "w", encoding="utf-8") as file:
+                    json.dump([], file)
+            if order is not None:
+                data = data[order]
+            numpy.save(os.path.join(self.directory, f"{self.name}.{suffix}.npy"), data)
+            os.remove(raw_path)
+        return info
+
+    def close(self):
+        """
+        書き出し中のファイルを閉じる
+        """
+        self.value_file.close()
+        self.null_file.close()
+
+    def discard(self):
+        """
+        書き出しを中止する（変換できない値があった列）
+        """
+        self.close()
+        for suffix in ("values", "null"):
+            raw_path = os.path.join(self.directory, f"{self.name}.{suffix}.raw")
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+
+
+class ColumnarSource:
+    """
+    列ごとの値の配列に対する固有値・並び替え・フィルターの問い合わせ
+
+    派生クラスで地物ID（昇順）・列の値とNULLの配列・文字列の辞書（昇順）を提供する。
+    文字列は辞書の符号で保持し、NULLの符号は-1とする。
+    派生クラスはQObjectと多重継承するため抽象基底クラスにはせず、既定では列を持たない取得元とする。
+    """
+
+    def isUsable(self) -> bool:
+        return False
+
+    def fieldKind(self, field_name: str) -> str:
+        """
+        列の種類を取得する
+
+        @return 列の種類（列がない、またはフィールドの型が異なる場合はNone）
+        """
+        return None
+
+    def hasField(self, field_name: str) -> bool:
+        return self.fieldKind(field_name) is not None
+
+    def fids(self):
+        """
+        地物ID（昇順）
+        """
+        return numpy.empty(0, dtype=numpy.int64)
+
+    def column(self, field_name: str):
+        """
+        列の値とNULLの配列を取得する（fieldKindが列の種類を返す列のみ）
+
+        @return (値, NULL)
+        """
+        raise KeyError(field_name)
+
+    def dictionary(self, field_name: str) -> list:
+        """
+        文字列の辞書（昇順）を取得する
+        """
+        return []
+
+    def uniqueValues(self, field_name: str, limit: int):
+        """
+        固有値を取得する（NULLはNoneとして含める）
+
+        @return 固有値の集合（キャッシュで解決できない場合はNone）
+        """
+        kind = self.fieldKind(field_name)
+        if kind not in ("int", "double", "string"):
+            return None
+
+        values, nulls = self.column(field_name)
+        if kind == "string":
+            uniques = self.dictionary(field_name)[0:limit]
+        else:
+            uniques = numpy.unique(values[~nulls])[0:limit].tolist()
+        uniques = set(uniques)
+        if len(uniques) < limit and nulls.any():
+            uniques.add(None)
+        return uniques
+
+    def valueFrequencies(self, field_name: str, count: int):
+        """
+        固有値の数と頻出値を取得する（NULLを除く）
+
+        @param  count:頻出値の件数
+        @return (固有値の数, [(値, 件数)]（件数の多い順）, 正確な値か)（キャッシュで解決できない場合はNone）
+        """
+        kind = self.fieldKind(field_name)
+        if kind not in ("int", "double", "string"):
+            return None
+
+        values, nulls = self.column(field_name)
+        uniques, frequencies = numpy.unique(values[~nulls], return_counts=True)
+        # 件数の多い順（同数の場合は値の昇順）
+        order = numpy.argsort(-frequencies, kind="stable")[0:count]
+        if kind == "string":
+            dictionary = self.dictionary(field_name)
+            top_values = [(dictionary[int(uniques[index])], int(frequencies[index])) for index in order]
+        else:
+            top_values = [(uniques[index].item(), int(frequencies[index])) for index in order]
+        return (len(uniques), top_values, True)
+
+    def prefixValues(self, field_name: str, prefix: str, limit: int):
+        """
+        前方一致する固有値を取得する（文字列のみ）
+
+        @param  prefix:前方一致させる文字列
+        @param  limit:上限件数
+        @return 固有値の昇順のリスト（キャッシュで解決できない場合はNone）
+        """
+        if self.fieldKind(field_name) != "string":
+            return None
+        return prefixMatches(self.dictionary(field_name), prefix, limit)
+
+    def numericColumnData(self, field_name: str, bins: int):
+        """
+        数値列の範囲フィルター用のデータを取得する
+
+        @param  bins:ヒストグラムの階級数
+        @return (昇順に並べた値, 最小値, 最大値, ヒストグラム, 地物ID, 地物IDごとの値)（解決できない場合はNone）
+        """
+        if self.fieldKind(field_name) not in ("int", "double"):
+            return None
+
+        values, nulls = self.column(field_name)
+        not_null = ~nulls
+        fids = self.fids()[not_null]
+        fid_values = values[not_null].astype(numpy.float64)
+        sorted_values = numpy.sort(fid_values)
+        if len(sorted_values) == 0:
+            return (array("d"), 0.0, 0.0, [0] * bins, array("q"), array("d"))
+
+        minimum = float(sorted_values[0])
+        maximum = float(sorted_values[-1])
+        histogram, _ = numpy.histogram(sorted_values, bins=bins, range=(minimum, maximum) if maximum > minimum else None)
+        if maximum <= minimum:
+            histogram = [len(sorted_values)] + [0] * (bins - 1)
+        return (toArray("d", sorted_values), minimum, maximum, list(map(int, histogram)), toArray("q", fids), toArray("d", fid_values))
+
+    def dateColumnData(self, field_name: str):
+        """
+        日付ごとの件数を取得する（日時は日付単位に集計する）
+
+        @return ({datetime.date: 件数}, NULLの件数, 地物ID, 地物IDごとの日付の序数（NULLは0））（解決できない場合はNone）
+        """
+        kind = self.fieldKind(field_name)
+        if kind not in ("date", "datetime"):
+            return None
+
+        values, nulls = self.column(field_name)
+        if kind == "datetime":
+            ordinals = values // 86400000 + EPOCH.toordinal()
+        else:
+            ordinals = numpy.array(values, dtype=numpy.int64)
+        ordinals[nulls] = 0
+
+        uniques, counts = numpy.unique(ordinals[~nulls], return_counts=True)
+        date_counts = {datetime.date.fromordinal(int(ordinal)): int(count) for ordinal, count in zip(uniques, counts)}
+        return (date_counts, int(nulls.sum()), toArray("q", self.fids()), toArray("l", ordinals))
+
+    def sampleFids(self, count: int):
+        """
+        無作為に選んだ地物IDを取得する
+
+        @param  count:件数
+        @return 地物IDのリスト（キャッシュを使用できない場合はNone）
+        """
+        if not self.isUsable():
+            return None
+        fids = self.fids()
+        if len(fids) <= count:
+            return fids.tolist()
+        return numpy.sort(numpy.random.default_rng().choice(fids, count, replace=False)).tolist()
+
+    def rowPositions(self, fids: list):
+        """
+        地物IDに対応するキャッシュの行を求める
+
+        @return 行の配列（キャッシュにない地物IDがある場合はNone）
+        """
+        store_fids = self.fids()
+        fids = numpy.array(fids, dtype=numpy.int64)
+        positions = numpy.searchsorted(store_fids, fids)
+        if len(store_fids) == 0 or positions.max(initial=0) >= len(store_fids) or not numpy.array_equal(store_fids[positions], fids):
+            return None
+        return positions
+
+    def sortRanks(self, field_name: str, fids: list):
+        """
+        地物の並び順（同じ値は同じ順位）を求める
+
+        @param  fids:地物IDのリスト（元モデルの行順）
+        @return (順位ごとの値（NULLはNone）, 行ごとの順位)（解決できない場合はNone）
+        """
+        kind = self.fieldKind(field_name)
+        if kind is None:
+            return None
+        positions = self.rowPositions(fids)
+        if positions is None:
+            return None
+
+        values, nulls = self.column(field_name)
+        row_values = values[positions]
+        row_nulls = nulls[positions]
+        has_null = bool(row_nulls.any())
+        offset = 1 if has_null else 0
+
+        if kind == "string":
+            # 辞書が昇順のため符号がそのまま順位になる
+            uniques = self.dictionary(field_name)
+            ranks = row_values.astype(numpy.float64) + offset
+        else:
+            uniques = numpy.unique(row_values[~row_nulls])
+            ranks = numpy.searchsorted(uniques, row_values).astype(numpy.float64) + offset
+            ranks[row_nulls] = 0.0
+            uniques = [fromColumnValue(kind, value) for value in uniques]
+
+        return (([None] if has_null else []) + list(uniques), toArray("d", ranks))
+
+    def matchingFids(self, expression: str):
+        """
+        フィルター式に一致する地物IDを取得する
+
+        @param  expression:式
+        @return 地物IDの集合（キャッシュで解決できない場合はNone）
+        """
+        if not self.isUsable():
+            return None
+        predicate = parsePredicate(expression)
+        if predicate is None:
+            return None
+
+        mask = self.evaluate(predicate)
+        if mask is None:
+            return None
+        return set(self.fids()[mask].tolist())
+
+    def matchingMask(self, expressions: list):
+        """
+        全てのフィルター式に一致する行を求める
+
+        @param  expressions:フィルター式のリスト
+        @return 行ごとの真偽値の配列（キャッシュで解決できない式がある場合はNone）
+        """
+        if not self.isUsable():
+            return None
+
+        mask = numpy.ones(len(self.fids()), dtype=numpy.bool_)
+        for expression in expressions:
+            predicate = parsePredicate(expression)
+            matched = self.evaluate(predicate) if predicate is not None else None
+            if matched is None:
+                return None
+            mask &= matched
+        return mask
+
+    def countMatching(self, expressions: list):
+        """
+        フィルター式に一致する件数を求める
+
+        @param  expressions:フィルター式のリスト
+        @return 件数（キャッシュで解決できない式がある場合はNone）
+        """
+        mask = self.matchingMask(expressions)
+        if mask is None:
+            return None
+        return int(numpy.count_nonzero(mask))
+
+    def valueCountsMatching(self, field_name: str, expressions: list):
+        """
+        フィルター式に一致する行の固有値ごとの件数を求める
+
+        @param  expressions:フィルター式のリスト
+        @return ({値: 件数}, NULLの件数)（キャッシュで解決できない場合はNone）
+        """
+        kind = self.fieldKind(field_name)
+        if kind not in ("int", "double", "string"):
+            return None
+        mask = self.matchingMask(expressions)
+        if mask is None:
+            return None
+
+        values, nulls = self.column(field_name)
+        uniques, frequencies = numpy.unique(values[mask & ~nulls], return_counts=True)
+        if kind == "string":
+            dictionary = self.dictionary(field_name)
+            uniques = [dictionary[code] for code in uniques.tolist()]
+        else:
+            uniques = uniques.tolist()
+        return (dict(zip(uniques, frequencies.tolist())), int(numpy.count_nonzero(mask & nulls)))
+
+    @staticmethod
+    def dictionaryCodes(dictionary: list, values) -> list:
+        """
+        値に対応する辞書の符号を求める（辞書にない値は除く）
+
+        @param  dictionary:文字列の辞書（昇順）
+        @param  values:値
+        """
+        codes = []
+        for value in values:
+            text = str(value)
+            code = bisect.bisect_left(dictionary, text)
+            if code < len(dictionary) and dictionary[code] == text:
+                codes.append(code)
+        return codes
+
+    def evaluate(self, predicate):
+        """
+        条件に一致する行を求める
+
+        @return 行ごとの真偽値の配列（キャッシュで解決できない場合はNone）
+        """
+        if isinstance(predicate, LogicalPredicate):
+            masks = [self.evaluate(child) for child in predicate.children]
+            if any(mask is None for mask in masks):
+                return None
+            combine = numpy.logical_and if predicate.operator == "AND" else numpy.logical_or
+            return combine.reduce(masks)
+
+        kind = self.fieldKind(predicate.field)
+        if kind is None:
+            return None
+        values, nulls = self.column(predicate.field)
+
+        if isinstance(predicate, NullPredicate):
+            return numpy.array(nulls)
+
+        if kind == "string":
+            dictionary = self.dictionary(predicate.field)
+            if isinstance(predicate, ValueSetPredicate):
+                # 判定値を辞書の符号に変換し、符号の比較で判定する
+                codes = self.dictionaryCodes(dictionary, predicate.values)
+                if predicate.include_null:
+                    codes.append(-1)
+                return numpy.isin(values, numpy.array(codes, dtype=values.dtype))
+            # その他の条件は辞書の値ごとに判定し、符号で引き当てる
+            if isinstance(predicate, LikePredicate):
+                lookup = [predicate.matchesText(text) for text in dictionary]
+                include_null = False
+            elif isinstance(predicate, ComparisonPredicate) and isinstance(predicate.value, str):
+                lookup = [compareValues(text, predicate.operator, predicate.value) for text in dictionary]
+                include_null = False
+            else:
+                return None
+            # NULL（-1）は末尾の要素で引き当てる
+            lookup = numpy.array(lookup + [include_null], dtype=numpy.bool_)
+            return lookup[values]
+
+        if kind in ("int", "double"):
+            if isinstance(predicate, ValueSetPredicate):
+                try:
+                    targets = [float(value) for value in predicate.values]
+                except ValueError:
+                    return None
+                mask = numpy.isin(values, targets) & ~nulls
+                return mask | nulls if predicate.include_null else mask
+            if isinstance(predicate, ComparisonPredicate):
+                try:
+                    target = float(predicate.value)
+                except ValueError:
+                    return None
+                operators = {"=": numpy.equal, "!=": numpy.not_equal, ">": numpy.greater, ">=": numpy.greater_equal,
+                             "<": numpy.less, "<=": numpy.less_equal}
+                return operators[predicate.operator](values, target) & ~nulls
+            return None
+
+        if isinstance(predicate, DateRangePredicate):
+            mask = numpy.zeros(len(values), dtype=numpy.bool_)
+            for start, end in predicate.ranges:
+                if kind == "date":
+                    lower, upper = start.toordinal(), end.toordinal()
+                else:
+                    lower = toColumnValue("datetime", datetime.datetime.combine(start, datetime.time()))
+                    upper = toColumnValue("datetime", datetime.datetime.combine(end, datetime.time()))
+                mask |= (values >= lower) & (values < upper)
+            mask &= ~nulls
+            return mask | nulls if predicate.include_null else mask
+        return None
+
+
+class EasyAttributeFilterColumnStore(ColumnarSource):
+    """
+    レイヤのデータソースごとの列データのディスクキャッシュ
+
+    キャッシュはコミット済みのデータを対象とし、データソースのファイルサイズ・更新日時が
+    作成時と異なる場合や、未コミットの編集がある場合は使用しない。
+    """
+
+    def __init__(self, layer: QgsVectorLayer):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        """
+        self.layer = layer
+        uri = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source())
+        self.source_path = uri.get("path", "")
+        self.layer_name = uri.get("layerName", "") or ""
+
+        key = hashlib.sha1(f"{os.path.abspath(self.source_path)}|{self.layer_name}|{layer.subsetString()}".encode("utf-8")).hexdigest()
+        self.store_dir = os.path.join(QgsApplication.qgisSettingsDirPath(), "easy_attribute_filter", "columns", key)
+
+        # 読み込んだキャッシュ
+        self.directory = None
+        self.manifest = None
+        self.arrays = dict()
+        self.dictionaries = dict()
+        self.build_task = None
+        # スナップショットで固定したレイヤの状態
+        self.layer_state = None
+
+    @staticmethod
+    def isSupported(layer: QgsVectorLayer) -> bool:
+        """
+        ディスクキャッシュを使用できるレイヤか判定する
+        """
+        if not isNumpyAvailable() or layer is None or layer.providerType() != "ogr":
+            return False
+        uri = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source())
+        return os.path.isfile(uri.get("path", ""))
+
+    def sourceFiles(self) -> list:
+        """
+        変更を検知するファイル（シェープファイルの場合は属性を持つ.dbf、WALモードの場合は-walも含める）
+        """
+        files = [self.source_path]
+        dbf_path = os.path.splitext(self.source_path)[0] + ".dbf"
+        if dbf_path != self.source_path and os.path.exists(dbf_path):
+            files.append(dbf_path)
+        # WALモードのデータベースはチェックポイントまで変更が-walファイルにのみ書き込まれる
+        wal_path = self.source_path + "-wal"
+        if os.path.exists(wal_path):
+            files.append(wal_path)
+        return files
+
+    def stampDirectory(self) -> str:
+        """
+        データソースのファイルサイズ・更新日時に対応するキャッシュのディレクトリ
+        """
+        stamps = []
+        for path in self.sourceFiles():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            stamps.append(f"{stat.st_size}:{stat.st_mtime_ns}")
+        return os.path.join(self.store_dir, hashlib.sha1("|".join(stamps).encode("utf-8")).hexdigest()[:16])
+
+    def load(self) -> bool:
+        """
+        データソースに対応するキャッシュを読み込む
+
+        @return 読み込めたか
+        """
+        self.unload()
+        directory = self.stampDirectory()
+        if directory is None:
+            return False
+
+        try:
+            with open(os.path.join(directory, MANIFEST_FILE), encoding="utf-8") as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return False
+        if manifest.get("version") != STORE_VERSION:
+            return False
+
+        self.directory = directory
+        self.manifest = manifest
+        return True
+
+    def unload(self):
+        """
+        読み込んだキャッシュを解放する
+        """
+        self.directory = None
+        self.manifest = None
+        self.arrays.clear()
+        self.dictionaries.clear()
+
+    def isLoaded(self) -> bool:
+        return self.manifest is not None
+
+    def layerState(self):
+        """
+        レイヤの状態を取得する
+
+        @return (フィールド, 未コミットの編集があるか)（スナップショットでは作成時の状態）
+        """
+        if self.layer_state is not None:
+            return self.layer_state
+        return (self.layer.fields(), self.layer.isEditable() and self.layer.isModified())
+
+    def snapshot(self):
+        """
+        レイヤの現在の状態を固定した複製を作成する
+
+        複製はレイヤを参照しないため、別のスレッドで使う場合はレイヤを所有するスレッドで作成して渡す。
+        """
+        store = copy.copy(self)
+        store.layer = None
+        store.layer_state = (QgsFields(self.layer.fields()), self.layer.isEditable() and self.layer.isModified())
+        store.arrays = dict(self.arrays)
+        store.dictionaries = dict(self.dictionaries)
+        store.build_task = None
+        return store
+
+    def isUsable(self) -> bool:
+        """
+        キャッシュを使用できるか判定する
+        """
+        if self.manifest is None or self.directory != self.stampDirectory():
+            # データソースが変更された
+            return False
+        # 未コミットの編集はキャッシュに反映されていない
+        return not self.layerState()[1]
+
+    def isBuilding(self) -> bool:
+        return self.build_task is not None
+
+    def build(self):
+        """
+        キャッシュをバックグラウンドで作成する
+
+        作成はレイヤから読み込むため、未コミットの編集がある場合は作成せずコミット後に作成する。
+
+        @return 作成タスク（作成中または未コミットの編集がある場合はNone）
+        """
+        if self.build_task is not None or (self.layer.isEditable() and self.layer.isModified()):
+            return None
+
+        task = EasyAttributeFilterColumnBuildTask(self)
+        task.taskCompleted.connect(lambda: self.onBuildFinished(task))
+        task.taskTerminated.connect(lambda: self.onBuildFinished(task))
+        self.build_task = task
+        QgsApplication.taskManager().addTask(task)
+        return task
+
+    def cancelBuild(self):
+        if self.build_task is not None:
+            self.build_task.cancel()
+            self.build_task = None
+
+    def onBuildFinished(self, task):
+        if self.build_task is task:
+            self.build_task = None
+            self.load()
+
+    def removeOutdated(self, keep_directory: str):
+        """
+        古いデータソースのキャッシュを削除する
+
+        他のQGISがメモリマップで使用中の場合があるため、作成から一定時間が経過したもののみ削除する。
+        """
+        expired = time.time() - OUTDATED_GRACE_SECONDS
+        for directory in glob.glob(os.path.join(self.store_dir, "*")):
+            if directory == keep_directory or directory.endswith(".tmp"):
+                continue
+            try:
+                if os.path.getmtime(directory) > expired:
+                    continue
+            except OSError:
+                continue
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def fieldKind(self, field_name: str) -> str:
+        """
+        キャッシュにある列の種類を取得する
+
+        @return 列の種類（キャッシュにない、またはフィールドの型が異なる場合はNone）
+        """
+        if not self.isUsable():
+            return None
+        info = self.manifest["fields"].get(field_name)
+        if info is None:
+            return None
+        fields = self.layerState()[0]
+        field_index = fields.indexOf(field_name)
+        if field_index < 0 or COLUMN_KINDS.get(fields.at(field_index).type()) != info["kind"]:
+            return None
+        return info["kind"]
+
+    def loadArray(self, name: str):
+        """
+        NPYファイルをメモリマップで読み込む
+        """
+        if name not in self.arrays:
+            self.arrays[name] = numpy.load(os.path.join(self.directory, f"{name}.npy"), mmap_mode="r")
+        return self.arrays[name]
+
+    def fids(self):
+        """
+        地物ID（昇順）
+        """
+        return self.loadArray("fids")
+
+    def column(self, field_name: str):
+        """
+        列の値とNULLの配列を取得する
+
+        @return (値, NULL)
+        """
+        file = self.manifest["fields"][field_name]["file"]
+        return (self.loadArray(f"{file}.values"), self.loadArray(f"{file}.null"))
+
+    def dictionary(self, field_name: str) -> list:
+        """
+        文字列の辞書（昇順）を取得する
+        """
+        if field_name not in self.dictionaries:
+            file = self.manifest["fields"][field_name]["file"]
+            with open(os.path.join(self.directory, f"{file}.dict.json"), encoding="utf-8") as dictionary_file:
+                self.dictionaries[field_name] = json.load(dictionary_file)
+        return self.dictionaries[field_name]
+
+
+class EasyAttributeFilterColumnBuildTask(QgsTask):
+    """
+    列データのディスクキャッシュの作成タスク
+
+    対応する型の全フィールドを1回の読み込みで書き出す。
+    """
+
+    def __init__(self, store: EasyAttributeFilterColumnStore):
+        super(EasyAttributeFilterColumnBuildTask, self).__init__(f"列キャッシュの作成：{store.layer.name()}", QgsTask.CanCancel)
+
+        self.store = store
+        fields = store.layer.fields()
+        self.columns = [(field_index, field.name(), COLUMN_KINDS[field.type()])
+                        for field_index, field in enumerate(fields)
+                        if field.type() in COLUMN_KINDS and fields.fieldOrigin(field_index) == QgsFields.OriginProvider]
+        self.total = store.layer.featureCount()
+
+        # 作成中にデータソースが変更された場合は別のキャッシュとなるよう、開始時点のディレクトリを記録する
+        self.directory = store.stampDirectory()
+        self.source = QgsVectorLayerFeatureSource(store.layer)
+
+    def run(self) -> bool:
+        if self.directory is None:
+            return False
+
+        work_dir = f"{self.directory}.{os.getpid()}.tmp"
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([field_index for field_index, _, _ in self.columns])
+
+        fid_writer = ColumnWriter(work_dir, "fids", "int")
+        writers = {field_index: ColumnWriter(work_dir, f"c{field_index}", kind) for field_index, _, kind in self.columns}
+        completed = False
+        try:
+            count = 0
+            for feature in self.source.getFeatures(request):
+                if self.isCanceled():
+                    raise InterruptedError()
+
+                fid_writer.append(feature.id())
+                attributes = feature.attributes()
+                for field_index, writer in list(writers.items()):
+                    try:
+                        writer.append(toColumnValue(writer.kind, attributes[field_index]))
+                    except (ValueError, TypeError, OverflowError):
+                        # 変換できない値がある列はキャッシュしない
+                        writer.discard()
+                        del writers[field_index]
+
+                count += 1
+                if count % 10000 == 0 and self.total > 0:
+                    self.setProgress(100.0 * count / self.total)
+
+            fid_writer.flush()
+            fid_writer.close()
+            fids = numpy.fromfile(os.path.join(work_dir, "fids.values.raw"), dtype=numpy.int64)
+            order = None
+            if len(fids) > 1 and not numpy.all(fids[1:] > fids[:-1]):
+                order = numpy.argsort(fids, kind="stable")
+                fids = fids[order]
+            numpy.save(os.path.join(work_dir, "fids.npy"), fids)
+            os.remove(os.path.join(work_dir, "fids.values.raw"))
+            os.remove(os.path.join(work_dir, "fids.null.raw"))
+
+            names = {field_index: name for field_index, name, _ in self.columns}
+            fields_info = dict()
+            for field_index, writer in writers.items():
+                if self.isCanceled():
+                    raise InterruptedError()
+                fields_info[names[field_index]] = writer.finish(order)
+
+            with open(os.path.join(work_dir, MANIFEST_FILE), "w", encoding="utf-8") as file:
+                json.dump({"version": STORE_VERSION, "row_count": int(len(fids)), "fields": fields_info}, file, ensure_ascii=False)
+
+            if os.path.exists(self.directory):
+                # 他のQGISで作成済み
+                shutil.rmtree(work_dir, ignore_errors=True)
+            else:
+                os.replace(work_dir, self.directory)
+            completed = True
+        except (InterruptedError, OSError):
+            return False
+        finally:
+            if not completed:
+                # 開いたままのファイルがあるとWindowsでは作業ディレクトリを削除できない
+                for writer in [fid_writer] + list(writers.values()):
+                    writer.close()
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+        self.store.removeOutdated(self.directory)
+        return True
@@ -0,0 +1,446 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterCompactTable
+                                 A QGIS plugin
+ 読み込んだレイヤの属性値のコンパクトな保持
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+ 属性値を地物ごとのQVariantではなく列ごとの型付き配列でメモリに保持する。
+ 文字列は昇順の辞書の符号（固有値の数に応じて8/16/32ビット）、整数は値の範囲に応じて
+ 32/64ビット、NULLはビット列とする。固有値・並び替え・フィルターはこの配列で求め、
+ 文字列のINの判定は符号の比較となる。
+ 未コミットの編集を含めて読み込むため、属性値の編集は配列に反映し、地物の追加・削除時は作り直す。
+ numpyが使用できない環境では使用しない。
+"""
+import sys
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from qgis.PyQt.QtCore import QObject, QTimer, pyqtSignal
+from qgis.core import QgsApplication, QgsTask, QgsFeatureRequest, QgsFields, QgsVectorLayer, QgsVectorLayerFeatureSource
+
+from .easy_attribute_filter_columnar import ColumnarSource, COLUMN_KINDS, toColumnValue, isNumpyAvailable
+
+# 編集後に作り直すまでの待ち時間（ミリ秒）
+REBUILD_DELAY = 1000
+# 配列に反映していない属性値の変更の上限（超える場合は作り直す）
+PENDING_CHANGE_LIMIT = 10000
+# 列の種類：読み込み中の値の配列の型
+BUFFER_TYPECODES = {"int": "q", "double": "d", "string": "i", "date": "i", "datetime": "q"}
+
+
+def compactCodes(codes):
+    """
+    文字列の符号を固有値の数に応じた最小の型に変換する（NULLの-1を含む）
+    """
+    for dtype in (numpy.int8, numpy.int16, numpy.int32):
+        if len(codes) == 0 or codes.max() <= numpy.iinfo(dtype).max:
+            return codes.astype(dtype)
+    return codes
+
+
+def compactIntegers(values):
+    """
+    整数を値の範囲に応じて32ビットに変換する
+    """
+    info = numpy.iinfo(numpy.int32)
+    if len(values) == 0 or (values.min() >= info.min and values.max() <= info.max):
+        return values.astype(numpy.int32)
+    return values
+
+
+def updateCodes(codes, dictionary: list, rows, texts: list):
+    """
+    文字列の符号の一部を変更する
+
+    新しい値を辞書に加え、使われなくなった値を辞書から除いて、符号の大小が値の大小と一致するよう振り直す。
+
+    @param  codes:符号の配列
+    @param  dictionary:辞書（昇順）
+    @param  rows:変更する行の配列
+    @param  texts:変更後の値のリスト（NULLはNone）
+    @return (符号の配列, 辞書)
+    """
+    known = set(dictionary)
+    merged = sorted(dictionary + list({text for text in texts if text is not None and text not in known}))
+    index = {text: code for code, text in enumerate(merged)}
+
+    # NULL（-1）は末尾の要素で-1のまま残す
+    remap = numpy.array([index[text] for text in dictionary] + [-1], dtype=numpy.int64)
+    codes = remap[codes]
+    codes[rows] = [index[text] if text is not None else -1 for text in texts]
+
+    used = numpy.bincount(codes[codes >= 0], minlength=len(merged)) > 0
+    if not used.all():
+        kept = numpy.flatnonzero(used)
+        remap = numpy.full(len(merged) + 1, -1, dtype=numpy.int64)
+        remap[kept] = numpy.arange(len(kept), dtype=numpy.int64)
+        codes = remap[codes]
+        merged = [merged[code] for code in kept]
+    return (compactCodes(codes), merged)
+
+
+class CompactColumnBuilder:
+    """
+    1列分の値を型付きの配列に追記する
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.values = array(BUFFER_TYPECODES[kind])
+        self.nulls = bytearray()
+        # 文字列の辞書 {値: 仮の符号}
+        self.dictionary = dict()
+
+    def append(self, value):
+        """
+        値を追加する
+
+        @param  value:列の値（NULLはNone）
+        """
+        if value is None:
+            self.values.append(-1 if self.kind == "string" else 0)
+            self.nulls.append(1)
+            return
+        if self.kind == "string":
+            value = self.dictionary.setdefault(value, len(self.dictionary))
+        self.values.append(value)
+        self.nulls.append(0)
+
+    def finish(self, order):
+        """
+        配列に変換する
+
+        文字列は辞書を昇順に並べ、符号の大小が値の大小と一致するよう振り直す。
+
+        @param  order:地物IDの昇順に並べ替える行の順序（並べ替えが不要な場合はNone）
+        @return (値の配列, NULLのビット列, 辞書（文字列以外はNone）)
+        """
+        values = numpy.frombuffer(self.values, dtype=numpy.dtype(self.values.typecode)).copy()
+        nulls = numpy.frombuffer(bytes(self.nulls), dtype=numpy.bool_)
+        self.values = None
+        self.nulls = None
+
+        dictionary = None
+        if self.kind == "string":
+            texts = list(self.dictionary.keys())
+            sorted_codes = sorted(range(len(texts)), key=texts.__getitem__)
+            remap = numpy.empty(len(texts) + 1, dtype=numpy.int64)
+            remap[numpy.array(sorted_codes, dtype=numpy.int64)] = numpy.arange(len(texts), dtype=numpy.int64)
+            # NULL（-1）は末尾の要素で-1のまま残す
+            remap[-1] = -1
+            values = compactCodes(remap[values])
+            dictionary = [texts[code] for code in sorted_codes]
+            self.dictionary = None
+        elif self.kind == "int":
+            values = compactIntegers(values)
+        elif self.kind == "date":
+            values = values.astype(numpy.int32)
+
+        if order is not None:
+            values = values[order]
+            nulls = nulls[order]
+        return (values, numpy.packbits(nulls), dictionary)
+
+
+class EasyAttributeFilterCompactBuildTask(QgsTask):
+    """
+    レイヤの属性値を型付きの配列に読み込むタスク
+    """
+
+    def __init__(self, layer: QgsVectorLayer):
+        super(EasyAttributeFilterCompactBuildTask, self).__init__(f"属性値の読み込み：{layer.name()}", QgsTask.CanCancel)
+
+        fields = layer.fields()
+        # 式によるフィールドは対象外とする
+        self.columns = [(field_index, field.name(), COLUMN_KINDS[field.type()])
+                        for field_index, field in enumerate(fields)
+                        if field.type() in COLUMN_KINDS and fields.fieldOrigin(field_index) != QgsFields.OriginExpression]
+        self.total = layer.featureCount()
+        self.source = QgsVectorLayerFeatureSource(layer)
+
+        # 読み込み結果
+        self.fids = None
+        self.row_count = 0
+        # {フィールド名: (列の種類, 値の配列, NULLのビット列, 辞書)}
+        self.columns_data = dict()
+
+    def run(self) -> bool:
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([field_index for field_index, _, _ in self.columns])
+
+        fids = array("q")
+        builders = {field_index: CompactColumnBuilder(kind) for field_index, _, kind in self.columns}
+        for feature in self.source.getFeatures(request):
+            if self.isCanceled():
+                return False
+
+            fids.append(feature.id())
+            attributes = feature.attributes()
+            for field_index, builder in list(builders.items()):
+                try:
+                    builder.append(toColumnValue(builder.kind, attributes[field_index]))
+                except (ValueError, TypeError, OverflowError):
+                    # 変換できない値がある列は保持しない
+                    del builders[field_index]
+
+            if len(fids) % 10000 == 0 and self.total > 0:
+                self.setProgress(100.0 * len(fids) / self.total)
+
+        fid_values = numpy.frombuffer(fids, dtype=numpy.int64).copy()
+        order = None
+        if len(fid_values) > 1 and not numpy.all(fid_values[1:] > fid_values[:-1]):
+            order = numpy.argsort(fid_values, kind="stable")
+            fid_values = fid_values[order]
+
+        names = {field_index: name for field_index, name, _ in self.columns}
+        for field_index, builder in builders.items():
+            if self.isCanceled():
+                return False
+            values, null_bits, dictionary = builder.finish(order)
+            self.columns_data[names[field_index]] = (builder.kind, values, null_bits, dictionary)
+
+        self.fids = fid_values
+        self.row_count = len(fid_values)
+        return True
+
+
+class EasyAttributeFilterCompactTable(QObject, ColumnarSource):
+    """
+    読み込んだレイヤの属性値を列ごとの型付き配列で保持する
+
+    作成後は固有値・並び替え・フィルターの列データの取得元として使用する。
+    """
+
+    # 作成・作り直しが終わり、使用できるようになった
+    ready = pyqtSignal()
+
+    def __init__(self, layer: QgsVectorLayer, parent=None):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        """
+        super(EasyAttributeFilterCompactTable, self).__init__(parent)
+        self.layer = layer
+
+        self.fid_array = None
+        self.row_count = 0
+        # {フィールド名: (列の種類, 値の配列, NULLのビット列, 辞書)}
+        self.columns = dict()
+        # NULLの配列（ビット列から展開したもの）は直近の1列のみ保持する
+        self.null_cache = (None, None)
+
+        # 編集で内容が古くなったか
+        self.stale = True
+        # 配列に反映していない属性値の変更 [(地物ID, フィールドindex, 値)]
+        self.pending_changes = []
+        # 作成中に編集された場合は結果を使わない
+        self.generation = 0
+        self.build_task = None
+
+        self.rebuild_timer = QTimer(self)
+        self.rebuild_timer.setSingleShot(True)
+        self.rebuild_timer.setInterval(REBUILD_DELAY)
+        self.rebuild_timer.timeout.connect(self.build)
+
+    @staticmethod
+    def isSupported(layer: QgsVectorLayer) -> bool:
+        return isNumpyAvailable() and layer is not None
+
+    def isUsable(self) -> bool:
+        if self.stale or self.fid_array is None:
+            return False
+        if len(self.pending_changes) > 0:
+            self.applyChanges()
+        return not self.stale
+
+    def build(self):
+        """
+        属性値をバックグラウンドで読み込む
+        """
+        if self.build_task is not None:
+            self.build_task.cancel()
+
+        task = EasyAttributeFilterCompactBuildTask(self.layer)
+        generation = self.generation
+        task.taskCompleted.connect(lambda: self.onBuildCompleted(task, generation))
+        task.taskTerminated.connect(lambda: self.onBuildTerminated(task))
+        self.build_task = task
+        QgsApplication.taskManager().addTask(task)
+
+    def cancelBuild(self):
+        self.rebuild_timer.stop()
+        if self.build_task is not None:
+            self.build_task.cancel()
+            self.build_task = None
+
+    def onBuildCompleted(self, task: EasyAttributeFilterCompactBuildTask, generation: int):
+        if self.build_task is task:
+            self.build_task = None
+        if generation != self.generation:
+            return
+
+        self.fid_array = task.fids
+        self.row_count = task.row_count
+        self.columns = task.columns_data
+        self.null_cache = (None, None)
+        self.pending_changes = []
+        self.stale = False
+        self.ready.emit()
+
+    def onBuildTerminated(self, task: EasyAttributeFilterCompactBuildTask):
+        if self.build_task is task:
+            self.build_task = None
+
+    def invalidate(self, *args):
+        """
+        内容が古くなったため、少し待ってから作り直す
+        """
+        self.stale = True
+        self.pending_changes = []
+        self.generation += 1
+        if self.build_task is not None:
+            self.build_task.cancel()
+            self.build_task = None
+        self.rebuild_timer.start()
+
+    def onAttributeValueChanged(self, fid: int, field_index: int, value):
+        """
+        変更された属性値を保持し、次に使用する際に配列へ反映する
+
+        一括で編集された場合など、変更が多い場合は作り直す。
+        """
+        if self.stale or len(self.pending_changes) >= PENDING_CHANGE_LIMIT:
+            # 作成中の結果には変更が含まれない場合がある
+            self.invalidate()
+            return
+        self.pending_changes.append((fid, field_index, value))
+
+    def applyChanges(self):
+        """
+        保持している属性値の変更を配列に反映する
+
+        配列は作成済みの結果を参照している処理があるため、書き換えずに複製する。
+        """
+        changes = self.pending_changes
+        self.pending_changes = []
+
+        fields = self.layer.fields()
+        # {フィールド名: {行: 値}}
+        column_changes = dict()
+        for fid, field_index, value in changes:
+            if field_index < 0 or field_index >= fields.count() or fields.at(field_index).name() not in self.columns:
+                continue
+            row = int(numpy.searchsorted(self.fid_array, fid))
+            if row >= self.row_count or self.fid_array[row] != fid:
+                # 保持していない地物
+                self.invalidate()
+                return
+            column_changes.setdefault(fields.at(field_index).name(), dict())[row] = value
+
+        for field_name, row_values in column_changes.items():
+            kind = self.columns[field_name][0]
+            try:
+                converted = [toColumnValue(kind, value) for value in row_values.values()]
+            except (ValueError, TypeError, OverflowError):
+                self.invalidate()
+                return
+            self.updateColumn(field_name, numpy.fromiter(row_values.keys(), dtype=numpy.int64, count=len(row_values)), converted)
+        self.null_cache = (None, None)
+
+    def updateColumn(self, field_name: str, rows, new_values: list):
+        """
+        列の一部の行の値を変更する
+
+        @param  field_name:フィールド名
+        @param  rows:変更する行の配列
+        @param  new_values:変更後の列の値のリスト（NULLはNone）
+        """
+        kind, values, null_bits, dictionary = self.columns[field_name]
+
+        nulls = numpy.unpackbits(null_bits, count=self.row_count).view(numpy.bool_)
+        nulls[rows] = [value is None for value in new_values]
+
+        if kind == "string":
+            values, dictionary = updateCodes(values, dictionary, rows, new_values)
+        else:
+            filled = [0 if value is None else value for value in new_values]
+            if kind == "int" and values.dtype != numpy.int64:
+                info = numpy.iinfo(values.dtype)
+                if min(filled) < info.min or max(filled) > info.max:
+                    values = values.astype(numpy.int64)
+            values = values.copy()
+            values[rows] = filled
+
+        self.columns[field_name] = (kind, values, numpy.packbits(nulls), dictionary)
+
+    def invalidateSignals(self) -> list:
+        """
+        作り直すシグナル
+        """
+        return [self.layer.featureAdded, self.layer.featureDeleted,
+                self.layer.subsetStringChanged, self.layer.dataSourceChanged, self.layer.updatedFields,
+                self.layer.afterRollBack]
+
+    def connectLayer(self):
+        """
+        データ変更時に反映する、または作り直すよう接続する
+        """
+        self.layer.attributeValueChanged.connect(self.onAttributeValueChanged)
+        for signal in self.invalidateSignals():
+            signal.connect(self.invalidate)
+
+    def disconnectLayer(self):
+        """
+        接続を解除する
+        """
+        self.cancelBuild()
+        self.layer.attributeValueChanged.disconnect(self.onAttributeValueChanged)
+        for signal in self.invalidateSignals():
+            signal.disconnect(self.invalidate)
+
+    def memoryBytes(self) -> int:
+        """
+        保持している配列と辞書のメモリ使用量（概算）
+        """
+        if self.fid_array is None:
+            return 0
+        total = self.fid_array.nbytes
+        for _, values, null_bits, dictionary in self.columns.values():
+            total += values.nbytes + null_bits.nbytes
+            if dictionary is not None:
+                total += sum(sys.getsizeof(text) for text in dictionary) + 8 * len(dictionary)
+        return total
+
+    def fieldKind(self, field_name: str) -> str:
+        if not self.isUsable():
+            return None
+        column = self.columns.get(field_name)
+        if column is None:
+            return None
+        field_index = self.layer.fields().indexOf(field_name)
+        if field_index < 0 or COLUMN_KINDS.get(self.layer.fields().at(field_index).type()) != column[0]:
+            return None
+        return column[0]
+
+    def fids(self):
+        return self.fid_array
+
+    def column(self, field_name: str):
+        _, values, null_bits, _ = self.columns[field_name]
+        cached_name, nulls = self.null_cache
+        if cached_name != field_name:
+            nulls = numpy.unpackbits(null_bits, count=self.row_count).view(numpy.bool_)
+            self.null_cache = (field_name, nulls)
+        return (values, nulls)
+
+    def dictionary(self, field_name: str) -> list:
+        return self.columns[field_name][3]
@@ -0,0 +1,241 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterValueCompleter
+                                 A QGIS plugin
+ 入力中の文字列に前方一致する値の補完
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+"""
+from collections import OrderedDict
+
+from qgis.PyQt.QtCore import Qt, QTimer, QStringListModel
+from qgis.PyQt.QtWidgets import QCompleter, QComboBox
+from qgis.core import (QgsApplication, QgsTask, QgsFeatureRequest, QgsVectorLayer, QgsVectorLayerFeatureSource,
+                       QgsExpression)
+
+from .easy_attribute_filter_column_cache import isNullValue
+from .easy_attribute_filter_columnar import prefixMatches
+from .easy_attribute_filter_sql import EasyAttributeFilterSqlBackend
+
+# 補完候補の上限件数
+COMPLETION_LIMIT = 100
+# 前方一致の結果を保持する件数
+COMPLETION_CACHE_SIZE = 32
+
+
+class EasyAttributeFilterPrefixTask(QgsTask):
+    """
+    前方一致する固有値を取得するタスク
+
+    列データの取得元（ディスクキャッシュまたはSQL）で求められる場合はそれを使う。
+    SQLはこのタスクのスレッドで接続して実行する。
+    求められない場合はLIKEのフィルター式を地物リクエストに設定し、式をコンパイルできるプロバイダでは
+    プロバイダ側で抽出させる。上限件数の固有値が集まった時点で読み込みをやめる。
+    """
+
+    def __init__(self, layer: QgsVectorLayer, field_index: int, prefix: str, limit: int, column_store=None):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        @param  field_index:フィールドindex
+        @param  prefix:前方一致させる文字列
+        @param  limit:上限件数
+        @param  column_store:列データの取得元（ディスクキャッシュまたはSQL）
+        """
+        super(EasyAttributeFilterPrefixTask, self).__init__(f"値の補完：{layer.name()}", QgsTask.CanCancel)
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.field_index = field_index
+        self.field = layer.fields().at(field_index)
+        self.prefix = prefix
+        self.limit = limit
+
+        # 使用できるかの判定とSQLの作成はメインスレッドで行い、読み込みのみこのタスクで行う
+        self.column_store = None
+        self.sql_backend = None
+        self.sql_query = None
+        if isinstance(column_store, EasyAttributeFilterSqlBackend):
+            self.sql_backend = column_store
+            self.sql_query = column_store.prefixQuery(self.field.name(), prefix, limit)
+        elif column_store is not None and column_store.fieldKind(self.field.name()) == "string":
+            self.column_store = column_store
+
+        # 前方一致した固有値（昇順）
+        self.values = []
+
+    def run(self) -> bool:
+        values = self.storeValues()
+        if values is not None:
+            self.values = values
+            return not self.isCanceled()
+        return self.providerValues()
+
+    def storeValues(self):
+        """
+        列データの取得元から前方一致する固有値を取得する
+
+        @return 固有値の昇順のリスト（求められない場合はNone）
+        """
+        if self.sql_query is not None:
+            rows = self.sql_backend.execute(*self.sql_query)
+            return [row[0] for row in rows] if rows is not None else None
+        if self.column_store is not None:
+            return prefixMatches(self.column_store.dictionary(self.field.name()), self.prefix, self.limit)
+        return None
+
+    def providerValues(self) -> bool:
+        """
+        プロバイダから前方一致する固有値を取得する
+        """
+        column = QgsExpression.quotedColumnRef(self.field.name())
+        if self.field.isNumeric():
+            column = f"to_string({column})"
+        # LIKEの特殊文字を含む場合は広めに抽出し、下で前方一致を確認する
+        pattern = self.prefix.replace("%", "_") + "%"
+
+        request = QgsFeatureRequest()
+        request.setFilterExpression(f"{column} LIKE {QgsExpression.quotedString(pattern)}")
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.field_index])
+
+        values = set()
+        for feature in self.source.getFeatures(request):
+            if self.isCanceled():
+                return False
+
+            value = feature.attribute(self.field_index)
+            if isNullValue(value):
+                continue
+            text = str(value)
+            if text.startswith(self.prefix):
+                values.add(text)
+                if len(values) >= self.limit:
+                    break
+
+        self.values = sorted(values)
+        return True
+
+
+class EasyAttributeFilterValueCompleter(QCompleter):
+    """
+    判定値コンボボックスの入力中の文字列に前方一致する値を補完する
+
+    列データの取得元（ディスクキャッシュまたはSQL）、プロバイダの順にバックグラウンドで取得する。
+    取得した結果は前方一致させた文字列ごとに保持し、同じ入力や続けて入力した場合に使う。
+    """
+
+    def __init__(self, layer: QgsVectorLayer, field_index: int, column_store=None, parent=None):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        @param  field_index:フィールドindex
+        @param  column_store:列データの取得元（ディスクキャッシュまたはSQL）
+        """
+        super(EasyAttributeFilterValueCompleter, self).__init__(parent)
+        self.layer = layer
+        self.field_index = field_index
+        self.column_store = column_store
+
+        self.value_model = QStringListModel(self)
+        self.setModel(self.value_model)
+        self.setCaseSensitivity(Qt.CaseSensitive)
+        self.setCompletionMode(QCompleter.PopupCompletion)
+
+        # {前方一致させた文字列: 固有値のリスト}
+        self.cache = OrderedDict()
+        self.prefix = ""
+        self.task = None
+
+        # 入力が止まってから取得する
+        self.request_timer = QTimer(self)
+        self.request_timer.setSingleShot(True)
+        self.request_timer.setInterval(200)
+        self.request_timer.timeout.connect(self.requestValues)
+
+    def attach(self, combobox: QComboBox):
+        """
+        コンボボックスに補完を設定する
+        """
+        combobox.setCompleter(self)
+        combobox.lineEdit().textEdited.connect(self.onTextEdited)
+
+    def onTextEdited(self, text: str):
+        self.prefix = text
+        self.request_timer.start()
+
+    def cachedValues(self, prefix: str):
+        """
+        保持している結果から前方一致する値を取得する
+
+        短い文字列での結果が上限件数未満の場合は、それを絞り込んで使う。
+
+        @return 固有値のリスト（保持していない場合はNone）
+        """
+        if prefix in self.cache:
+            self.cache.move_to_end(prefix)
+            return self.cache[prefix]
+
+        for length in range(len(prefix) - 1, -1, -1):
+            values = self.cache.get(prefix[0:length])
+            if values is not None and len(values) < COMPLETION_LIMIT:
+                return [value for value in values if value.startswith(prefix)]
+        return None
+
+    def storeValues(self, prefix: str, values: list):
+        self.cache[prefix] = values
+        self.cache.move_to_end(prefix)
+        while len(self.cache) > COMPLETION_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def requestValues(self):
+        """
+        入力中の文字列に前方一致する値を取得する
+        """
+        self.cancel()
+        prefix = self.prefix
+        if len(prefix) == 0:
+            return
+
+        values = self.cachedValues(prefix)
+        if values is not None:
+            self.showValues(prefix, values)
+            return
+
+        # SQLやキャッシュの読み込みも入力のたびにメインスレッドで行わない
+        task = EasyAttributeFilterPrefixTask(self.layer, self.field_index, prefix, COMPLETION_LIMIT, self.column_store)
+        task.taskCompleted.connect(lambda: self.onTaskCompleted(task))
+        task.taskTerminated.connect(lambda: self.onTaskTerminated(task))
+        self.task = task
+        QgsApplication.taskManager().addTask(task)
+
+    def cancel(self):
+        """
+        取得中の要求を中止する
+        """
+        self.request_timer.stop()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def onTaskCompleted(self, task: EasyAttributeFilterPrefixTask):
+        self.storeValues(task.prefix, task.values)
+        if self.task is task:
+            self.task = None
+            self.showValues(task.prefix, task.values)
+
+    def onTaskTerminated(self, task: EasyAttributeFilterPrefixTask):
+        if self.task is task:
+            self.task = None
+
+    def showValues(self, prefix: str, values: list):
+        """
+        補完候補を表示する（入力が変わっている場合は表示しない）
+        """
+        if prefix != self.prefix or self.widget() is None or not self.widget().hasFocus():
+            return
+        self.value_model.setStringList(values)
+        self.setCompletionPrefix(prefix)
+        self.complete()
@@ -12,9 +12,9 @@
 
 import os
 
-from qgis.PyQt import uic
-from qgis.PyQt.QtWidgets import QDialog, QMenu, QAction, QWidgetAction
-from qgis.PyQt.QtCore import pyqtSignal, Qt, QPoint
+from qgis.PyQt import uic, sip
+from qgis.PyQt.QtWidgets import QDialog, QMenu, QAction, QWidgetAction, QFileDialog
+from qgis.PyQt.QtCore import pyqtSignal, Qt, QPoint, QVariant, QTimer
 from qgis.PyQt.QtGui import QCursor, QColor
 
 from qgis.core import *
@@ -22,10 +22,37 @@ from qgis.gui import *
 
 from .easy_attribute_filter_values import EasyAttributeFilterValues
 from .easy_attribute_filter_option_dialog import EasyAttributeFilterOptionDialog
+from .easy_attribute_filter_export import EasyAttributeFilterExportTask, EXPORT_FORMATS
+from .easy_attribute_filter_fts import EasyAttributeFilterFtsIndex
+from .easy_attribute_filter_column_cache import EasyAttributeFilterColumnCache, isNullValue
+from .easy_attribute_filter_columnar import EasyAttributeFilterColumnStore
+from .easy_attribute_filter_compact import EasyAttributeFilterCompactTable
+from .easy_attribute_filter_virtual import EasyAttributeFilterVirtualColumns
+from .easy_attribute_filter_sql import EasyAttributeFilterSqlBackend
+from .easy_attribute_filter_table_model import EasyAttributeFilterTableFilterModel
+from .easy_attribute_filter_match import EasyAttributeFilterMatchTask, EasyAttributeFilterMatchEstimator
+from .easy_attribute_filter_planner import (EasyAttributeFilterPlanner, ENGINE_NAMES, LOAD_PREVIEW, FILTER_INDEX,
+                                            FILTER_COLUMNAR, FILTER_SQL, FILTER_PUSHDOWN, FILTER_MEMORY, FILTER_MATERIALIZED,
+                                            logPlan)
+from .easy_attribute_filter_predicate import parsePredicate, ValueSetPredicate
+from .easy_attribute_filter_state import storeFilters, loadFilters, storeResult, loadResult, resultPath
+from .easy_attribute_filter_relation import (EasyAttributeFilterRelationDialog, EasyAttributeFilterSemiJoinTask, parentRelations,
+                                             semiJoinExpression, parseSemiJoinExpression, semi_join_keys)
+from .easy_attribute_filter_multi_layer import EasyAttributeFilterMultiLayerDialog
+from .easy_attribute_filter_cache_stats import EasyAttributeFilterCacheStats, PHASE_SCROLL, PHASE_FILTER
 
 FORM_CLASS, _ = uic.loadUiType(os.path.join(
     os.path.dirname(__file__), 'easy_attribute_filter_dialog_base.ui'))
 
+# プレビュー表示を行う地物数（これを超えるレイヤが対象）
+PREVIEW_FEATURE_COUNT = 100000
+# プレビュー表示する地物数
+PREVIEW_ROW_COUNT = 1000
+# レイヤキャッシュのメモリ上限（MB）の既定値
+DEFAULT_CACHE_MEMORY_MB = 256
+# コンパクト表示時のレイヤキャッシュの上限行数（表示中の行のみ保持する）
+COMPACT_CACHE_ROWS = 10000
+
 class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
 
     closed = pyqtSignal()
@@ -48,18 +75,48 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
         # テーブルヘッダに独自のコンテキストメニューを表示する
         self.table_view.horizontalHeader().setContextMenuPolicy(Qt.CustomContextMenu)
         self.table_view.horizontalHeader().customContextMenuRequested.connect(self.showHeaderContextMenu)
+        # スクロールで表示する行がレイヤキャッシュにあるかを数える
+        self.table_view.verticalScrollBar().valueChanged.connect(self.recordVisibleRows)
 
         # connect設定
         # レイヤー変更
         self.vectorlayer_combobox.layerChanged.connect(self.updateTableData)
         # フィルタークリアボタン
         self.filter_clear_button.clicked.connect(self.clearAllFilters)
+        # 複数レイヤに適用
+        self.multi_layer_button.clicked.connect(self.showMultiLayerDialog)
+        # 地図表示にもフィルターを適用
+        self.render_filter_checkbox.toggled.connect(self.updateRenderFilter)
+        # 大規模レイヤはプレビューから表示
+        self.preview_checkbox.setChecked(QgsSettings().value("easy_attribute_filter/preview", True, type=bool))
+        self.preview_checkbox.toggled.connect(lambda checked: QgsSettings().setValue("easy_attribute_filter/preview", checked))
+        self.preview_label.setVisible(False)
+        # ディスクキャッシュを使用
+        self.column_store_checkbox.setChecked(QgsSettings().value("easy_attribute_filter/column_store", False, type=bool))
+        self.column_store_checkbox.toggled.connect(self.toggleColumnStore)
+        # コンパクト表示
+        self.compact_checkbox.setChecked(QgsSettings().value("easy_attribute_filter/compact", False, type=bool))
+        self.compact_checkbox.toggled.connect(self.toggleCompactTable)
         # 地図表示
         self.zoom_features_button.clicked.connect(self.zoomToFeature)
+        # フィルター結果を選択
+        self.select_menu = QMenu(self)
+        for text, behavior in (("選択を置き換える", QgsVectorLayer.SetSelection),
+                               ("選択に追加", QgsVectorLayer.AddToSelection),
+                               ("選択との共通部分", QgsVectorLayer.IntersectSelection),
+                               ("選択から除く", QgsVectorLayer.RemoveFromSelection)):
+            action = self.select_menu.addAction(text)
+            action.triggered.connect(lambda checked=False, behavior=behavior: self.selectFilteredFeatures(behavior))
+        self.select_features_button.setMenu(self.select_menu)
+        self.select_features_button.clicked.connect(lambda: self.selectFilteredFeatures(QgsVectorLayer.SetSelection))
+        # エクスポート
+        self.export_button.clicked.connect(self.exportFeatures)
         # 閉じるボタン
         self.close_button.clicked.connect(lambda: self.close())
         # プロジェクト変更
         QgsProject.instance().homePathChanged.connect(lambda: self.close())
+        # プロジェクトの保存時にフィルターを保存し、地図表示のフィルターは保存しない
+        QgsProject.instance().writeMapLayer.connect(self.onWriteMapLayer)
 
         # コンテキストメニュー
         self.menu = QMenu(self)
@@ -71,10 +128,26 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
         self.action_sort_descending.triggered.connect(lambda: self.sort(False))
         self.menu.addAction(self.action_sort_descending)
 
+        self.action_sort_add_ascending = QAction("昇順で並び替えを追加", self)
+        self.action_sort_add_ascending.triggered.connect(lambda: self.addSort(True))
+        self.menu.addAction(self.action_sort_add_ascending)
+
+        self.action_sort_add_descending = QAction("降順で並び替えを追加", self)
+        self.action_sort_add_descending.triggered.connect(lambda: self.addSort(False))
+        self.menu.addAction(self.action_sort_add_descending)
+
         self.action_option_filter = QAction("テキストフィルター", self)
         self.action_option_filter.triggered.connect(self.showOptionFilterDialog)
         self.menu.addAction(self.action_option_filter)
 
+        self.action_relation_filter = QAction("関連レイヤの条件でフィルター", self)
+        self.action_relation_filter.triggered.connect(self.showRelationFilterDialog)
+        self.menu.addAction(self.action_relation_filter)
+
+        self.action_fts_index = QAction("全文索引を作成", self)
+        self.action_fts_index.triggered.connect(self.toggleFtsIndex)
+        self.menu.addAction(self.action_fts_index)
+
         self.action_clear_filter = QAction("フィルタ クリア", self)
         self.action_clear_filter.triggered.connect(self.clearFieldFilter)
         self.menu.addAction(self.action_clear_filter)
@@ -90,18 +163,107 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
 
         # 変数初期化
         self.field_filters = dict()
+        # フィルター結果の保存先
+        self.result_path = None
         self.column_target = -1
         self.layer = None
         self.filter_model = None
         self.master_model = None
         self.layer_cache = None
+        self.original_renderer = None
+        self.render_filter = None
+        self.setting_renderer = False
+        self.export_task = None
+        self.multi_layer_dialog = None
+        # 関連レイヤの条件でのフィルター {列番号: (リレーションID, 子レイヤの条件, 外部キーの集合)}
+        self.semi_joins = dict()
+        self.semi_join_tasks = dict()
+        self.fts_index = None
+        self.column_cache = None
+        self.column_store = None
+        self.sql_backend = None
+        self.compact_table = None
+        self.virtual_columns = None
+
+        # 読み込みと抽出の方式
+        self.planner = None
+        self.load_plan = None
+        self.filter_plan = None
+        self.logged_plan = ""
+
+        # レイヤキャッシュの行数と行の読み込みの統計
+        self.cache_size = 0
+        self.cache_stats = None
+        self.cache_stats_timer = QTimer(self)
+        self.cache_stats_timer.setSingleShot(True)
+        self.cache_stats_timer.setInterval(500)
+        self.cache_stats_timer.timeout.connect(self.updateCacheLabel)
+
+        # プレビュー表示（標本の表示中は正確な結果をバックグラウンドで求める）
+        self.is_preview = False
+        self.preview_text = ""
+        self.exact_task = None
+        self.exact_generation = 0
+
+        # フィルター結果（編集時は変更のあった地物のみ再判定する）
+        self.filtered_fids = None
+        self.filter_expression = None
+        self.filter_context = None
+        self.pending_filter_fids = set()
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.timeout.connect(self.retestPendingFeatures)
 
 
     def clear(self):
         """
         クリア
         """        
+        if self.layer is not None and not sip.isdeleted(self.layer):
+            self.saveFilterState(True)
+        self.restoreRenderer()
+        self.cancelExactFilter()
+        self.cancelSemiJoin()
+        self.is_preview = False
+        self.preview_label.setVisible(False)
+        if self.layer is not None and not sip.isdeleted(self.layer):
+            self.disconnectLayerSignals()
+        self.resetFilterResult()
+        if self.fts_index is not None:
+            if not sip.isdeleted(self.layer):
+                self.fts_index.disconnectLayer()
+            self.fts_index = None
+        if self.column_cache is not None:
+            self.column_cache.cancelPrefetch()
+            if not sip.isdeleted(self.layer):
+                self.column_cache.disconnectLayer()
+            self.column_cache = None
+        if self.compact_table is not None:
+            if not sip.isdeleted(self.layer):
+                self.compact_table.disconnectLayer()
+            else:
+                self.compact_table.cancelBuild()
+            self.compact_table = None
+        if self.virtual_columns is not None:
+            if not sip.isdeleted(self.layer):
+                self.virtual_columns.disconnectLayer()
+            self.virtual_columns = None
+        # 作成中のディスクキャッシュは次回以降に使えるよう中止しない
+        self.column_store = None
+        self.sql_backend = None
+        self.planner = None
+        self.load_plan = None
+        self.filter_plan = None
+        self.logged_plan = ""
+        self.plan_label.setText("")
+        if self.cache_stats is not None:
+            if self.layer is not None and not sip.isdeleted(self.layer) and sum(self.cache_stats.totals()) > 0:
+                logPlan(f"{self.layer.name()}\n{self.cache_stats.description()}")
+            self.cache_stats = None
+        self.cache_stats_timer.stop()
+        self.cache_label.setText("")
         self.field_filters.clear()
+        self.syncSemiJoins()
         self.table_view.setModel(None)
         self.table_view.setFeatureSelectionManager(None)
         self.filter_model = None
@@ -131,18 +293,233 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
         # カーソルを待機中にする
         QgsApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
 
+        # 地物数とプロバイダの機能から読み込みの方式を選ぶ（大規模レイヤは標本を先に表示する）
+        self.planner = EasyAttributeFilterPlanner(self.layer)
+        self.result_path = resultPath(self.layer)
+        self.cache_size = self.cacheSize()
+        self.load_plan = self.planner.planLoad(self.cache_size, self.preview_checkbox.isChecked(), PREVIEW_FEATURE_COUNT, PREVIEW_ROW_COUNT,
+                                               self.isCompact())
+        self.is_preview = self.load_plan.engine == LOAD_PREVIEW
+        self.updatePlanLabel()
+
         # レイヤキャッシュを作成
         self.initLayerCache()
 
+        # 編集時のフィルター結果の更新
+        self.connectLayerSignals()
+
+        # 列データのキャッシュ
+        self.column_cache = EasyAttributeFilterColumnCache(self.layer)
+        self.column_cache.connectLayer()
+
+        # 全文索引（GeoPackage/SQLiteのみ）
+        if EasyAttributeFilterFtsIndex.isSupported(self.layer):
+            self.fts_index = EasyAttributeFilterFtsIndex(self.layer)
+            self.fts_index.connectLayer()
+
+        # GeoPackage/SQLiteはデータソースにSQLで問い合わせる
+        if EasyAttributeFilterSqlBackend.isSupported(self.layer):
+            self.sql_backend = EasyAttributeFilterSqlBackend(self.layer)
+
+        # 列データのディスクキャッシュ（ファイルレイヤのみ）
+        self.initColumnStore()
+
+        # 属性値のコンパクトな保持
+        self.initCompactTable()
+
+        # 式によるフィールドの値の保持
+        if EasyAttributeFilterVirtualColumns.isSupported(self.layer):
+            self.virtual_columns = EasyAttributeFilterVirtualColumns(self.layer, self)
+            self.virtual_columns.connectLayer()
+            self.virtual_columns.invalidated.connect(self.onVirtualColumnsInvalidated)
+
         # データテーブル初期化   
         self.initModels()
+        self.filter_model.cache_stats = self.cache_stats
         self.table_view.setAttributeTableConfig(self.vectorlayer_combobox.currentLayer().attributeTableConfig())
         self.table_view.setModel(self.filter_model)
+        self.updateColumnSource()
+
+        # 保存したフィルターを復元する（データが変わっていなければ結果もそのまま使う）
+        restored = self.restoreFilterState()
+        if self.is_preview:
+            self.startPreview()
+        if len(self.field_filters) > 0 and not restored:
+            self.filterFeatures()
+
+        # ヘッダのポップアップ用に表示列の固有値を先読みする（列データの取得元がない場合）
+        if self.sql_backend is None and self.compact_table is None and (self.column_store is None or not self.column_store.isUsable()):
+            self.prefetchFieldSummaries()
 
         # カーソルを戻す
         QgsApplication.restoreOverrideCursor()
 
 
+    def initColumnStore(self):
+        """
+        列データのディスクキャッシュを読み込む
+
+        データソースに対応するキャッシュがない場合はバックグラウンドで作成し、
+        作成後から固有値・並び替え・フィルターに使用する。
+        """
+        if not self.column_store_checkbox.isChecked() or not EasyAttributeFilterColumnStore.isSupported(self.layer):
+            return
+
+        self.column_store = EasyAttributeFilterColumnStore(self.layer)
+        if not self.column_store.load():
+            self.buildColumnStore()
+
+
+    def isCompact(self) -> bool:
+        """
+        属性値を列ごとの型付き配列で保持するか判定する
+        """
+        return self.compact_checkbox.isChecked() and EasyAttributeFilterCompactTable.isSupported(self.layer)
+
+
+    def initCompactTable(self):
+        """
+        属性値を列ごとの型付き配列にバックグラウンドで読み込む
+
+        読み込み後から固有値・並び替え・フィルターに使用する。
+        """
+        if not self.isCompact():
+            return
+
+        self.compact_table = EasyAttributeFilterCompactTable(self.layer, self)
+        self.compact_table.connectLayer()
+        self.compact_table.ready.connect(self.onCompactTableReady)
+        self.compact_table.build()
+
+
+    def onCompactTableReady(self):
+        """
+        属性値の読み込みが終わった場合は列データの取得元を切り替える
+        """
+        table = self.compact_table
+        if table is None:
+            return
+        logPlan(f"{self.layer.name()}\nコンパクト表示：{table.row_count:,}行 約{table.memoryBytes() / (1024 * 1024):,.1f}MB")
+        self.updateColumnSource()
+
+
+    def toggleCompactTable(self, checked: bool):
+        """
+        コンパクト表示を切り替える（読み込みの方式が変わるため読み込み直す）
+
+        @param  checked:使用するか
+        """
+        QgsSettings().setValue("easy_attribute_filter/compact", checked)
+        if self.layer is not None:
+            self.updateTableData(self.layer)
+
+
+    def buildColumnStore(self):
+        """
+        列データのディスクキャッシュをバックグラウンドで作成する
+
+        未コミットの編集がある場合は作成せず、コミット時（onAfterCommitChanges）に作成する。
+        """
+        store = self.column_store
+        task = store.build()
+        if task is None:
+            return
+        task.taskCompleted.connect(lambda: self.updateColumnSource() if store is self.column_store else None)
+
+
+    def updateColumnSource(self):
+        """
+        固有値・並び替えに使う列データの取得元を各キャッシュに設定する
+        """
+        source = self.columnSource()
+        if self.column_cache is not None:
+            self.column_cache.setColumnStore(source)
+            self.column_cache.setVirtualColumns(self.virtual_columns)
+        if self.filter_model is not None:
+            self.filter_model.setColumnStore(source)
+            self.filter_model.setVirtualColumns(self.virtual_columns)
+
+
+    def onVirtualColumnsInvalidated(self):
+        """
+        式によるフィールドの値を破棄した場合は、その値から求めた順位・固有値を破棄する
+        """
+        if self.filter_model is not None:
+            self.filter_model.invalidateSortCache()
+        if self.column_cache is not None:
+            self.column_cache.invalidate()
+
+
+    def columnSource(self):
+        """
+        列データの取得元を取得する
+
+        コンパクト表示の配列、データソースに対応するディスクキャッシュの順に優先し、
+        ない場合はSQLを使う。
+
+        @return コンパクト表示の配列、ディスクキャッシュまたはSQL（ない場合はNone）
+        """
+        store = self.columnStore()
+        if store is not None:
+            return store
+        return self.sql_backend
+
+
+    def columnStore(self):
+        """
+        列ごとの値の配列を持つ取得元を取得する
+
+        @return コンパクト表示の配列またはディスクキャッシュ（ない場合はNone）
+        """
+        if self.compact_table is not None and self.compact_table.isUsable():
+            return self.compact_table
+        if self.column_store is not None and self.column_store.isUsable():
+            return self.column_store
+        return None
+
+
+    def toggleColumnStore(self, checked: bool):
+        """
+        列データのディスクキャッシュの使用を切り替える
+
+        @param  checked:使用するか
+        """
+        QgsSettings().setValue("easy_attribute_filter/column_store", checked)
+        if self.layer is None:
+            return
+
+        if checked:
+            self.initColumnStore()
+        else:
+            self.column_store = None
+        self.updateColumnSource()
+
+
+    def onAfterCommitChanges(self):
+        """
+        コミットでデータソースが変わった場合はディスクキャッシュを作り直す
+        """
+        if self.column_store is not None and not self.column_store.isUsable():
+            self.buildColumnStore()
+        self.updateColumnSource()
+
+
+    def prefetchFieldSummaries(self):
+        """
+        表示列の固有値・NULL有無・最小値・最大値をバックグラウンドで先読みする
+        """
+        fields = self.layer.fields()
+        field_indexes = []
+        for column in self.layer.attributeTableConfig().columns():
+            if column.type != QgsAttributeTableConfig.Field or column.hidden:
+                continue
+            field_index = fields.indexOf(column.name)
+            if field_index >= 0:
+                field_indexes.append(field_index)
+
+        self.column_cache.prefetch(field_indexes)
+
+
     def showEvent(self, event):
         """
         表示処理
@@ -165,18 +542,103 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
         """
         選択レイヤの地物のキャッシュを作成する
         """
-        # 属性表示時の標準キャッシュサイズを取得する
-        settings = QgsSettings()
-        cache_size = int(settings.value("qgis/attributeTableRowCache", "10000" ))
-
         # 選択レイヤのキャッシュを作成する
-        self.layer_cache = QgsVectorLayerCache(self.layer, cache_size)
+        self.layer_cache = QgsVectorLayerCache(self.layer, self.cache_size)
         self.layer_cache.setCacheGeometry(False)
 
-        if 0 == cache_size or  0 == ( QgsVectorDataProvider.SelectAtId & self.layer.dataProvider().capabilities() ):
-            # キャッシュサイズが0だったり、地物IDで地物にアクセスできない場合は全地物をキャッシュする
+        if self.load_plan.full_cache:
+            # キャッシュサイズが0だったり、地物IDで地物にアクセスできない場合や、
+            # 全地物がキャッシュに収まる場合は全地物をキャッシュする
             self.layer_cache.setFullCache(True)
 
+        self.cache_stats = EasyAttributeFilterCacheStats(self.layer_cache, self.cache_size, self.planner.estimatedRowBytes(), self)
+        self.cache_stats.updated.connect(self.cache_stats_timer.start)
+        self.updateCacheLabel()
+
+
+    def cacheSize(self) -> int:
+        """
+        レイヤキャッシュの行数を求める
+
+        メモリの上限と1行あたりの推定メモリ使用量から求める。上限が0の場合や、
+        属性表示時の標準キャッシュサイズが0（全地物をキャッシュ）の場合は標準キャッシュサイズとする。
+        """
+        settings = QgsSettings()
+        cache_size = int(settings.value("qgis/attributeTableRowCache", "10000" ))
+        memory_mb = settings.value("easy_attribute_filter/cache_memory_mb", DEFAULT_CACHE_MEMORY_MB, type=int)
+        if cache_size == 0 or memory_mb <= 0:
+            return cache_size
+        cache_size = self.planner.adaptiveCacheSize(memory_mb * 1024 * 1024)
+        if self.isCompact():
+            # 属性値は列ごとの配列で保持するため、レイヤキャッシュは表示中の行のみとする
+            cache_size = min(cache_size, COMPACT_CACHE_ROWS)
+        return cache_size
+
+
+    def updateCacheLabel(self):
+        """
+        行の読み込みの統計を表示する
+        """
+        if self.cache_stats is None:
+            self.cache_label.setText("")
+            return
+        self.cache_label.setText(self.cache_stats.text())
+        self.cache_label.setToolTip(self.cache_stats.description())
+
+
+    def recordVisibleRows(self):
+        """
+        表示する行がレイヤキャッシュにあるかを統計に加算する
+        """
+        if self.cache_stats is None or self.filter_model is None:
+            return
+
+        first = self.table_view.rowAt(0)
+        if first < 0:
+            return
+        last = self.table_view.rowAt(self.table_view.viewport().height() - 1)
+        if last < 0:
+            last = self.filter_model.rowCount() - 1
+        fids = [self.filter_model.rowToId(self.filter_model.index(row, 0)) for row in range(first, last + 1)]
+        self.cache_stats.recordFids(PHASE_SCROLL, fids)
+
+
+    def recordFilterStats(self):
+        """
+        読み込み済みの行でのフィルターの判定を統計に加算する
+
+        全地物をキャッシュしていない場合、判定する行はキャッシュを経由せずにプロバイダから読み込まれる。
+        行ごとにキャッシュを調べていないため、ミスや再取得ではなく直接読み込みとして数える。
+        """
+        if self.cache_stats is None:
+            return
+        row_count = self.master_model.rowCount()
+        if self.layer_cache.hasFullCache():
+            self.cache_stats.record(PHASE_FILTER, row_count, 0)
+        else:
+            self.cache_stats.recordReads(PHASE_FILTER, row_count)
+
+
+    def updatePlanLabel(self):
+        """
+        選択した読み込みと抽出の方式を表示し、ログに出力する
+        """
+        if self.load_plan is None:
+            self.plan_label.setText("")
+            return
+
+        text = ENGINE_NAMES[self.load_plan.engine]
+        description = self.load_plan.description()
+        if self.filter_plan is not None and len(self.filter_plan.steps) > 0:
+            text += f"／{self.filter_plan.summary()}"
+            description += "\n" + self.filter_plan.description()
+        self.plan_label.setText(text)
+        self.plan_label.setToolTip(description)
+
+        if description != self.logged_plan:
+            self.logged_plan = description
+            logPlan(f"{self.layer.name()}\n{description}")
+
 
     def initModels(self):
         """
@@ -186,10 +648,196 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
         self.master_model = None
 
         self.master_model = QgsAttributeTableModel(self.layer_cache, self)
+        self.master_model.setRequest(self.previewRequest() if self.is_preview else QgsFeatureRequest())
+        self.master_model.loadLayer()
+
+        self.filter_model = EasyAttributeFilterTableFilterModel(self.iface.mapCanvas(), self.master_model, self)
+
+
+    def previewRequest(self) -> QgsFeatureRequest:
+        """
+        プレビュー表示する標本のリクエストを作成する
+
+        列データの取得元があれば無作為に選んだ地物、ない場合は先頭の地物とする。
+        """
+        request = QgsFeatureRequest()
+        source = self.columnSource()
+        fids = source.sampleFids(PREVIEW_ROW_COUNT) if source is not None else None
+        if fids is not None:
+            request.setFilterFids(fids)
+            self.preview_text = f"無作為{len(fids):,}件"
+        else:
+            request.setLimit(PREVIEW_ROW_COUNT)
+            self.preview_text = f"先頭{PREVIEW_ROW_COUNT:,}件"
+        return request
+
+
+    def startPreview(self):
+        """
+        プレビュー表示を開始し、正確な結果をバックグラウンドで求める
+        """
+        sample_fids = [self.master_model.rowToId(row) for row in range(self.master_model.rowCount())]
+        self.column_cache.setSampleFids(sample_fids)
+        self.startExactFilter()
+
+
+    def startExactFilter(self):
+        """
+        プレビュー中に現在のフィルターの正確な結果をバックグラウンドで求める
+
+        索引・ディスクキャッシュ・SQLで解決できる場合はすぐに切り替える。
+        """
+        if not self.is_preview:
+            return
+
+        self.cancelExactFilter()
+        self.exact_generation += 1
+
+        filter = self.filterString() if len(self.field_filters) > 0 else None
+        if filter is not None:
+            fids, remaining_filters = self.resolveIndexedFilters()
+            if fids is not None and len(remaining_filters) == 0:
+                self.swapInExactResults(fids)
+                return
+
+        task = EasyAttributeFilterMatchTask(self.layer, filter)
+        generation = self.exact_generation
+        task.taskCompleted.connect(lambda: self.onExactFilterCompleted(task, generation))
+        task.taskTerminated.connect(lambda: self.onExactFilterTerminated(task))
+        self.exact_task = task
+        QgsApplication.taskManager().addTask(task)
+
+        self.preview_label.setText(f"プレビュー（概算）：{self.preview_text} / 全{self.layer.featureCount():,}件　正確な結果を取得中…")
+        self.preview_label.setVisible(True)
+
+
+    def cancelExactFilter(self):
+        """
+        正確な結果の取得を中止する
+        """
+        if self.exact_task is not None:
+            self.exact_generation += 1
+            self.exact_task.cancel()
+            self.exact_task = None
+
+
+    def onExactFilterCompleted(self, task: EasyAttributeFilterMatchTask, generation: int):
+        if self.exact_task is task:
+            self.exact_task = None
+        if generation == self.exact_generation and self.is_preview:
+            self.swapInExactResults(set(task.fids) if task.fids is not None else None)
+
+
+    def onExactFilterTerminated(self, task: EasyAttributeFilterMatchTask):
+        if self.exact_task is task:
+            self.exact_task = None
+            if len(task.error_message) > 0:
+                self.iface.messageBar().pushWarning("フィルター", task.error_message)
+
+
+    def swapInExactResults(self, fids):
+        """
+        プレビューを終了し、正確な結果に切り替える
+
+        全地物を読み込み、フィルターがある場合は一致した地物のみを表示する。
+        一致した地物のみを読み込むと、次のフィルターがその地物だけで判定されるため全地物を読み込む。
+
+        @param  fids:一致した地物IDの集合（フィルターがない場合はNone）
+        """
+        self.is_preview = False
+        self.preview_label.setVisible(False)
+        self.column_cache.setSampleFids(None)
+
+        QgsApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
+
+        # プレビューを使わない場合の読み込みの方式に切り替える
+        self.load_plan = self.planner.planLoad(self.cache_size, False, PREVIEW_FEATURE_COUNT, PREVIEW_ROW_COUNT, self.isCompact())
+        self.updatePlanLabel()
+
+        if self.load_plan.full_cache:
+            self.layer_cache.setFullCache(True)
         self.master_model.setRequest(QgsFeatureRequest())
         self.master_model.loadLayer()
 
-        self.filter_model = QgsAttributeTableFilterModel(self.iface.mapCanvas(), self.master_model, self)
+        if fids is None:
+            self.filter_model.setFilterMode(QgsAttributeTableFilterModel.ShowAll)
+        else:
+            self.applyFilteredFids(fids)
+
+        QgsApplication.restoreOverrideCursor()
+
+
+    def applyFilteredFids(self, fids):
+        """
+        求め済みのフィルター結果を表示する
+
+        @param  fids:現在のフィルターに一致した地物IDの集合
+        """
+        filter_expression = QgsExpression(self.filterString())
+        context = QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(self.layer))
+        filter_expression.prepare(context)
+        self.filter_model.setFilterExpression(filter_expression, context)
+        self.filter_model.setFilteredFeatures(fids)
+        self.filter_model.setFilterMode(QgsAttributeTableFilterModel.ShowFilteredList)
+        self.filter_model.disconnectFilterModeConnections()
+        self.filtered_fids = set(fids)
+        self.filter_expression = filter_expression
+        self.filter_context = context
+        self.pending_filter_fids.clear()
+
+
+    def saveFilterState(self, with_result: bool=False):
+        """
+        フィルターをレイヤのカスタムプロパティに保存する
+
+        プロジェクトを変更済みにしないよう、フィルターの操作ごとには呼び出さず、
+        プロジェクトの保存時とダイアログを閉じる・レイヤを切り替える際に呼び出す。
+
+        @param  with_result:フィルター結果の地物IDも保存するか（プレビュー中は保存しない）
+        """
+        fields = self.layer.fields()
+        filters = {fields.at(column).name(): expression for column, expression in self.field_filters.items()
+                   if 0 <= column < fields.count()}
+        storeFilters(self.layer, filters)
+        if not with_result:
+            return
+
+        fids = None
+        if len(filters) > 0 and not self.is_preview and self.filtered_fids is not None:
+            self.retestPendingFeatures()
+            fids = self.filtered_fids
+        storeResult(self.layer, self.result_path, self.filterString(), fids)
+
+
+    def restoreFilterState(self) -> bool:
+        """
+        保存したフィルターを復元する
+
+        保存したフィルター結果がデータの版と一致する場合は、フィルターを評価せずに表示する。
+
+        @return フィルター結果まで復元できたか
+        """
+        fields = self.layer.fields()
+        for name, expression in loadFilters(self.layer).items():
+            column = fields.indexOf(name)
+            if column >= 0:
+                self.setFieldFilter(column, expression)
+        if len(self.field_filters) == 0:
+            return False
+
+        self.restoreSemiJoins()
+
+        fids = loadResult(self.layer, self.result_path, self.filterString())
+        if fids is None:
+            return False
+
+        if self.is_preview:
+            # 一致した地物のみを読み込む
+            self.swapInExactResults(fids)
+        else:
+            self.applyFilteredFids(fids)
+        self.updateRenderFilter()
+        return True
 
 
     def clearAllFilters(self):
@@ -199,9 +847,12 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
         for column in self.field_filters.keys():
             self.filter_model.setHeaderData(column, Qt.Horizontal, QColor(), Qt.ForegroundRole)
         self.field_filters.clear()
+        self.syncSemiJoins()
 
         # クリア後に再表示
         self.showAll()
+        self.updateRenderFilter()
+        self.startExactFilter()
 
 
     def zoomToFeature(self):
@@ -212,6 +863,118 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
             self.iface.mapCanvas().zoomToSelected(self.layer)
 
 
+    def selectFilteredFeatures(self, behavior):
+        """
+        フィルター結果の地物をレイヤの選択に反映する
+
+        抽出済みの地物IDの集合を1回のselectByIdsで渡し、選択変更のシグナルを1回にする。
+
+        @param  behavior:選択の方法（置き換え・追加・共通部分・除外）
+        """
+        if self.layer is None or self.filter_model is None:
+            return
+
+        if self.is_preview:
+            self.iface.messageBar().pushInfo("選択", "正確な結果の取得後に選択してください。")
+            return
+
+        if len(self.field_filters) == 0:
+            fids = None
+        elif self.filtered_fids is not None and len(self.pending_filter_fids) == 0:
+            fids = self.filtered_fids
+        else:
+            fids = self.filteredFeatureIds()
+
+        QgsApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
+        if fids is None:
+            # フィルターがない場合は全地物が対象となる
+            if behavior in (QgsVectorLayer.SetSelection, QgsVectorLayer.AddToSelection):
+                self.layer.selectAll()
+            elif behavior == QgsVectorLayer.RemoveFromSelection:
+                self.layer.removeSelection()
+        else:
+            self.layer.selectByIds(list(fids), behavior)
+        QgsApplication.restoreOverrideCursor()
+
+
+    def showMultiLayerDialog(self):
+        """
+        現在のフィルターを複数レイヤに適用するダイアログを表示する
+        """
+        if self.layer is None:
+            return
+
+        self.closeMultiLayerDialog()
+        self.multi_layer_dialog = EasyAttributeFilterMultiLayerDialog(self.iface, self.layer, list(self.field_filters.values()), self)
+        self.multi_layer_dialog.finished.connect(self.onMultiLayerDialogFinished)
+        self.multi_layer_dialog.show()
+
+
+    def onMultiLayerDialogFinished(self):
+        self.multi_layer_dialog = None
+
+
+    def closeMultiLayerDialog(self):
+        if self.multi_layer_dialog is not None:
+            self.multi_layer_dialog.close()
+            self.multi_layer_dialog = None
+
+
+    def filteredFeatureIds(self):
+        """
+        フィルター結果の地物IDを取得する
+
+        @return 地物IDのリスト（フィルターがない場合はNone）
+        """
+        if len(self.field_filters) == 0 or self.filter_model is None:
+            return None
+        return self.filter_model.filteredFeatures()
+
+
+    def exportFeatures(self):
+        """
+        フィルター結果をファイルにエクスポートする
+        """
+        if self.layer is None:
+            return
+
+        if self.export_task is not None:
+            self.iface.messageBar().pushInfo("エクスポート", "エクスポートを実行中です。")
+            return
+
+        if self.is_preview:
+            self.iface.messageBar().pushInfo("エクスポート", "プレビュー中は正確な結果の取得後にエクスポートしてください。")
+            return
+
+        file_path, file_format = QFileDialog.getSaveFileName(self, "エクスポート", "", ";;".join(EXPORT_FORMATS.keys()))
+        if len(file_path) == 0:
+            return
+
+        # 拡張子を補完する
+        extension = EXPORT_FORMATS[file_format][1]
+        if not file_path.lower().endswith(extension):
+            file_path += extension
+
+        task = EasyAttributeFilterExportTask(self.layer, self.filteredFeatureIds(), file_path, file_format)
+
+        # ダイアログが閉じられても結果を通知できるようにifaceを直接参照する
+        iface = self.iface
+        task.taskCompleted.connect(lambda: iface.messageBar().pushSuccess("エクスポート", f"{task.exported_count:,}件を出力しました：{file_path}"))
+        task.taskTerminated.connect(lambda: iface.messageBar().pushWarning("エクスポート", task.error_message if len(task.error_message) > 0 else "エクスポートを中止しました。"))
+        task.taskCompleted.connect(self.onExportFinished)
+        task.taskTerminated.connect(self.onExportFinished)
+
+        self.export_task = task
+        QgsApplication.taskManager().addTask(task)
+
+
+    def onExportFinished(self):
+        """
+        エクスポート終了時の処理
+        """
+        self.export_task = None
+
+
     def clearFieldFilter(self):
         """
         フィルタークリア（ポップアップ）
@@ -239,7 +1002,21 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
         if provider is None:
             return
 
-        self.filter_model.sort(self.column_target, Qt.AscendingOrder if ascending else Qt.DescendingOrder)
+        self.filter_model.sortColumns([(self.column_target, ascending)])
+
+
+    def addSort(self, ascending: bool=True):
+        """
+        並び替えキーを追加する（既存の並び替えを優先し、対象列で続けて並び替える）
+
+        @param  ascending:昇順or降順
+        """
+        if self.filter_model is None:
+            return
+
+        sort_keys = [(column, key_ascending) for column, key_ascending in self.filter_model.sort_keys if column != self.column_target]
+        sort_keys.append((self.column_target, ascending))
+        self.filter_model.sortColumns(sort_keys)
         
 
     def showOptionFilterDialog(self):
@@ -253,7 +1030,8 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
         previous_filter = self.field_filters.get(self.column_target, "")
 
         # 対象列からフィールドを特定する
-        dlg.setValues(self.column_target, self.filter_model, previous_filter)
+        dlg.setValues(self.column_target, self.filter_model, previous_filter, self.column_cache)
+        dlg.setMatchEstimator(self.createMatchEstimator(dlg))
         
         if dlg.exec() != QDialog.Accepted:
             return
@@ -264,6 +1042,190 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
         self.filterFeatures()
 
 
+    def showRelationFilterDialog(self):
+        """
+        関連レイヤの条件でフィルターするダイアログ表示
+
+        子レイヤの条件に一致する外部キーの集合をバックグラウンドで求め、対象列がその集合に含まれる地物を抽出する。
+        """
+        if self.layer is None or self.column_target < 0:
+            return
+
+        field = self.filter_model.layer().fields().at(self.column_target)
+        relations = parentRelations(self.layer, field.name())
+        if len(relations) == 0:
+            return
+
+        dlg = EasyAttributeFilterRelationDialog(relations, self)
+        if dlg.exec() != QDialog.Accepted or dlg.relation() is None:
+            return
+
+        self.startSemiJoin(self.column_target, dlg.relation(), dlg.expression())
+        self.iface.messageBar().pushInfo("関連レイヤの条件でフィルター", f"{dlg.relation().referencingLayer().name()}を抽出しています。")
+
+
+    def startSemiJoin(self, column: int, relation: QgsRelation, child_expression: str):
+        """
+        子レイヤの条件に一致する外部キーの集合をバックグラウンドで求める
+
+        @param  column:親レイヤのキーの列番号
+        @param  relation:リレーション
+        @param  child_expression:子レイヤの条件
+        """
+        self.cancelSemiJoin(column)
+        task = EasyAttributeFilterSemiJoinTask(relation, child_expression)
+        layer = self.layer
+        field = self.layer.fields().at(column)
+        task.taskCompleted.connect(lambda: self.onSemiJoinCompleted(task, layer, column, field))
+        task.taskTerminated.connect(lambda: self.onSemiJoinTerminated(task, column))
+        self.semi_join_tasks[column] = task
+        QgsApplication.taskManager().addTask(task)
+
+
+    def onSemiJoinCompleted(self, task: EasyAttributeFilterSemiJoinTask, layer: QgsVectorLayer, column: int, field: QgsField):
+        if self.semi_join_tasks.get(column) is not task:
+            return
+        del self.semi_join_tasks[column]
+        if self.layer is not layer:
+            return
+
+        # キーの集合はメモリに保持し、フィルター式にはリレーションIDと子レイヤの条件のみを含める
+        self.setFieldFilter(column, semiJoinExpression(task.relation_id, task.child_expression, field.name()))
+        self.semi_joins[column] = (task.relation_id, task.child_expression, frozenset(task.keys))
+        self.syncSemiJoins()
+        self.filterFeatures()
+
+
+    def onSemiJoinTerminated(self, task: EasyAttributeFilterSemiJoinTask, column: int):
+        if self.semi_join_tasks.get(column) is not task:
+            return
+        del self.semi_join_tasks[column]
+        if len(task.error_message) > 0:
+            self.iface.messageBar().pushWarning("関連レイヤの条件でフィルター", task.error_message)
+
+
+    def cancelSemiJoin(self, column: int=None):
+        """
+        外部キーの集合を求めている途中の要求を中止する
+
+        @param  column:列番号（Noneの場合は全ての列）
+        """
+        columns = list(self.semi_join_tasks.keys()) if column is None else [column]
+        for target in columns:
+            task = self.semi_join_tasks.pop(target, None)
+            if task is not None:
+                task.cancel()
+
+
+    def syncSemiJoins(self):
+        """
+        フィルターが変更・削除された列の外部キーの集合を破棄し、式関数が判定に使う集合を更新する
+        """
+        for column, (relation_id, child_expression, _) in list(self.semi_joins.items()):
+            semi_join = parseSemiJoinExpression(self.field_filters.get(column, ""))
+            if semi_join is None or semi_join[0:2] != (relation_id, child_expression):
+                del self.semi_joins[column]
+
+        semi_join_keys.clear()
+        for relation_id, child_expression, keys in self.semi_joins.values():
+            semi_join_keys[(relation_id, child_expression)] = keys
+
+
+    def restoreSemiJoins(self):
+        """
+        復元した関連レイヤの条件でのフィルターの外部キーの集合を求め直す
+
+        リレーションがなくなった場合はフィルターを削除する。
+        """
+        for column, expression in list(self.field_filters.items()):
+            semi_join = parseSemiJoinExpression(expression)
+            if semi_join is None or column in self.semi_joins:
+                continue
+            relation = QgsProject.instance().relationManager().relation(semi_join[0])
+            if not relation.isValid() or relation.referencedLayerId() != self.layer.id():
+                del self.field_filters[column]
+                self.filter_model.setHeaderData(column, Qt.Horizontal, QColor(), Qt.ForegroundRole)
+                continue
+            self.startSemiJoin(column, relation, semi_join[1])
+
+
+    def semiJoinFids(self, column: int):
+        """
+        外部キーの集合に含まれる地物IDを列データの取得元で求める
+
+        @param  column:親レイヤのキーの列番号
+        @return 地物IDの集合（列データの取得元で解決できない場合はNone）
+        """
+        store = self.columnStore()
+        field_name = self.layer.fields().at(column).name()
+        if store is None or not store.hasField(field_name):
+            return None
+        _, _, keys = self.semi_joins[column]
+        mask = store.evaluate(ValueSetPredicate(field_name, list(keys)))
+        if mask is None:
+            return None
+        return set(store.fids()[mask].tolist())
+
+
+    def crossFilter(self, column: int):
+        """
+        対象列の値の一覧を絞り込む他の列のフィルターを取得する
+
+        対象列にフィルターがない場合、現在のフィルター結果が他の列のフィルターを通過した地物となる。
+
+        @param  column:対象列
+        @return (他の列のフィルター式のリスト, 通過した地物IDの集合（分からない場合はNone）)（他の列にフィルターがない場合はNone）
+        """
+        expressions = [expression for other_column, expression in self.field_filters.items() if other_column != column]
+        if len(expressions) == 0 or self.is_preview:
+            # プレビュー中は全地物の読み込みを避けるため絞り込まない
+            return None
+
+        fids = None
+        if column not in self.field_filters and self.filtered_fids is not None and len(self.pending_filter_fids) == 0:
+            fids = self.filtered_fids
+        return (expressions, fids)
+
+
+    def createMatchEstimator(self, parent) -> EasyAttributeFilterMatchEstimator:
+        """
+        対象列の条件に一致する件数を求めるオブジェクトを作成する
+
+        他の列のフィルターも含めた、適用後に表示される件数を求める。
+
+        @param  parent:親オブジェクト
+        """
+        estimator = EasyAttributeFilterMatchEstimator(self.layer, self.column_cache, parent)
+        estimator.setColumnSource(self.columnSource())
+        estimator.setOtherFilters([expression for column, expression in self.field_filters.items() if column != self.column_target])
+        return estimator
+
+
+    def toggleFtsIndex(self):
+        """
+        対象列の全文索引を作成または削除する
+        """
+        if self.fts_index is None:
+            return
+
+        field_name = self.filter_model.layer().fields().at(self.column_target).name()
+        if self.fts_index.isIndexed(field_name):
+            self.fts_index.remove(field_name)
+            return
+
+        if self.fts_index.isModified():
+            # 未コミットの編集を含めて作成すると、コミット済みのデータと一致しない索引になる
+            self.iface.messageBar().pushWarning("全文索引", "未コミットの編集があるため作成できません。編集を保存してから作成してください。")
+            return
+
+        task = self.fts_index.build(field_name)
+        if task is None:
+            return
+
+        iface = self.iface
+        task.taskCompleted.connect(lambda: iface.messageBar().pushSuccess("全文索引", f"{field_name}の全文索引を作成しました。"))
+
+
     def setFieldFilterFromPopup(self, expression):
         """
         フィルター式を保管する（ポップアップ時）
@@ -295,12 +1257,15 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
         if self.layer is None:
             return
 
+        self.syncSemiJoins()
         filter_count = len(self.field_filters)
         if filter_count == 0:
             self.showAll()
+            self.updateRenderFilter()
+            self.startExactFilter()
             return
 
-        filter = " AND ".join(self.field_filters.values())
+        filter = self.filterString()
 
         filter_expression = QgsExpression(filter)
         if filter_expression.hasParserError():
@@ -315,11 +1280,383 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
             self.iface.messageBar().pushWarning("Evaluation error", filter_expression.evalErrorString())
             return
 
+        # 索引で解決できるフィルターは地物IDを直接求める
+        indexed_fids, remaining_filters = self.resolveIndexedFilters()
+
         # フィルター式に設定する
-        self.filter_model.setFilterExpression(filter_expression, context)
-        self.filter_model.filterFeatures()
+        if indexed_fids is None:
+            self.filter_model.setFilterExpression(filter_expression, context)
+            self.filter_model.filterFeatures()
+            self.recordFilterStats()
+        else:
+            if len(remaining_filters) > 0:
+                # 残りのフィルターのみで抽出し、索引の結果と組み合わせる
+                remaining_expression = QgsExpression(" AND ".join(remaining_filters))
+                remaining_expression.prepare(context)
+                self.filter_model.setFilterExpression(remaining_expression, context)
+                self.filter_model.filterFeatures()
+                self.recordFilterStats()
+                indexed_fids &= set(self.filter_model.filteredFeatures())
+            self.filter_model.setFilterExpression(filter_expression, context)
+            self.filter_model.setFilteredFeatures(indexed_fids)
         self.setFilterMode(QgsAttributeTableFilterModel.ShowFilteredList)
 
+        # 編集時は全件を再判定せず、変更のあった地物のみ再判定する
+        self.filter_model.disconnectFilterModeConnections()
+        self.filtered_fids = set(self.filter_model.filteredFeatures())
+        self.filter_expression = filter_expression
+        self.filter_context = context
+        self.pending_filter_fids.clear()
+
+        self.updateRenderFilter()
+
+        # プレビュー中は標本での結果を表示し、正確な結果を求める
+        self.startExactFilter()
+
+
+    def resetFilterResult(self):
+        """
+        フィルター結果をクリアする
+        """
+        self.filter_timer.stop()
+        self.filtered_fids = None
+        self.filter_expression = None
+        self.filter_context = None
+        self.pending_filter_fids.clear()
+
+
+    def connectLayerSignals(self):
+        """
+        編集時にフィルター結果を更新するよう接続する
+        """
+        self.layer.featureAdded.connect(self.onFeatureAdded)
+        self.layer.featureDeleted.connect(self.onFeatureDeleted)
+        self.layer.attributeValueChanged.connect(self.onAttributeValueChanged)
+        self.layer.geometryChanged.connect(self.onGeometryChanged)
+        self.layer.committedFeaturesAdded.connect(self.onCommittedFeaturesAdded)
+        self.layer.afterCommitChanges.connect(self.onAfterCommitChanges)
+
+
+    def disconnectLayerSignals(self):
+        """
+        接続を解除する
+        """
+        self.layer.featureAdded.disconnect(self.onFeatureAdded)
+        self.layer.featureDeleted.disconnect(self.onFeatureDeleted)
+        self.layer.attributeValueChanged.disconnect(self.onAttributeValueChanged)
+        self.layer.geometryChanged.disconnect(self.onGeometryChanged)
+        self.layer.committedFeaturesAdded.disconnect(self.onCommittedFeaturesAdded)
+        self.layer.afterCommitChanges.disconnect(self.onAfterCommitChanges)
+
+
+    def queueFilterRetest(self, fids):
+        """
+        地物を再判定の対象に追加する
+
+        @param  fids:地物IDのリスト
+        """
+        if self.filtered_fids is None:
+            return
+        self.pending_filter_fids.update(fids)
+        self.filter_timer.start(0)
+
+
+    def onFeatureAdded(self, fid: int):
+        self.queueFilterRetest([fid])
+
+
+    def onFeatureDeleted(self, fid: int):
+        self.pending_filter_fids.discard(fid)
+        if self.filtered_fids is not None:
+            self.filtered_fids.discard(fid)
+
+
+    def onAttributeValueChanged(self, fid: int, field_index: int, value):
+        if self.filter_expression is None:
+            return
+        if field_index not in self.filter_expression.referencedAttributeIndexes(self.layer.fields()):
+            # フィルターに関係しない属性の変更
+            return
+        self.queueFilterRetest([fid])
+
+
+    def onGeometryChanged(self, fid: int, geometry):
+        if self.filter_expression is None or not self.filter_expression.needsGeometry():
+            # ジオメトリを参照しないフィルター（$areaなどを使う式のみ再判定する）
+            return
+        self.queueFilterRetest([fid])
+
+
+    def onCommittedFeaturesAdded(self, layer_id: str, features):
+        if self.filtered_fids is None:
+            return
+        # 未コミット時の一時的な地物IDを削除し、確定した地物IDで再判定する
+        self.filtered_fids = {fid for fid in self.filtered_fids if fid >= 0}
+        self.pending_filter_fids = {fid for fid in self.pending_filter_fids if fid >= 0}
+        self.queueFilterRetest([feature.id() for feature in features])
+
+
+    def retestPendingFeatures(self):
+        """
+        変更のあった地物のみフィルター式で再判定し、フィルター結果を更新する
+        """
+        fids = list(self.pending_filter_fids)
+        self.pending_filter_fids.clear()
+        if self.filtered_fids is None or self.filter_model is None or len(fids) == 0:
+            return
+
+        request = QgsFeatureRequest()
+        request.setFilterFids(fids)
+        if not self.filter_expression.needsGeometry():
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+
+        changed = False
+        for feature in self.layer.getFeatures(request):
+            self.filter_context.setFeature(feature)
+            result = self.filter_expression.evaluate(self.filter_context)
+            matched = not isNullValue(result) and bool(result)
+            if matched and feature.id() not in self.filtered_fids:
+                self.filtered_fids.add(feature.id())
+                changed = True
+            elif not matched and feature.id() in self.filtered_fids:
+                self.filtered_fids.discard(feature.id())
+                changed = True
+
+        if changed:
+            self.filter_model.setFilteredFeatures(self.filtered_fids)
+            self.filter_model.disconnectFilterModeConnections()
+
+
+    def resolveIndexedFilters(self):
+        """
+        抽出の方式を選び、読み込み済みの行で判定するもの以外のフィルターの地物IDを求める
+
+        索引・ディスクキャッシュ・SQL・プロバイダで抽出する。プレビュー中はプロバイダでの抽出を
+        バックグラウンドで行うため、ここでは行わない。
+        関連レイヤの条件は保持した外部キーの集合で判定する（列データの取得元がない場合は
+        読み込み済みの行ごとに式関数で集合に含まれるかを判定する）。
+
+        @return (地物IDの集合（解決できるフィルターがない場合はNone）, 残りのフィルター式のリスト)
+        """
+        filters = [expression for column, expression in self.field_filters.items() if column not in self.semi_joins]
+        self.filter_plan = self.planner.planFilter(filters, self.load_plan,
+                                                   self.columnStore(), self.sql_backend, self.fts_index, self.virtual_columns)
+        self.updatePlanLabel()
+
+        fids = None
+        remaining_filters = []
+        for expression in self.filter_plan.expressions(FILTER_INDEX) + self.filter_plan.expressions(FILTER_COLUMNAR):
+            matched = self.fts_index.matchingFids(expression) if self.fts_index is not None else None
+            if matched is None and self.columnStore() is not None:
+                matched = self.columnStore().matchingFids(expression)
+            if matched is None:
+                remaining_filters.append(expression)
+                continue
+            fids = matched if fids is None else fids & matched
+
+        for expression in self.filter_plan.expressions(FILTER_MATERIALIZED):
+            # 式によるフィールドは初回のみ全地物で評価して保持する（プレビュー中は保持済みの場合のみ）
+            fields = parsePredicate(expression).fields()
+            usable = not self.is_preview or all(self.virtual_columns.isMaterialized(field) for field in fields)
+            matched = None
+            if usable and all(self.virtual_columns.materialize(field) for field in fields):
+                matched = self.virtual_columns.matchingFids(expression)
+            if matched is None:
+                remaining_filters.append(expression)
+                continue
+            fids = matched if fids is None else fids & matched
+
+        sql_filters = self.filter_plan.expressions(FILTER_SQL)
+        if len(sql_filters) > 0:
+            # SQLに変換できるものは1回のSQLで抽出する
+            matched, sql_remaining = self.sql_backend.matchingFids(sql_filters)
+            remaining_filters += sql_remaining
+            if matched is not None:
+                fids = matched if fids is None else fids & matched
+
+        pushdown_filters = self.filter_plan.expressions(FILTER_PUSHDOWN)
+        if len(pushdown_filters) > 0 and not self.is_preview:
+            matched = self.pushdownFids(pushdown_filters)
+            fids = matched if fids is None else fids & matched
+        else:
+            remaining_filters += pushdown_filters
+
+        remaining_filters += self.filter_plan.expressions(FILTER_MEMORY)
+
+        for column in self.semi_joins:
+            matched = self.semiJoinFids(column)
+            if matched is None:
+                remaining_filters.append(self.field_filters[column])
+                continue
+            fids = matched if fids is None else fids & matched
+        return (fids, remaining_filters)
+
+
+    def pushdownFids(self, expressions: list) -> set:
+        """
+        フィルター式をプロバイダに渡して一致する地物IDを求める
+
+        @param  expressions:フィルター式のリスト
+        """
+        request = QgsFeatureRequest()
+        request.setFilterExpression(" AND ".join(f"({expression})" for expression in expressions))
+        request.setExpressionContext(QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(self.layer)))
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setNoAttributes()
+        return {feature.id() for feature in self.layer.getFeatures(request)}
+
+
+    def filterString(self) -> str:
+        """
+        全体のフィルター式を作成する
+
+        @return 各列のフィルター式をANDで結合した式
+        """
+        return " AND ".join(self.field_filters.values())
+
+
+    def updateRenderFilter(self):
+        """
+        地図表示のフィルターを現在の設定に合わせて更新する
+        """
+        if self.layer is None:
+            return
+
+        if self.render_filter_checkbox.isChecked() and len(self.field_filters) > 0:
+            self.applyRenderFilter(self.filterString())
+        else:
+            self.restoreRenderer()
+
+
+    def applyRenderFilter(self, filter: str):
+        """
+        地図表示にフィルターを適用する
+
+        元のシンボロジーをルールベースに変換し、フィルター式を持つルールの下に配置する。
+        ルールのフィルター式は描画時の地物リクエストに渡されるため、
+        式をコンパイルできるプロバイダでは抽出された地物のみが読み込まれる。
+        プロジェクトの保存時は元のレンダラーを書き込み、フィルター適用中に変更されたシンボロジーは元のレンダラーとして取り込む。
+
+        @param  filter:フィルター式
+        """
+        if self.layer.renderer() is None:
+            return
+
+        # 元のレンダラーを退避する（フィルター適用中は退避済みのものを使う）
+        original_renderer = self.original_renderer if self.original_renderer is not None else self.layer.renderer().clone()
+
+        converted = QgsRuleBasedRenderer.convertFromRenderer(original_renderer)
+        if converted is None:
+            # ルールベースに変換できないレンダラーは対象外
+            self.iface.messageBar().pushWarning("地図表示", "このレイヤのシンボロジーにはフィルターを適用できません。")
+            return
+
+        filter_rule = QgsRuleBasedRenderer.Rule(None, 0, 0, filter)
+        for child in converted.rootRule().children():
+            filter_rule.appendChild(child.clone())
+        root_rule = QgsRuleBasedRenderer.Rule(None)
+        root_rule.appendChild(filter_rule)
+
+        if self.original_renderer is None:
+            self.layer.rendererChanged.connect(self.onRendererChanged)
+        self.original_renderer = original_renderer
+        self.render_filter = filter
+        self.setLayerRenderer(QgsRuleBasedRenderer(root_rule))
+
+
+    def restoreRenderer(self):
+        """
+        地図表示のフィルターを解除し、元のレンダラーに戻す
+        """
+        if self.original_renderer is None:
+            return
+
+        renderer = self.original_renderer
+        self.original_renderer = None
+        self.render_filter = None
+        if self.layer is None or sip.isdeleted(self.layer):
+            # レイヤが削除済みの場合は戻す必要がない
+            return
+
+        self.layer.rendererChanged.disconnect(self.onRendererChanged)
+        self.setLayerRenderer(renderer)
+
+
+    def setLayerRenderer(self, renderer: QgsFeatureRenderer):
+        """
+        レイヤのレンダラーを設定する（利用者による変更と区別する）
+        """
+        self.setting_renderer = True
+        try:
+            self.layer.setRenderer(renderer)
+        finally:
+            self.setting_renderer = False
+        self.layer.triggerRepaint()
+
+
+    def onRendererChanged(self):
+        """
+        フィルター適用中にシンボロジーが変更された場合、変更後のものを元のレンダラーとしてフィルターを適用し直す
+        """
+        if self.setting_renderer or self.original_renderer is None:
+            return
+
+        self.original_renderer = self.unwrapRenderFilter(self.layer.renderer())
+        # 変更した処理が終わってから適用し直す
+        QTimer.singleShot(0, self.updateRenderFilter)
+
+
+    def unwrapRenderFilter(self, renderer: QgsFeatureRenderer) -> QgsFeatureRenderer:
+        """
+        フィルター用のルールを取り除いたレンダラーを作成する
+
+        フィルター適用中のルールベースのシンボロジーが編集された場合は、フィルター用のルールの下のルールを取り出す。
+
+        @param  renderer:レンダラー
+        @return フィルター用のルールを含まないレンダラー
+        """
+        if isinstance(renderer, QgsRuleBasedRenderer):
+            children = renderer.rootRule().children()
+            if len(children) == 1 and children[0].filterExpression() == self.render_filter:
+                root_rule = QgsRuleBasedRenderer.Rule(None)
+                for child in children[0].children():
+                    root_rule.appendChild(child.clone())
+                return QgsRuleBasedRenderer(root_rule)
+        return renderer.clone()
+
+
+    def onWriteMapLayer(self, layer: QgsMapLayer, element, document):
+        """
+        プロジェクトの保存時に表示中のレイヤのフィルターを書き込む
+
+        書き込みはレイヤの要素の作成後に通知されるため、フィルターをカスタムプロパティに保存してから
+        レイヤの要素のカスタムプロパティを書き直す。
+        地図表示のフィルターを適用中の場合は元のレンダラーを書き込み、
+        フィルター式（関連レイヤの条件ではプラグインでのみ使える関数を含む）をプロジェクトに残さない。
+
+        @param  layer:書き込むレイヤ
+        @param  element:レイヤの要素
+        @param  document:プロジェクトのXML
+        """
+        if self.layer is None or sip.isdeleted(self.layer) or layer.id() != self.layer.id():
+            return
+
+        if self.filter_model is not None:
+            self.saveFilterState(True)
+            self.layer.writeCustomProperties(element, document)
+
+        if self.original_renderer is None:
+            return
+
+        context = QgsReadWriteContext()
+        context.setPathResolver(QgsProject.instance().pathResolver())
+        renderer_element = self.original_renderer.save(document, context)
+        filtered_element = element.firstChildElement("renderer-v2")
+        if filtered_element.isNull():
+            element.appendChild(renderer_element)
+        else:
+            element.replaceChild(renderer_element, filtered_element)
+
 
     def setFilterMode(self, mode: QgsAttributeTableFilterModel.FilterMode):
         """
@@ -330,6 +1667,11 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
         if self.filter_model is None:
             return
 
+        if self.is_preview:
+            # プレビュー中は標本のみを対象とする
+            self.filter_model.setFilterMode(mode)
+            return
+
         # リクエスト初期化
         master_request = QgsFeatureRequest(self.master_model.request())
         # previous request was subset or no features
@@ -354,6 +1696,7 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
         """
         フィルターモデルのモードにShowAllを設定する
         """
+        self.resetFilterResult()
         self.setFilterMode(QgsAttributeTableFilterModel.ShowAll)
 
 
@@ -376,24 +1719,47 @@ class EasyAttributeFilterDialog(QDialog, FORM_CLASS):
         self.column_target = column_target
 
         self.action_option_filter.setText("数値フィルタ" if self.filter_model.layer().fields().at(column_target).isNumeric() else "テキストフィルタ")
+        self.updateFtsIndexAction(self.filter_model.layer().fields().at(column_target))
+        self.action_relation_filter.setVisible(len(parentRelations(self.layer, self.filter_model.layer().fields().at(column_target).name())) > 0)
         
         # 前回設定したフィルターがあるか確認
         previous_filter = self.field_filters.get(column_target, "")
         # 値フィルターウィジェットアクションにサンプル値を設定する
         QgsApplication.setOverrideCursor(Qt.WaitCursor)
-        self.filter_values.setValues(self.column_target, self.filter_model, previous_filter)
+        self.filter_values.setValues(self.column_target, self.filter_model, previous_filter, self.column_cache, self.crossFilter(self.column_target))
+        self.filter_values.setMatchEstimator(self.createMatchEstimator(self.filter_values))
         QgsApplication.restoreOverrideCursor()
         # メニューを表示する
         self.menu.popup(self.table_view.horizontalHeader().mapToGlobal(pos))
 
 
 
+    def updateFtsIndexAction(self, field: QgsField):
+        """
+        全文索引メニューの表示を更新する
+
+        @param  field:対象フィールド
+        """
+        if self.fts_index is None or field.type() != QVariant.String:
+            self.action_fts_index.setVisible(False)
+            return
+
+        self.action_fts_index.setVisible(True)
+        if self.fts_index.isBuilding(field.name()):
+            self.action_fts_index.setText("全文索引を作成中")
+            self.action_fts_index.setEnabled(False)
+        else:
+            self.action_fts_index.setText("全文索引を削除" if self.fts_index.isIndexed(field.name()) else "全文索引を作成")
+            self.action_fts_index.setEnabled(True)
+
+
     def closeEvent(self, event):
         """
         クローズ処理
 
         @param  event
         """
+        self.closeMultiLayerDialog()
         self.clear()
         self.closed.emit()
         event.accept()
\ No newline at end of file
@@ -0,0 +1,245 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterEngine
+                                 A QGIS plugin
+ フィルター式の作成と評価（画面を使わない処理用）
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+ 値の一覧・比較・LIKEのフィルター式の作成と、レイヤに対するフィルターの評価を行う。
+ Qtのウィジェットに依存しないため、プロセシングのアルゴリズムやバックグラウンドのスレッドからも使用できる。
+ 評価はダイアログと同じく、ディスクキャッシュ・SQLで解決できる式はそれを使い、残りはプロバイダに渡す。
+"""
+from collections import Counter
+
+from qgis.core import (QgsFeatureRequest, QgsExpression, QgsExpressionContext, QgsExpressionContextUtils, QgsVectorLayer,
+                       QgsVectorLayerFeatureSource)
+
+from .easy_attribute_filter_column_cache import isNullValue
+from .easy_attribute_filter_columnar import EasyAttributeFilterColumnStore
+from .easy_attribute_filter_sql import EasyAttributeFilterSqlBackend
+from .easy_attribute_filter_planner import (EasyAttributeFilterPlanner, LoadPlan, LOAD_PAGED, FILTER_COLUMNAR, FILTER_SQL,
+                                            FILTER_PUSHDOWN, FILTER_MEMORY)
+
+# 演算子の表示名：式の演算子
+NUMERIC_OPERATORS = {"と等しい": "=","と等しくない": "!=","より大きい": ">","以上": ">=","より小さい": "<","以下": "<="}
+TEXT_OPERATORS  = {"で始まる": "LIKE '(value)%'","で始まらない": "NOT LIKE '(value)%'","で終わる": "LIKE '%(value)'","で終わらない": "NOT LIKE '%(value)'","を含む": "LIKE '%(value)%'","を含まない": "NOT LIKE '%(value)%'"}
+
+
+def quoteValue(value: str, is_numeric: bool) -> str:
+    """
+    値の一覧の判定値を式のリテラルにする（空文字列の''はそのまま）
+
+    文字列の引用符やバックスラッシュはエスケープするため、判定値はエスケープせずに渡す。
+
+    @param  value:判定値（文字列）
+    @param  is_numeric:数値のフィールドか
+    """
+    if is_numeric or value == "''":
+        return value
+    return QgsExpression.quotedString(value)
+
+
+def valueSetExpression(field_name: str, values: list, include_null: bool, is_numeric: bool) -> str:
+    """
+    値の一覧に一致するフィルター式を作成する
+
+    @param  field_name:フィールド名
+    @param  values:判定値（文字列）のリスト
+    @param  include_null:NULLも含めるか
+    @param  is_numeric:数値のフィールドか
+    @return 式（判定値がない場合は空）
+    """
+    if len(values) == 0:
+        return ""
+
+    values_joined = ",".join(quoteValue(value, is_numeric) for value in values)
+    if include_null:
+        return f'("{field_name}" IN ({values_joined}) OR "{field_name}" IS NULL)'
+    return f'"{field_name}" IN ({values_joined})'
+
+
+def comparisonExpression(field_name: str, operator: str, value: str, is_numeric: bool) -> str:
+    """
+    比較またはLIKEのフィルター式を作成する
+
+    @param  field_name:フィールド名
+    @param  operator:演算子の表示名（NUMERIC_OPERATORSまたはTEXT_OPERATORSのキー）
+    @param  value:判定値
+    @param  is_numeric:数値のフィールドか
+    @return 式（演算子が不明な場合は空）
+    """
+    if operator in NUMERIC_OPERATORS:
+        literal = value if is_numeric else QgsExpression.quotedString(value)
+        return f"\"{field_name}\" {NUMERIC_OPERATORS[operator]} {literal}"
+
+    if operator in TEXT_OPERATORS:
+        # 'で囲まれたパターンに判定値を埋め込んでからリテラルにする
+        like_operator, like_pattern = TEXT_OPERATORS[operator].split(" '")
+        pattern = like_pattern[0:-1].replace("(value)", value)
+        return f"\"{field_name}\" {like_operator} {QgsExpression.quotedString(pattern)}"
+
+    return ""
+
+
+def dateRangeExpression(field_name: str, ranges: list, include_null: bool, is_datetime: bool) -> str:
+    """
+    日付の範囲のフィルター式を作成する
+
+    @param  field_name:フィールド名
+    @param  ranges:[(開始日, 終了日（含まない）)]
+    @param  include_null:NULLも含めるか
+    @param  is_datetime:日時のフィールドか
+    @return 式（範囲がない場合は空）
+    """
+    if is_datetime:
+        literal = lambda date: f"to_datetime('{date.isoformat()} 00:00:00')"
+    else:
+        literal = lambda date: f"to_date('{date.isoformat()}')"
+
+    conditions = [f'"{field_name}" >= {literal(start)} AND "{field_name}" < {literal(end)}' for start, end in ranges]
+    if include_null:
+        conditions.append(f'"{field_name}" IS NULL')
+
+    if len(conditions) == 0:
+        return ""
+    return "(" + " OR ".join(f"({condition})" for condition in conditions) + ")"
+
+
+class EasyAttributeFilterEngine:
+    """
+    レイヤに対してフィルター式を評価する
+
+    作成はレイヤを所有するスレッドで行い、評価は別のスレッドから行ってもよい。
+    """
+
+    def __init__(self, layer: QgsVectorLayer, expressions: list):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        @param  expressions:フィルター式のリスト（ANDで結合する）
+        """
+        self.layer = layer
+        self.layer_name = layer.name()
+        self.expressions = [expression for expression in expressions if expression]
+        self.fields = layer.fields()
+        self.feature_count = layer.featureCount()
+
+        # スレッドからはレイヤではなく地物ソースを経由して読み込む
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.context = QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(layer))
+
+        # ディスクキャッシュは作成済みの場合のみ使う
+        # 評価のスレッドからレイヤを参照しないよう、フィールド・サブセット・編集状態を固定したスナップショットを使う
+        self.column_store = None
+        if EasyAttributeFilterColumnStore.isSupported(layer):
+            store = EasyAttributeFilterColumnStore(layer)
+            if store.load():
+                self.column_store = store.snapshot()
+        self.sql_backend = EasyAttributeFilterSqlBackend(layer).snapshot() if EasyAttributeFilterSqlBackend.isSupported(layer) else None
+        self.column_sources = [source for source in (self.column_store, self.sql_backend) if source is not None and source.isUsable()]
+
+        # レイヤを参照するため、方式は作成時に選んでおく（キャッシュを持たないため読み込み済みの行はない）
+        load_plan = LoadPlan(LOAD_PAGED, 0.0, False, "")
+        self.filter_plan = EasyAttributeFilterPlanner(layer).planFilter(self.expressions, load_plan, self.column_store, self.sql_backend)
+
+    def matchingFids(self, feedback=None):
+        """
+        フィルター式に一致する地物IDを求める
+
+        @param  feedback:中止の確認に使うQgsFeedback
+        @return 地物IDの集合（フィルター式がない場合はNone、中止した場合は空）
+        """
+        if len(self.expressions) == 0:
+            return None
+
+        plan = self.filter_plan
+        fids = None
+        remaining = []
+        for expression in plan.expressions(FILTER_COLUMNAR):
+            matched = self.column_store.matchingFids(expression)
+            if matched is None:
+                remaining.append(expression)
+                continue
+            fids = matched if fids is None else fids & matched
+
+        sql_filters = plan.expressions(FILTER_SQL)
+        if len(sql_filters) > 0:
+            matched, sql_remaining = self.sql_backend.matchingFids(sql_filters)
+            remaining += sql_remaining
+            if matched is not None:
+                fids = matched if fids is None else fids & matched
+
+        # 残りはプロバイダに渡す（式をコンパイルできるプロバイダはデータソース側で抽出する）
+        remaining += plan.expressions(FILTER_PUSHDOWN) + plan.expressions(FILTER_MEMORY)
+        if len(remaining) == 0:
+            return fids
+
+        request = QgsFeatureRequest()
+        request.setFilterExpression(" AND ".join(f"({expression})" for expression in remaining))
+        request.setExpressionContext(self.context)
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setNoAttributes()
+        if fids is not None:
+            # 解決済みの地物のみを判定する
+            request.setFilterFids(list(fids))
+
+        matched = set()
+        for feature in self.source.getFeatures(request):
+            if feedback is not None and feedback.isCanceled():
+                return set()
+            matched.add(feature.id())
+        return matched
+
+    def count(self, feedback=None) -> int:
+        """
+        フィルター式に一致する件数を求める
+
+        @param  feedback:中止の確認に使うQgsFeedback
+        """
+        if len(self.expressions) == 0:
+            return self.feature_count
+
+        for source in self.column_sources:
+            count = source.countMatching(self.expressions)
+            if count is not None:
+                return count
+        return len(self.matchingFids(feedback))
+
+    def valueCounts(self, field_name: str, feedback=None):
+        """
+        フィルター式に一致する地物の固有値ごとの件数を求める
+
+        @param  field_name:フィールド名
+        @param  feedback:中止の確認に使うQgsFeedback
+        @return ({値: 件数}, NULLの件数)（フィールドがない場合はNone）
+        """
+        field_index = self.fields.indexOf(field_name)
+        if field_index < 0:
+            return None
+
+        for source in self.column_sources:
+            result = source.valueCountsMatching(field_name, self.expressions)
+            if result is not None:
+                return result
+
+        fids = self.matchingFids(feedback)
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([field_index])
+        if fids is not None:
+            request.setFilterFids(list(fids))
+
+        counts = Counter()
+        null_count = 0
+        for feature in self.source.getFeatures(request):
+            if feedback is not None and feedback.isCanceled():
+                break
+            value = feature.attribute(field_index)
+            if isNullValue(value):
+                null_count += 1
+            else:
+                counts[value] += 1
+        return (dict(counts), null_count)
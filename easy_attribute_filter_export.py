@@ -0,0 +1,118 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterExportTask
+                                 A QGIS plugin
+ フィルター結果のエクスポート
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+"""
+import os
+
+from qgis.core import (QgsTask, QgsProject, QgsFeatureRequest, QgsVectorFileWriter,
+                       QgsVectorLayer, QgsVectorLayerFeatureSource, QgsWkbTypes)
+
+# ファイル種類：(ドライバ名, 拡張子, ジオメトリ出力有無)
+EXPORT_FORMATS = {"CSV (*.csv)": ("CSV", ".csv", False), "GeoPackage (*.gpkg)": ("GPKG", ".gpkg", True), "Excel (*.xlsx)": ("XLSX", ".xlsx", False)}
+
+class EasyAttributeFilterExportTask(QgsTask):
+
+    # 1回のリクエストで読み込む地物数
+    BATCH_SIZE = 10000
+    # 進捗を更新する間隔
+    PROGRESS_INTERVAL = 1000
+
+    def __init__(self, layer: QgsVectorLayer, fids, file_path: str, file_format: str):
+        """
+        コンストラクタ
+
+        @param  layer:出力元レイヤ
+        @param  fids:出力する地物IDのリスト（Noneの場合は全地物）
+        @param  file_path:出力先ファイル
+        @param  file_format:ファイル種類（EXPORT_FORMATSのキー）
+        """
+        super(EasyAttributeFilterExportTask, self).__init__(f"エクスポート：{os.path.basename(file_path)}", QgsTask.CanCancel)
+
+        self.driver_name, _, with_geometry = EXPORT_FORMATS[file_format]
+        self.file_path = file_path
+
+        # スレッドからはレイヤではなく地物ソースを経由して読み込む
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.fields = layer.fields()
+        self.crs = layer.crs()
+        self.wkb_type = layer.wkbType() if with_geometry else QgsWkbTypes.NoGeometry
+        self.transform_context = QgsProject.instance().transformContext()
+
+        self.fids = sorted(fids) if fids is not None else None
+        self.total = len(self.fids) if self.fids is not None else layer.featureCount()
+
+        self.exported_count = 0
+        self.error_message = ""
+
+    def run(self) -> bool:
+        """
+        エクスポート処理（バックグラウンド）
+        """
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = self.driver_name
+        options.fileEncoding = "UTF-8"
+
+        writer = QgsVectorFileWriter.create(self.file_path, self.fields, self.wkb_type, self.crs, self.transform_context, options)
+        if writer.hasError() != QgsVectorFileWriter.NoError:
+            self.error_message = writer.errorMessage()
+            del writer
+            self.removeOutput()
+            return False
+
+        completed = False
+        try:
+            for request in self.requests():
+                # 地物は1件ずつ書き出し、全件をメモリに保持しない
+                for feature in self.source.getFeatures(request):
+                    if self.isCanceled():
+                        return False
+
+                    if not writer.addFeature(feature):
+                        self.error_message = writer.errorMessage()
+                        return False
+
+                    self.exported_count += 1
+                    if self.exported_count % self.PROGRESS_INTERVAL == 0 and self.total > 0:
+                        self.setProgress(100.0 * self.exported_count / self.total)
+            completed = True
+        finally:
+            # ファイルを閉じる（中止・エラー時は書きかけのファイルを残さない）
+            del writer
+            if not completed:
+                self.removeOutput()
+
+        return True
+
+    def removeOutput(self):
+        """
+        書きかけの出力ファイルを削除する
+        """
+        try:
+            if os.path.exists(self.file_path):
+                os.remove(self.file_path)
+        except OSError:
+            pass
+
+    def requests(self):
+        """
+        地物リクエストを生成する
+
+        地物IDは一定件数ごとに分割し、リクエスト毎のID集合が大きくなりすぎないようにする。
+        """
+        flags = QgsFeatureRequest.NoGeometry if self.wkb_type == QgsWkbTypes.NoGeometry else QgsFeatureRequest.NoFlags
+
+        if self.fids is None:
+            yield QgsFeatureRequest().setFlags(flags)
+            return
+
+        for start in range(0, len(self.fids), self.BATCH_SIZE):
+            request = QgsFeatureRequest()
+            request.setFilterFids(self.fids[start:start + self.BATCH_SIZE])
+            request.setFlags(flags)
+            yield request
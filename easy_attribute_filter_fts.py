@@ -0,0 +1,352 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterFtsIndex
+                                 A QGIS plugin
+ 「を含む」「を含まない」フィルター用の全文索引
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+"""
+import os
+import re
+import hashlib
+import sqlite3
+
+from qgis.core import (QgsApplication, QgsTask, QgsFeatureRequest, QgsProviderRegistry,
+                       QgsVectorLayer, QgsVectorLayerFeatureSource)
+
+from .easy_attribute_filter_predicate import parsePredicate, LikePredicate
+
+# 全文索引を使用できるストレージ
+FTS_STORAGE_TYPES = ("GPKG", "SQLite")
+# 一度に登録する地物数
+INSERT_BATCH_SIZE = 10000
+
+_fts_available = None
+
+def isFtsAvailable() -> bool:
+    """
+    FTS5のtrigramトークナイザが使用できるか判定する
+    """
+    global _fts_available
+    if _fts_available is None:
+        try:
+            connection = sqlite3.connect(":memory:")
+            connection.execute("CREATE VIRTUAL TABLE t USING fts5(v, tokenize='trigram case_sensitive 1')")
+            connection.close()
+            _fts_available = True
+        except sqlite3.Error:
+            _fts_available = False
+    return _fts_available
+
+
+def parseContainsExpression(expression: str):
+    """
+    「を含む」「を含まない」の式を解析する
+
+    全文索引で解決できるのは "フィールド" LIKE '%値%' / "フィールド" NOT LIKE '%値%' で、
+    値にLIKEの特殊文字（%・_・\\）を含まないもの。値は文字列リテラルのエスケープを戻して取得する。
+
+    @param  expression:式
+    @return (フィールド名, 値, 否定) 対象外の式はNone
+    """
+    predicate = parsePredicate(expression)
+    if not isinstance(predicate, LikePredicate):
+        return None
+
+    pattern = predicate.pattern
+    if len(pattern) < 2 or not pattern.startswith("%") or not pattern.endswith("%"):
+        return None
+    value = pattern[1:-1]
+    if any(character in value for character in "%_\\"):
+        return None
+    return (predicate.field, value, predicate.negate)
+
+
+def escapeGlob(value: str) -> str:
+    """
+    GLOBの特殊文字をエスケープする
+    """
+    return re.sub(r"([*?\[])", r"[\1]", value)
+
+
+class EasyAttributeFilterFtsIndex:
+    """
+    レイヤのデータソース・サブセットごとに作成する全文索引（FTS5 trigram）のサイドカーファイル
+
+    索引はコミット済みのデータを対象とし、レイヤの編集がコミットされたときに更新する。
+    データソースのファイルサイズ・更新日時（-walファイルを含む）が索引作成時と異なる場合は使用しない。
+    """
+
+    def __init__(self, layer: QgsVectorLayer):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        """
+        self.layer = layer
+        uri = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source())
+        self.source_path = uri.get("path", "")
+        self.layer_name = uri.get("layerName", "") or ""
+
+        # サブセットごとに対象の地物が異なるため、サブセットの条件もキーに含める
+        key = hashlib.sha1(f"{os.path.abspath(self.source_path)}|{self.layer_name}|{layer.subsetString()}".encode("utf-8")).hexdigest()
+        index_dir = os.path.join(QgsApplication.qgisSettingsDirPath(), "easy_attribute_filter", "fts")
+        self.index_path = os.path.join(index_dir, f"{key}.sqlite")
+
+        self.build_tasks = dict()
+
+    @staticmethod
+    def isSupported(layer: QgsVectorLayer) -> bool:
+        """
+        全文索引を使用できるレイヤか判定する
+        """
+        if layer is None or layer.providerType() != "ogr":
+            return False
+        if layer.dataProvider().storageType() not in FTS_STORAGE_TYPES:
+            return False
+        return isFtsAvailable()
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        サイドカーファイルに接続する
+        """
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        connection = sqlite3.connect(self.index_path, timeout=30)
+        connection.execute("CREATE TABLE IF NOT EXISTS fields (name TEXT PRIMARY KEY, table_name TEXT, size INTEGER, mtime REAL)")
+        return connection
+
+    def sourceStamp(self):
+        """
+        データソースの変更検知用の値（ファイルサイズ, 更新日時）を取得する
+
+        WALモードのデータベースはチェックポイントまで変更が-walファイルにのみ書き込まれるため、
+        -walファイルがある場合はサイズの合計と新しい方の更新日時とする。
+        """
+        try:
+            stat = os.stat(self.source_path)
+        except OSError:
+            return (-1, -1.0)
+        size, mtime = stat.st_size, stat.st_mtime
+        try:
+            wal_stat = os.stat(self.source_path + "-wal")
+        except OSError:
+            return (size, mtime)
+        return (size + wal_stat.st_size, max(mtime, wal_stat.st_mtime))
+
+    def indexedFields(self) -> dict:
+        """
+        有効な索引があるフィールドを取得する
+
+        @return {フィールド名: テーブル名}
+        """
+        if not os.path.exists(self.index_path):
+            return dict()
+
+        size, mtime = self.sourceStamp()
+        connection = self.connect()
+        try:
+            rows = connection.execute("SELECT name, table_name FROM fields WHERE size = ? AND mtime = ?", (size, mtime)).fetchall()
+        finally:
+            connection.close()
+        return {name: table_name for name, table_name in rows}
+
+    def isIndexed(self, field_name: str) -> bool:
+        return field_name in self.indexedFields()
+
+    def isBuilding(self, field_name: str) -> bool:
+        return field_name in self.build_tasks
+
+    def tableName(self, field_name: str) -> str:
+        return "fts_" + hashlib.sha1(field_name.encode("utf-8")).hexdigest()[:16]
+
+    def build(self, field_name: str):
+        """
+        索引をバックグラウンドで作成する
+
+        @param  field_name:フィールド名
+        @return 作成タスク（作成中または未コミットの編集がある場合はNone）
+        """
+        if self.isBuilding(field_name) or self.isModified():
+            return None
+
+        task = EasyAttributeFilterFtsBuildTask(self, field_name)
+        task.taskCompleted.connect(lambda: self.build_tasks.pop(field_name, None))
+        task.taskTerminated.connect(lambda: self.build_tasks.pop(field_name, None))
+        self.build_tasks[field_name] = task
+        QgsApplication.taskManager().addTask(task)
+        return task
+
+    def remove(self, field_name: str):
+        """
+        索引を削除する
+
+        @param  field_name:フィールド名
+        """
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(f'DROP TABLE IF EXISTS "{self.tableName(field_name)}"')
+                connection.execute("DELETE FROM fields WHERE name = ?", (field_name,))
+        finally:
+            connection.close()
+
+    def isModified(self) -> bool:
+        """
+        未コミットの編集があるか判定する（索引はコミット済みのデータのみを対象とする）
+        """
+        return self.layer.isEditable() and self.layer.isModified()
+
+    def canAnswer(self, expression: str) -> bool:
+        """
+        式を索引で解決できるか判定する
+        """
+        if self.isModified():
+            # 未コミットの編集は索引に反映されていない
+            return False
+
+        parsed = parseContainsExpression(expression)
+        return parsed is not None and self.isIndexed(parsed[0])
+
+    def matchingFids(self, expression: str):
+        """
+        「を含む」「を含まない」の式に一致する地物IDを取得する
+
+        @param  expression:式
+        @return 地物IDの集合（索引で解決できない場合はNone）
+        """
+        if not self.canAnswer(expression):
+            return None
+
+        field_name, value, negate = parseContainsExpression(expression)
+        table_name = self.indexedFields()[field_name]
+
+        # NULLはLIKE/NOT LIKEのいずれにも一致しない
+        operator = "NOT GLOB" if negate else "GLOB"
+        # 3文字未満はtrigramで検索できないため、索引を使わずに照合する
+        column = "value" if len(value) >= 3 and not negate else "+value"
+        connection = self.connect()
+        try:
+            rows = connection.execute(f'SELECT rowid FROM "{table_name}" WHERE {column} {operator} ?', (f"*{escapeGlob(value)}*",))
+            return {row[0] for row in rows}
+        finally:
+            connection.close()
+
+    def connectLayer(self):
+        """
+        コミット時に索引を更新するよう接続する
+        """
+        self.layer.committedFeaturesAdded.connect(self.onCommittedFeaturesAdded)
+        self.layer.committedFeaturesRemoved.connect(self.onCommittedFeaturesRemoved)
+        self.layer.committedAttributeValuesChanges.connect(self.onCommittedAttributeValuesChanges)
+
+    def disconnectLayer(self):
+        """
+        接続を解除する
+        """
+        self.layer.committedFeaturesAdded.disconnect(self.onCommittedFeaturesAdded)
+        self.layer.committedFeaturesRemoved.disconnect(self.onCommittedFeaturesRemoved)
+        self.layer.committedAttributeValuesChanges.disconnect(self.onCommittedAttributeValuesChanges)
+
+    def updateIndex(self, update):
+        """
+        有効な索引を更新し、データソースの変更検知用の値を更新する
+
+        @param  update:(接続, フィールド名, フィールドindex, テーブル名)を受け取る更新処理
+        """
+        indexed_fields = self.indexedFields()
+        if len(indexed_fields) == 0:
+            return
+
+        fields = self.layer.fields()
+        size, mtime = self.sourceStamp()
+        connection = self.connect()
+        try:
+            with connection:
+                for field_name, table_name in indexed_fields.items():
+                    update(connection, field_name, fields.indexOf(field_name), table_name)
+                    connection.execute("UPDATE fields SET size = ?, mtime = ? WHERE name = ?", (size, mtime, field_name))
+        finally:
+            connection.close()
+
+    def onCommittedFeaturesAdded(self, layer_id: str, features):
+        def update(connection, field_name, field_index, table_name):
+            connection.executemany(f'INSERT OR REPLACE INTO "{table_name}" (rowid, value) VALUES (?, ?)',
+                                   [(feature.id(), self.textValue(feature.attribute(field_index))) for feature in features])
+        self.updateIndex(update)
+
+    def onCommittedFeaturesRemoved(self, layer_id: str, fids):
+        def update(connection, field_name, field_index, table_name):
+            connection.executemany(f'DELETE FROM "{table_name}" WHERE rowid = ?', [(fid,) for fid in fids])
+        self.updateIndex(update)
+
+    def onCommittedAttributeValuesChanges(self, layer_id: str, changed_attributes: dict):
+        def update(connection, field_name, field_index, table_name):
+            connection.executemany(f'UPDATE "{table_name}" SET value = ? WHERE rowid = ?',
+                                   [(self.textValue(attributes[field_index]), fid) for fid, attributes in changed_attributes.items() if field_index in attributes])
+        self.updateIndex(update)
+
+    @staticmethod
+    def textValue(value):
+        """
+        索引に登録する値を取得する（NULLはNone）
+        """
+        if value is None or (hasattr(value, "isNull") and value.isNull()):
+            return None
+        return str(value)
+
+
+class EasyAttributeFilterFtsBuildTask(QgsTask):
+    """
+    全文索引の作成タスク
+    """
+
+    def __init__(self, fts_index: EasyAttributeFilterFtsIndex, field_name: str):
+        super(EasyAttributeFilterFtsBuildTask, self).__init__(f"全文索引の作成：{field_name}", QgsTask.CanCancel)
+
+        self.fts_index = fts_index
+        self.field_name = field_name
+        self.field_index = fts_index.layer.fields().indexOf(field_name)
+        self.table_name = fts_index.tableName(field_name)
+        self.total = fts_index.layer.featureCount()
+
+        # 作成中にデータソースが変更された場合は索引を無効とするため、開始時点の値を記録する
+        self.stamp = fts_index.sourceStamp()
+        self.source = QgsVectorLayerFeatureSource(fts_index.layer)
+
+    def run(self) -> bool:
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.field_index])
+
+        connection = self.fts_index.connect()
+        try:
+            with connection:
+                connection.execute(f'DROP TABLE IF EXISTS "{self.table_name}"')
+                connection.execute("DELETE FROM fields WHERE name = ?", (self.field_name,))
+                connection.execute(f"CREATE VIRTUAL TABLE \"{self.table_name}\" USING fts5(value, tokenize='trigram case_sensitive 1')")
+
+                rows = []
+                count = 0
+                for feature in self.source.getFeatures(request):
+                    if self.isCanceled():
+                        raise InterruptedError()
+
+                    rows.append((feature.id(), EasyAttributeFilterFtsIndex.textValue(feature.attribute(self.field_index))))
+                    count += 1
+                    if len(rows) >= INSERT_BATCH_SIZE:
+                        connection.executemany(f'INSERT INTO "{self.table_name}" (rowid, value) VALUES (?, ?)', rows)
+                        rows.clear()
+                        if self.total > 0:
+                            self.setProgress(100.0 * count / self.total)
+
+                connection.executemany(f'INSERT INTO "{self.table_name}" (rowid, value) VALUES (?, ?)', rows)
+                connection.execute("INSERT INTO fields (name, table_name, size, mtime) VALUES (?, ?, ?, ?)",
+                                   (self.field_name, self.table_name, self.stamp[0], self.stamp[1]))
+        except InterruptedError:
+            return False
+        finally:
+            connection.close()
+
+        return True
@@ -0,0 +1,253 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterMatchTask
+                                 A QGIS plugin
+ フィルター式に一致する地物のバックグラウンド抽出
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+"""
+from qgis.PyQt.QtCore import QObject, pyqtSignal
+from qgis.core import (QgsApplication, QgsTask, QgsExpression, QgsExpressionContext, QgsExpressionContextUtils,
+                       QgsFeatureRequest, QgsVectorLayer, QgsVectorLayerFeatureSource)
+
+from .easy_attribute_filter_predicate import parsePredicate
+from .easy_attribute_filter_sql import EasyAttributeFilterSqlBackend
+
+
+class EasyAttributeFilterMatchTask(QgsTask):
+    """
+    フィルター式に一致する地物IDを求めるタスク
+
+    フィルター式は地物リクエストに設定し、式をコンパイルできるプロバイダでは
+    プロバイダ側で抽出させる。
+    """
+
+    def __init__(self, layer: QgsVectorLayer, expression: str=None, collect_fids: bool=True):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        @param  expression:フィルター式（Noneの場合は全地物を読み込むのみ）
+        @param  collect_fids:地物IDを収集するか（Falseの場合は件数のみ数える）
+        """
+        super(EasyAttributeFilterMatchTask, self).__init__(f"フィルターの抽出：{layer.name()}", QgsTask.CanCancel)
+
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.fields = layer.fields()
+        self.total = layer.featureCount()
+        self.expression = expression
+        self.context = QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(layer))
+        self.collect_fids = collect_fids
+
+        # 一致した地物ID（式がない場合や件数のみ数える場合はNone）
+        self.fids = None
+        self.count = 0
+        self.error_message = ""
+
+    def run(self) -> bool:
+        request = QgsFeatureRequest()
+        if self.expression is None:
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+            request.setNoAttributes()
+        else:
+            expression = QgsExpression(self.expression)
+            if expression.hasParserError():
+                self.error_message = expression.parserErrorString()
+                return False
+            request.setFilterExpression(self.expression)
+            request.setExpressionContext(self.context)
+            if not expression.needsGeometry():
+                request.setFlags(QgsFeatureRequest.NoGeometry)
+            request.setSubsetOfAttributes(expression.referencedColumns(), self.fields)
+            if self.collect_fids:
+                self.fids = []
+
+        for feature in self.source.getFeatures(request):
+            if self.isCanceled():
+                return False
+
+            if self.fids is not None:
+                self.fids.append(feature.id())
+            self.count += 1
+            if self.count % 10000 == 0 and self.total > 0 and self.expression is None:
+                self.setProgress(100.0 * self.count / self.total)
+
+        return True
+
+
+class EasyAttributeFilterSqlCountTask(QgsTask):
+    """
+    作成済みのSQLで件数を求めるタスク
+
+    データソースへの接続はSQLを実行するスレッドで開く。
+    """
+
+    def __init__(self, sql_backend: EasyAttributeFilterSqlBackend, query: tuple):
+        """
+        コンストラクタ
+
+        @param  sql_backend:SQLを実行するレイヤのSQL
+        @param  query:(SQL, パラメータのリスト)
+        """
+        super(EasyAttributeFilterSqlCountTask, self).__init__(f"件数の集計：{sql_backend.layer.name()}", QgsTask.CanCancel)
+        self.sql_backend = sql_backend
+        self.sql, self.parameters = query
+        self.count = 0
+
+    def run(self) -> bool:
+        rows = self.sql_backend.execute(self.sql, self.parameters)
+        if rows is None or self.isCanceled():
+            return False
+        self.count = rows[0][0]
+        return True
+
+
+class EasyAttributeFilterMatchEstimator(QObject):
+    """
+    フィルター適用前に一致する件数を求める
+
+    列データの取得元（ディスクキャッシュ）、先読みした固有値ごとの件数の順に試し、
+    求められない場合はSQL、またはプロバイダにフィルター式を渡してバックグラウンドで数える。
+    入力中に呼ばれるため、メインスレッドではデータソースを読み込まない。
+    """
+
+    # 件数, 正確な値か
+    estimated = pyqtSignal(int, bool)
+
+    def __init__(self, layer: QgsVectorLayer, column_cache, parent=None):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        @param  column_cache:列データのキャッシュ
+        """
+        super(EasyAttributeFilterMatchEstimator, self).__init__(parent)
+        self.layer = layer
+        self.column_cache = column_cache
+        # 列データの取得元（ディスクキャッシュまたはSQL）
+        self.column_source = None
+        # 他の列のフィルター式
+        self.other_filters = []
+
+        # 古い要求の結果は使わない
+        self.generation = 0
+        self.task = None
+
+    def setColumnSource(self, column_source):
+        self.column_source = column_source
+
+    def setOtherFilters(self, expressions: list):
+        """
+        件数に含める他の列のフィルター式を設定する
+        """
+        self.other_filters = list(expressions)
+
+    def estimate(self, expression: str):
+        """
+        対象列のフィルター式と他の列のフィルター式に一致する件数を求める
+
+        結果はestimatedシグナルで通知する。
+
+        @param  expression:対象列のフィルター式（空の場合は他の列のみ）
+        """
+        self.cancel()
+        self.generation += 1
+
+        expressions = self.other_filters + ([expression] if len(expression) > 0 else [])
+        if len(expressions) == 0:
+            self.estimated.emit(self.layer.featureCount(), True)
+            return
+
+        # SQLはテーブル全体を走査する場合があるため、メインスレッドでは実行しない
+        sql_query = None
+        if isinstance(self.column_source, EasyAttributeFilterSqlBackend):
+            sql_query = self.column_source.countQuery(expressions)
+        elif self.column_source is not None:
+            count = self.column_source.countMatching(expressions)
+            if count is not None:
+                self.estimated.emit(count, True)
+                return
+
+        frequency_estimate = self.frequencyEstimate(expressions)
+        if frequency_estimate is not None:
+            count, is_exact = frequency_estimate
+            self.estimated.emit(count, is_exact)
+            if is_exact:
+                return
+
+        if sql_query is not None:
+            self.startTask(EasyAttributeFilterSqlCountTask(self.column_source, sql_query), expressions)
+        else:
+            self.startProviderCount(expressions)
+
+    def startProviderCount(self, expressions: list):
+        """
+        プロバイダで数える（式をコンパイルできるプロバイダではプロバイダ側で抽出される）
+        """
+        self.startTask(EasyAttributeFilterMatchTask(self.layer, " AND ".join(expressions), False), expressions)
+
+    def startTask(self, task: QgsTask, expressions: list):
+        """
+        件数を求めるタスクを開始する
+        """
+        generation = self.generation
+        task.taskCompleted.connect(lambda: self.onTaskCompleted(task, generation))
+        task.taskTerminated.connect(lambda: self.onTaskTerminated(task, generation, expressions))
+        self.task = task
+        QgsApplication.taskManager().addTask(task)
+
+    def frequencyEstimate(self, expressions: list):
+        """
+        先読みした固有値ごとの件数から件数を求める
+
+        複数の式は互いに独立とみなして該当率を掛け合わせるため概算となる。
+
+        @return (件数, 正確な値か)（求められない場合はNone）
+        """
+        if self.column_cache is None:
+            return None
+
+        fields = self.layer.fields()
+        ratio = 1.0
+        count = 0
+        for expression in expressions:
+            predicate = parsePredicate(expression)
+            if predicate is None or len(predicate.fields()) != 1:
+                return None
+            field_index = fields.indexFromName(next(iter(predicate.fields())))
+            summary = self.column_cache.summary(field_index) if field_index >= 0 else None
+            if summary is None or summary.total() == 0:
+                return None
+            count = summary.countMatching(predicate)
+            if count is None:
+                return None
+            ratio *= count / summary.total()
+
+        if len(expressions) == 1:
+            # 編集中は変更前の値の件数が残るため概算とする
+            return (count, not self.layer.isModified())
+        return (int(round(self.layer.featureCount() * ratio)), False)
+
+    def cancel(self):
+        """
+        数えている途中の要求を中止する
+        """
+        if self.task is not None:
+            self.generation += 1
+            self.task.cancel()
+            self.task = None
+
+    def onTaskCompleted(self, task: QgsTask, generation: int):
+        if self.task is task:
+            self.task = None
+        if generation == self.generation:
+            self.estimated.emit(task.count, True)
+
+    def onTaskTerminated(self, task: QgsTask, generation: int, expressions: list):
+        if self.task is task:
+            self.task = None
+            if generation == self.generation and isinstance(task, EasyAttributeFilterSqlCountTask):
+                # SQLを実行できなかった場合はプロバイダで数える
+                self.startProviderCount(expressions)
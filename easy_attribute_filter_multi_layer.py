@@ -0,0 +1,372 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterMultiLayerDialog
+                                 A QGIS plugin
+ 同じ属性構成の複数レイヤへのフィルターの適用
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+ 検索一覧画面のフィルターを、同じ属性構成の複数レイヤに適用する。
+ レイヤごとにバックグラウンドのタスクで並行して抽出し（式をコンパイルできるプロバイダでは
+ プロバイダ側で抽出する）、結果は出力元のレイヤの列を付けて1つの一覧に表示する。
+ 一覧の属性値は表示する行の分のみ読み込む。
+"""
+import os
+from bisect import bisect_right
+
+from qgis.PyQt import uic
+from qgis.PyQt.QtWidgets import QDialog, QListWidgetItem
+from qgis.PyQt.QtCore import Qt, QAbstractTableModel, QModelIndex
+from qgis.core import QgsApplication, QgsProject, QgsTask, QgsFeatureRequest, QgsVectorLayer
+
+from .easy_attribute_filter_column_cache import isNullValue
+from .easy_attribute_filter_engine import EasyAttributeFilterEngine
+
+FORM_CLASS, _ = uic.loadUiType(os.path.join(
+    os.path.dirname(__file__), 'easy_attribute_filter_multi_layer_base.ui'))
+
+# 一覧の表示で1回に読み込む行数
+PAGE_SIZE = 200
+# 読み込んだ行を保持する上限
+ROW_CACHE_LIMIT = 5000
+
+
+def isSameSchema(reference: QgsVectorLayer, layer: QgsVectorLayer) -> bool:
+    """
+    基準のレイヤの全ての属性を同じ型で持つか判定する
+    """
+    fields = layer.fields()
+    for field in reference.fields():
+        field_index = fields.indexOf(field.name())
+        if field_index < 0 or fields.at(field_index).type() != field.type():
+            return False
+    return True
+
+
+class EasyAttributeFilterLayerTask(QgsTask):
+    """
+    1レイヤ分のフィルターに一致する地物IDを求めるタスク
+    """
+
+    def __init__(self, engine: EasyAttributeFilterEngine):
+        super(EasyAttributeFilterLayerTask, self).__init__(f"複数レイヤのフィルター：{engine.layer_name}", QgsTask.CanCancel)
+        self.engine = engine
+        # 一致した地物ID（昇順）
+        self.fids = None
+
+    def run(self) -> bool:
+        # タスクは中止の確認（isCanceled）をフィードバックとして渡せる
+        fids = self.engine.matchingFids(self)
+        if self.isCanceled():
+            return False
+
+        if fids is None:
+            # フィルターがない場合は全地物
+            request = QgsFeatureRequest()
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+            request.setNoAttributes()
+            fids = set()
+            for feature in self.engine.source.getFeatures(request):
+                if self.isCanceled():
+                    return False
+                fids.add(feature.id())
+
+        self.fids = sorted(fids)
+        return True
+
+
+class EasyAttributeFilterMultiLayerModel(QAbstractTableModel):
+    """
+    複数レイヤのフィルター結果を1つの一覧にする
+
+    行はレイヤごとの地物IDの並びで、属性値は表示時に一定行数ずつ読み込む。
+    """
+
+    def __init__(self, field_names: list, parent=None):
+        """
+        コンストラクタ
+
+        @param  field_names:表示する属性名
+        """
+        super(EasyAttributeFilterMultiLayerModel, self).__init__(parent)
+        self.field_names = field_names
+        # [(レイヤ, 表示する属性の位置のリスト, 地物IDのリスト)]
+        self.blocks = []
+        # レイヤごとの先頭の行
+        self.offsets = []
+        self.row_total = 0
+        # {(レイヤの番号, 地物ID): 属性値のリスト}
+        self.row_cache = dict()
+        # 読み込めなかった（削除された）地物の属性値
+        self.missing_row = [None] * len(field_names)
+
+    def clear(self):
+        self.beginResetModel()
+        self.blocks = []
+        self.offsets = []
+        self.row_total = 0
+        self.row_cache = dict()
+        self.endResetModel()
+
+    def addLayer(self, layer: QgsVectorLayer, fids: list):
+        """
+        レイヤのフィルター結果を末尾に追加する
+
+        @param  layer:レイヤ
+        @param  fids:地物IDのリスト
+        """
+        if len(fids) == 0:
+            return
+        fields = layer.fields()
+        field_indexes = [fields.indexOf(field_name) for field_name in self.field_names]
+
+        self.beginInsertRows(QModelIndex(), self.row_total, self.row_total + len(fids) - 1)
+        self.blocks.append((layer, field_indexes, fids))
+        self.offsets.append(self.row_total)
+        self.row_total += len(fids)
+        self.endInsertRows()
+
+    def layers(self) -> list:
+        return [layer for layer, _, _ in self.blocks]
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else self.row_total
+
+    def columnCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.field_names) + 1
+
+    def headerData(self, section: int, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Vertical:
+            return section + 1
+        return "レイヤ" if section == 0 else self.field_names[section - 1]
+
+    def locate(self, row: int):
+        """
+        行のレイヤの番号とレイヤ内の位置を求める
+        """
+        block_index = bisect_right(self.offsets, row) - 1
+        return (block_index, row - self.offsets[block_index])
+
+    def featureAt(self, row: int):
+        """
+        行の地物
+
+        @return (レイヤ, 地物ID)
+        """
+        block_index, position = self.locate(row)
+        layer, _, fids = self.blocks[block_index]
+        return (layer, fids[position])
+
+    def data(self, index: QModelIndex, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+
+        block_index, position = self.locate(index.row())
+        layer = self.blocks[block_index][0]
+        if index.column() == 0:
+            return layer.name()
+
+        value = self.rowAttributes(block_index, position)[index.column() - 1]
+        return "NULL" if isNullValue(value) else value
+
+    def rowAttributes(self, block_index: int, position: int) -> list:
+        """
+        行の属性値を取得する（読み込んでいない場合は続く行とまとめて読み込む）
+        """
+        fids = self.blocks[block_index][2]
+        key = (block_index, fids[position])
+        if key not in self.row_cache:
+            self.fetchPage(block_index, position)
+        return self.row_cache.get(key, self.missing_row)
+
+    def fetchPage(self, block_index: int, position: int):
+        """
+        指定した位置から一定行数の属性値を読み込む
+        """
+        if len(self.row_cache) > ROW_CACHE_LIMIT:
+            self.row_cache = dict()
+
+        layer, field_indexes, fids = self.blocks[block_index]
+        page_fids = fids[position:position + PAGE_SIZE]
+        request = QgsFeatureRequest()
+        request.setFilterFids(page_fids)
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([field_index for field_index in field_indexes if field_index >= 0])
+        for feature in layer.getFeatures(request):
+            attributes = feature.attributes()
+            self.row_cache[(block_index, feature.id())] = [attributes[field_index] if field_index >= 0 else None
+                                                           for field_index in field_indexes]
+
+        # 削除された地物は空の行として保持し、描画のたびに読み込み直さない
+        for fid in page_fids:
+            self.row_cache.setdefault((block_index, fid), self.missing_row)
+
+
+class EasyAttributeFilterMultiLayerDialog(QDialog, FORM_CLASS):
+    """
+    複数レイヤにフィルターを適用するダイアログ
+    """
+
+    def __init__(self, iface, layer: QgsVectorLayer, expressions: list, parent=None):
+        """
+        コンストラクタ
+
+        @param  iface
+        @param  layer:基準のレイヤ（属性構成の比較に使う）
+        @param  expressions:フィルター式のリスト
+        """
+        super(EasyAttributeFilterMultiLayerDialog, self).__init__(parent, Qt.Dialog | Qt.WindowMinMaxButtonsHint | Qt.WindowCloseButtonHint)
+        self.setupUi(self)
+        self.setAttribute(Qt.WA_DeleteOnClose)
+
+        self.iface = iface
+        self.layer = layer
+        self.expressions = list(expressions)
+
+        self.model = EasyAttributeFilterMultiLayerModel([field.name() for field in layer.fields()], self)
+        self.table_view.setModel(self.model)
+
+        # 実行中のタスク
+        self.tasks = []
+        self.generation = 0
+        self.layer_total = 0
+        self.finished_count = 0
+        self.failed_count = 0
+
+        filter_text = " AND ".join(self.expressions) if len(self.expressions) > 0 else "なし（全地物）"
+        self.filter_label.setText(f"フィルター：{filter_text}")
+
+        self.check_all_button.clicked.connect(lambda: self.setAllChecked(True))
+        self.uncheck_all_button.clicked.connect(lambda: self.setAllChecked(False))
+        self.run_button.clicked.connect(self.run)
+        self.zoom_feature_button.clicked.connect(self.zoomToFeature)
+        self.table_view.doubleClicked.connect(self.zoomToFeature)
+        self.close_button.clicked.connect(lambda: self.close())
+        QgsProject.instance().layersWillBeRemoved.connect(self.onLayersWillBeRemoved)
+        self.is_connected = True
+
+        self.populateLayers()
+
+    def populateLayers(self):
+        """
+        基準のレイヤと同じ属性構成のレイヤを一覧にする
+        """
+        self.layer_list.clear()
+        for layer in QgsProject.instance().mapLayers().values():
+            if not isinstance(layer, QgsVectorLayer) or not isSameSchema(self.layer, layer):
+                continue
+            item = QListWidgetItem(layer.name())
+            item.setData(Qt.UserRole, layer.id())
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked if layer is self.layer else Qt.Unchecked)
+            self.layer_list.addItem(item)
+        self.layer_list.sortItems()
+
+    def setAllChecked(self, checked: bool):
+        for row in range(self.layer_list.count()):
+            self.layer_list.item(row).setCheckState(Qt.Checked if checked else Qt.Unchecked)
+
+    def checkedLayers(self) -> list:
+        layers = []
+        for row in range(self.layer_list.count()):
+            item = self.layer_list.item(row)
+            layer = QgsProject.instance().mapLayer(item.data(Qt.UserRole))
+            if item.checkState() == Qt.Checked and layer is not None:
+                layers.append(layer)
+        return layers
+
+    def run(self):
+        """
+        チェックしたレイヤごとにタスクを作成し、並行して抽出する
+        """
+        layers = self.checkedLayers()
+        if len(layers) == 0:
+            self.iface.messageBar().pushInfo("複数レイヤに適用", "対象レイヤを選択してください。")
+            return
+
+        self.cancelTasks()
+        self.model.clear()
+        self.generation += 1
+        self.layer_total = len(layers)
+        self.finished_count = 0
+        self.failed_count = 0
+
+        for layer in layers:
+            # 評価はレイヤを参照するため、作成はメインスレッドで行う
+            task = EasyAttributeFilterLayerTask(EasyAttributeFilterEngine(layer, self.expressions))
+            task.taskCompleted.connect(lambda task=task, generation=self.generation: self.onTaskCompleted(task, generation))
+            task.taskTerminated.connect(lambda task=task, generation=self.generation: self.onTaskTerminated(task, generation))
+            self.tasks.append(task)
+            QgsApplication.taskManager().addTask(task)
+        self.updateStatus()
+
+    def onTaskCompleted(self, task: EasyAttributeFilterLayerTask, generation: int):
+        if task in self.tasks:
+            self.tasks.remove(task)
+        if generation != self.generation:
+            return
+        self.model.addLayer(task.engine.layer, task.fids)
+        self.finished_count += 1
+        self.updateStatus()
+
+    def onTaskTerminated(self, task: EasyAttributeFilterLayerTask, generation: int):
+        if task in self.tasks:
+            self.tasks.remove(task)
+        if generation != self.generation:
+            return
+        self.failed_count += 1
+        self.updateStatus()
+
+    def cancelTasks(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def updateStatus(self):
+        text = f"{self.finished_count}/{self.layer_total}レイヤ完了 {self.model.rowCount():,}件"
+        if self.failed_count > 0:
+            text += f"（{self.failed_count}レイヤは中止・失敗）"
+        if len(self.tasks) > 0:
+            text += " 抽出中..."
+        self.status_label.setText(text)
+
+    def zoomToFeature(self, *args):
+        """
+        選択した行の地物を選択してズームする
+        """
+        index = self.table_view.currentIndex()
+        if not index.isValid():
+            return
+        layer, fid = self.model.featureAt(index.row())
+        layer.selectByIds([fid])
+        self.iface.mapCanvas().zoomToFeatureIds(layer, [fid])
+        self.iface.mapCanvas().flashFeatureIds(layer, [fid])
+
+    def onLayersWillBeRemoved(self, layer_ids):
+        """
+        対象のレイヤが削除される場合は結果をクリアする
+        """
+        if self.layer.id() in layer_ids:
+            self.close()
+            return
+
+        if any(layer.id() in layer_ids for layer in self.model.layers() + [task.engine.layer for task in self.tasks]):
+            self.cancelTasks()
+            self.generation += 1
+            self.model.clear()
+            self.status_label.setText("対象レイヤが削除されたため、結果をクリアしました")
+        for row in reversed(range(self.layer_list.count())):
+            if self.layer_list.item(row).data(Qt.UserRole) in layer_ids:
+                self.layer_list.takeItem(row)
+
+    def closeEvent(self, event):
+        self.cancelTasks()
+        self.generation += 1
+        self.model.clear()
+        if self.is_connected:
+            QgsProject.instance().layersWillBeRemoved.disconnect(self.onLayersWillBeRemoved)
+            self.is_connected = False
+        super(EasyAttributeFilterMultiLayerDialog, self).closeEvent(event)
@@ -10,21 +10,29 @@
 """
 import os
 import re
+import math
+from decimal import Decimal
 from typing import Union
 
 from qgis.PyQt import uic
 from qgis.PyQt import QtWidgets
-from qgis.PyQt.QtCore import Qt
-from qgis.PyQt.QtGui import QStandardItemModel, QStandardItem
+from qgis.PyQt.QtCore import Qt, QVariant, QRectF, QTimer
+from qgis.PyQt.QtGui import QStandardItemModel, QStandardItem, QPainter
 
-from qgis.core import QgsMessageLog, QgsApplication
+from qgis.core import QgsMessageLog, QgsApplication, QgsField
 from qgis.gui import QgsAttributeTableFilterModel
 
+from .easy_attribute_filter_column_cache import EasyAttributeFilterColumnCache
+from .easy_attribute_filter_match import EasyAttributeFilterMatchEstimator
+from .easy_attribute_filter_completer import EasyAttributeFilterValueCompleter
+from .easy_attribute_filter_engine import NUMERIC_OPERATORS, TEXT_OPERATORS, comparisonExpression
+
 FORM_CLASS, _ = uic.loadUiType(os.path.join(
     os.path.dirname(__file__), 'easy_attribute_filter_option_dialog_base.ui'))
 
-NUMERIC_OPERATORS = {"と等しい": "=","と等しくない": "!=","より大きい": ">","以上": ">=","より小さい": "<","以下": "<="}
-TEXT_OPERATORS  = {"で始まる": "LIKE '(value)%'","で始まらない": "NOT LIKE '(value)%'","で終わる": "LIKE '%(value)'","で終わらない": "NOT LIKE '%(value)'","を含む": "LIKE '%(value)%'","を含まない": "NOT LIKE '%(value)%'"}
+INTEGER_TYPES = (QVariant.Int, QVariant.UInt, QVariant.LongLong, QVariant.ULongLong)
+# 範囲スライダーの分割数
+RANGE_SLIDER_STEPS = 1000
 
 class EasyAttributeFilterOptionDialog(QtWidgets.QDialog, FORM_CLASS):
     
@@ -41,16 +49,43 @@ class EasyAttributeFilterOptionDialog(QtWidgets.QDialog, FORM_CLASS):
         self.expression = ""
 
         self.sample_model = QStandardItemModel(self)
+        self.completers = []
 
         self.setOperators()
 
-    def setValues(self, column: int, filter_model: QgsAttributeTableFilterModel, expression: str):
+        # 範囲フィルター（数値のみ）
+        self.numeric_column = None
+        self.numeric_column_task = None
+        self.is_integer = False
+        self.is_approximate = False
+        self.histogram_widget = RangeHistogramWidget(self)
+        self.range_layout.insertWidget(0, self.histogram_widget)
+        self.range_slider.setRangeLimits(0, RANGE_SLIDER_STEPS)
+        self.range_slider.rangeChanged.connect(self.onRangeChanged)
+        self.range_groupbox.setVisible(False)
+
+        # 一致する件数（入力が止まってから求める）
+        self.estimator = None
+        self.estimate_timer = QTimer(self)
+        self.estimate_timer.setSingleShot(True)
+        self.estimate_timer.setInterval(300)
+        self.estimate_timer.timeout.connect(self.updateMatchCount)
+        for combobox in (self.operator_combobox1, self.operator_combobox2):
+            combobox.currentIndexChanged.connect(lambda: self.estimate_timer.start())
+        for combobox in (self.value_combobox1, self.value_combobox2):
+            combobox.editTextChanged.connect(lambda: self.estimate_timer.start())
+        self.and_radiobutton.toggled.connect(lambda: self.estimate_timer.start())
+        self.finished.connect(lambda: self.setMatchEstimator(None))
+        self.finished.connect(self.cancelCompleters)
+
+    def setValues(self, column: int, filter_model: QgsAttributeTableFilterModel, expression: str, column_cache: EasyAttributeFilterColumnCache=None):
         """
         値を設定する
         
         @param  column:列番号
         @param  filter_model:フィルターモデル
         @param  expression:式
+        @param  column_cache:列データのキャッシュ
         """
         QgsApplication.setOverrideCursor(Qt.WaitCursor)
 
@@ -68,11 +103,10 @@ class EasyAttributeFilterOptionDialog(QtWidgets.QDialog, FORM_CLASS):
 
         self.sample_label.setText(self.field_name)
         
-        # 対象レイヤーから指定列の固有値を取得する
-        uniques = filter_model.layer().uniqueValues(field_index, self.max_count)
-
-        # データ件数超過の場合警告を表示する
-        data_count = len(uniques) 
+        # 一覧には先読み済みの固有値のみを表示し、レイヤからは読み込まない
+        summary = column_cache.summary(field_index) if column_cache is not None else None
+        uniques = summary.uniqueValues(self.max_count) if summary is not None else set()
+        uniques.discard(None)
 
         self.sample_model.setColumnCount(1)
 
@@ -80,19 +114,212 @@ class EasyAttributeFilterOptionDialog(QtWidgets.QDialog, FORM_CLASS):
         values = sorted(list(uniques))
         self.sample_model.appendRow(QStandardItem(""))
 
-        for row in range(0, data_count):
-            item = QStandardItem(str(values[row]))
+        for value in values:
+            item = QStandardItem(str(value))
             self.sample_model.appendRow(item)
         
         self.value_combobox1.setModel(self.sample_model)
         self.value_combobox2.setModel(self.sample_model)
 
+        # 入力中の文字列に前方一致する値を補完する
+        self.cancelCompleters()
+        column_store = column_cache.usableColumnStore(field_index) if column_cache is not None else None
+        self.completers = []
+        for combobox in (self.value_combobox1, self.value_combobox2):
+            completer = EasyAttributeFilterValueCompleter(filter_model.layer(), field_index, column_store, self)
+            completer.attach(combobox)
+            self.completers.append(completer)
+
         # テキスト式入力欄を作成する
         self.setTextExpression(expression)
 
+        # 範囲フィルターを作成する
+        self.setRangeFilter(field_index, field, column_cache)
+
         QgsApplication.restoreOverrideCursor()
 
 
+    def cancelCompleters(self):
+        """
+        補完候補の取得を中止する
+        """
+        for completer in self.completers:
+            completer.cancel()
+
+
+    def setRangeFilter(self, field_index: int, field: QgsField, column_cache: EasyAttributeFilterColumnCache):
+        """
+        範囲フィルターを設定する
+
+        @param  field_index:フィールドindex
+        @param  field:フィールド
+        @param  column_cache:列データのキャッシュ
+        """
+        self.numeric_column = None
+        self.numeric_column_task = None
+        if self.is_numeric == False or column_cache is None:
+            self.range_groupbox.setVisible(False)
+            return
+
+        self.numeric_column = column_cache.numericColumn(field_index)
+        if self.numeric_column is None:
+            # レイヤ全体の集計はバックグラウンドで行い、完了後に範囲フィルターを表示する
+            self.range_groupbox.setVisible(False)
+            task = column_cache.loadNumericColumn(field_index)
+            self.numeric_column_task = task
+            task.taskCompleted.connect(lambda: self.onNumericColumnLoaded(task, field_index, field, column_cache))
+            return
+
+        self.is_approximate = column_cache.isApproximate(field_index)
+        if self.numeric_column.count() == 0:
+            self.numeric_column = None
+            self.range_groupbox.setVisible(False)
+            return
+
+        self.is_integer = field.type() in INTEGER_TYPES
+        self.histogram_widget.setHistogram(self.numeric_column.histogram)
+        self.range_groupbox.setVisible(True)
+
+        # 現在の条件が範囲指定の場合はスライダーに反映する
+        lower, upper = self.currentRange()
+        lower_position = self.sliderPosition(lower)
+        upper_position = self.sliderPosition(upper)
+        self.range_slider.blockSignals(True)
+        self.range_slider.setRange(lower_position, upper_position)
+        self.range_slider.blockSignals(False)
+        self.histogram_widget.setSelection(lower_position / RANGE_SLIDER_STEPS, upper_position / RANGE_SLIDER_STEPS)
+        self.updateRangeCount(lower, upper)
+
+    def onNumericColumnLoaded(self, task, field_index: int, field: QgsField, column_cache: EasyAttributeFilterColumnCache):
+        """
+        数値列の集計完了時に範囲フィルターを表示する（別の列を表示中の場合は何もしない）
+        """
+        if self.numeric_column_task is not task or not self.isVisible():
+            return
+        self.numeric_column_task = None
+        if column_cache.numericColumn(field_index) is not None:
+            self.setRangeFilter(field_index, field, column_cache)
+
+    def currentRange(self):
+        """
+        入力中の条件から範囲を取得する
+
+        @return (下限, 上限) 範囲指定でない場合は最小値と最大値
+        """
+        full_range = (self.numeric_column.minimum, self.numeric_column.maximum)
+        if self.operator_combobox1.currentText() != "以上" or self.operator_combobox2.currentText() != "以下" or not self.and_radiobutton.isChecked():
+            return full_range
+        try:
+            return (float(self.value_combobox1.currentText()), float(self.value_combobox2.currentText()))
+        except ValueError:
+            return full_range
+
+    def sliderPosition(self, value: float) -> int:
+        """
+        値に対応するスライダーの位置を取得する
+        """
+        width = self.numeric_column.maximum - self.numeric_column.minimum
+        if width <= 0:
+            return 0 if value <= self.numeric_column.minimum else RANGE_SLIDER_STEPS
+        position = round(RANGE_SLIDER_STEPS * (value - self.numeric_column.minimum) / width)
+        return min(max(position, 0), RANGE_SLIDER_STEPS)
+
+    def rangeValueText(self, position: int, is_lower: bool) -> str:
+        """
+        スライダーの位置に対応する値の文字列を取得する
+
+        @param  position:スライダーの位置
+        @param  is_lower:下限かどうか
+        """
+        if position <= 0:
+            value = self.numeric_column.minimum
+        elif position >= RANGE_SLIDER_STEPS:
+            value = self.numeric_column.maximum
+        else:
+            value = self.numeric_column.minimum + (self.numeric_column.maximum - self.numeric_column.minimum) * position / RANGE_SLIDER_STEPS
+
+        if self.is_integer:
+            return str(math.ceil(value) if is_lower else math.floor(value))
+        # 値を丸めず、指数表記にもしない（式のリテラルとして使用する）
+        return format(Decimal(repr(value)), "f")
+
+    def onRangeChanged(self, lower_position: int, upper_position: int):
+        """
+        範囲スライダー変更時に条件と該当件数を更新する
+        """
+        lower_text = self.rangeValueText(lower_position, True)
+        upper_text = self.rangeValueText(upper_position, False)
+
+        self.value_combobox1.setEditText(lower_text)
+        self.operator_combobox1.setCurrentIndex(self.operator_combobox1.findText("以上"))
+        self.and_radiobutton.setChecked(True)
+        self.value_combobox2.setEditText(upper_text)
+        self.operator_combobox2.setCurrentIndex(self.operator_combobox2.findText("以下"))
+
+        self.histogram_widget.setSelection(lower_position / RANGE_SLIDER_STEPS, upper_position / RANGE_SLIDER_STEPS)
+        self.updateRangeCount(float(lower_text), float(upper_text))
+
+    def updateRangeCount(self, lower: float, upper: float):
+        """
+        範囲に該当する件数を表示する
+        """
+        count = self.numeric_column.countInRange(lower, upper)
+        text = f"{count:,}件 / {self.numeric_column.count():,}件（NULLを除く）"
+        if self.is_approximate:
+            text += "　※プレビュー中の標本からの概算"
+        self.range_count_label.setText(text)
+
+
+    def setMatchEstimator(self, estimator: EasyAttributeFilterMatchEstimator):
+        """
+        一致する件数を求めるオブジェクトを設定する
+
+        @param  estimator:件数を求めるオブジェクト（表示しない場合はNone）
+        """
+        self.estimate_timer.stop()
+        if self.estimator is not None:
+            self.estimator.cancel()
+            self.estimator.estimated.disconnect(self.onEstimated)
+            self.estimator.deleteLater()
+        self.estimator = estimator
+        self.match_count_label.setText("")
+        if estimator is not None:
+            estimator.estimated.connect(self.onEstimated)
+            self.estimate_timer.start()
+
+    def updateMatchCount(self):
+        """
+        入力中の条件に一致する件数を求める
+        """
+        if self.estimator is None:
+            return
+
+        if self.is_numeric:
+            # 数値として解釈できない入力は対象外
+            for value_combobox, operator_combobox in ((self.value_combobox1, self.operator_combobox1), (self.value_combobox2, self.operator_combobox2)):
+                value = value_combobox.currentText()
+                if value_combobox is self.value_combobox2 and (len(value) == 0 or len(operator_combobox.currentText()) == 0):
+                    continue
+                try:
+                    float(value)
+                except ValueError:
+                    self.estimator.cancel()
+                    self.match_count_label.setText("")
+                    return
+
+        self.match_count_label.setText("一致する件数を集計中…")
+        self.estimator.estimate(self.currentExpression())
+
+    def onEstimated(self, count: int, is_exact: bool):
+        """
+        一致する件数を表示する
+        """
+        if is_exact:
+            self.match_count_label.setText(f"{count:,}件が一致します")
+        else:
+            self.match_count_label.setText(f"約{count:,}件が一致します（概算）")
+
+
     def fieldFromColumn(self, column: int, filter_model: QgsAttributeTableFilterModel) :
         """
         属性indexと属性を取得する
@@ -139,14 +366,24 @@ class EasyAttributeFilterOptionDialog(QtWidgets.QDialog, FORM_CLASS):
             return
 
         # 式を生成する
-        self.expression = self.createExpression(self.operator_combobox1.currentText(), self.value_combobox1.currentText())
+        self.expression = self.currentExpression()
+
+        return super().accept()
+
+    def currentExpression(self) -> str:
+        """
+        入力中の条件から式を生成する
+
+        @return 式
+        """
+        expression = self.createExpression(self.operator_combobox1.currentText(), self.value_combobox1.currentText())
 
         if len(self.value_combobox2.currentText()) > 0 and len(self.operator_combobox2.currentText()) > 0:
             logical_operator = "AND" if self.and_radiobutton.isChecked() else "OR"
 
-            self.expression += f" {logical_operator} {self.createExpression(self.operator_combobox2.currentText(), self.value_combobox2.currentText())}"
+            expression += f" {logical_operator} {self.createExpression(self.operator_combobox2.currentText(), self.value_combobox2.currentText())}"
 
-        return super().accept()
+        return expression
     
     def createExpression(self, operator: str, value: str) -> str:
         """
@@ -157,18 +394,7 @@ class EasyAttributeFilterOptionDialog(QtWidgets.QDialog, FORM_CLASS):
 
         @return 式
         """
-        if operator in NUMERIC_OPERATORS:
-            return f"\"{self.field_name}\" {NUMERIC_OPERATORS[operator]} {self.enclosedQuotes(value)}"
-
-        elif operator in TEXT_OPERATORS:
-            pattern = TEXT_OPERATORS[operator]
-            like_pattern = pattern.replace("(value)", value)
-            return f"\"{self.field_name}\" {like_pattern}"
-
-        return ""
-
-    def enclosedQuotes(self, value):
-        return value if self.is_numeric else f"'{value}'"
+        return comparisonExpression(self.field_name, operator, value, self.is_numeric)
 
     def checkInput(self) -> bool:
         """
@@ -282,3 +508,48 @@ class EasyAttributeFilterOptionDialog(QtWidgets.QDialog, FORM_CLASS):
 
         value_combobox.setCurrentText("")
         operator_combobox.setCurrentIndex(0)
+
+
+class RangeHistogramWidget(QtWidgets.QWidget):
+    """
+    範囲フィルター用のヒストグラム
+    """
+    def __init__(self, parent=None):
+        super(RangeHistogramWidget, self).__init__(parent)
+        self.histogram = []
+        self.lower = 0.0
+        self.upper = 1.0
+        self.setMinimumHeight(40)
+
+    def setHistogram(self, histogram: list):
+        """
+        階級ごとの件数を設定する
+        """
+        self.histogram = histogram
+        self.update()
+
+    def setSelection(self, lower: float, upper: float):
+        """
+        選択範囲（0～1の割合）を設定する
+        """
+        self.lower = lower
+        self.upper = upper
+        self.update()
+
+    def paintEvent(self, event):
+        if len(self.histogram) == 0:
+            return
+
+        peak = max(self.histogram)
+        if peak == 0:
+            return
+
+        painter = QPainter(self)
+        bin_count = len(self.histogram)
+        bin_width = self.width() / bin_count
+        for index, count in enumerate(self.histogram):
+            height = self.height() * count / peak
+            center = (index + 0.5) / bin_count
+            color = self.palette().highlight().color() if self.lower <= center <= self.upper else self.palette().mid().color()
+            painter.fillRect(QRectF(index * bin_width, self.height() - height, max(bin_width - 1, 1), height), color)
+        painter.end()
@@ -0,0 +1,303 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterPlanner
+                                 A QGIS plugin
+ レイヤの規模とプロバイダの機能に応じた実行方式の選択
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+ 地物数・プロバイダの種類・機能（地物IDでのアクセス）・各フィルター式を
+ プロバイダ側で評価できるかをもとに、読み込みと抽出の方式を推定コストで選ぶ。
+ 推定コストは相対的な目安（ミリ秒相当）であり、実測値ではない。
+"""
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import Qgis, QgsMessageLog, QgsSettings, QgsVectorDataProvider, QgsVectorLayer, QgsFeatureRequest
+
+from .easy_attribute_filter_predicate import parsePredicate
+
+# 読み込みの方式
+LOAD_MEMORY = "memory"
+LOAD_PAGED = "paged"
+LOAD_PREVIEW = "preview"
+# 抽出の方式
+FILTER_INDEX = "index"
+FILTER_COLUMNAR = "columnar"
+FILTER_SQL = "sql"
+FILTER_PUSHDOWN = "pushdown"
+FILTER_MEMORY = "memory"
+FILTER_MATERIALIZED = "materialized"
+
+ENGINE_NAMES = {
+    LOAD_MEMORY: "全件をメモリに読み込み",
+    LOAD_PAGED: "必要な行のみ読み込み",
+    LOAD_PREVIEW: "標本を表示し全件は後から取得",
+    FILTER_INDEX: "全文索引",
+    FILTER_COLUMNAR: "ディスクキャッシュ",
+    FILTER_SQL: "SQL",
+    FILTER_PUSHDOWN: "プロバイダで抽出",
+    FILTER_MATERIALIZED: "計算列のキャッシュ",
+}
+FILTER_MEMORY_NAME = "読み込み済みの行で判定"
+
+# フィルター式をコンパイルしてデータソース側で評価できるプロバイダ
+PUSHDOWN_PROVIDERS = ("postgres", "ogr", "spatialite", "mssql", "oracle", "hana")
+
+# 推定コストの係数（ミリ秒相当）
+ROW_FETCH_COST = 0.002          # 1行の1属性をプロバイダから読み込む
+ROW_EVALUATE_COST = 0.003       # 読み込み済みの1行で式を評価する
+PROVIDER_QUERY_COST = 20.0      # プロバイダへの問い合わせ1回
+PROVIDER_SCAN_COST = 0.0005     # プロバイダ側で1行を評価する
+COLUMN_SCAN_COST = 0.00002      # 列データの1行を判定する
+
+# 1行あたりのメモリ使用量の推定（バイト）
+FEATURE_BYTES = 120             # 地物1件（ジオメトリなし）
+VARIANT_BYTES = 24              # 属性値1件
+# 1行あたりのメモリ使用量を推定するために読み込む行数
+ROW_SAMPLE_COUNT = 200
+# レイヤキャッシュの最小行数
+MIN_CACHE_ROWS = 1000
+
+# ログのタグ
+LOG_TAG = "EasyAttributeFilter"
+
+
+def logPlan(text: str):
+    """
+    選択した方式をログに出力する
+    """
+    QgsMessageLog.logMessage(text, LOG_TAG, Qgis.Info)
+
+
+class LoadPlan:
+    """
+    読み込みの方式
+    """
+
+    def __init__(self, engine: str, cost: float, full_cache: bool, reason: str):
+        """
+        コンストラクタ
+
+        @param  engine:方式
+        @param  cost:推定コスト
+        @param  full_cache:全地物をキャッシュするか
+        @param  reason:選んだ理由
+        """
+        self.engine = engine
+        self.cost = cost
+        self.full_cache = full_cache
+        self.reason = reason
+
+    def description(self) -> str:
+        return f"読み込み：{ENGINE_NAMES[self.engine]}（推定{self.cost:,.0f}ms、{self.reason}）"
+
+
+class FilterPlan:
+    """
+    抽出の方式（フィルター式ごとの方式と推定コスト）
+    """
+
+    def __init__(self):
+        # [(フィルター式, 方式, 推定コスト)]
+        self.steps = []
+
+    def add(self, expression: str, engine: str, cost: float):
+        self.steps.append((expression, engine, cost))
+
+    def expressions(self, engine: str) -> list:
+        """
+        指定した方式で抽出するフィルター式
+        """
+        return [expression for expression, step_engine, _ in self.steps if step_engine == engine]
+
+    def cost(self) -> float:
+        return sum(cost for _, _, cost in self.steps)
+
+    def summary(self) -> str:
+        """
+        方式の一覧（重複を除く）
+        """
+        names = []
+        for _, engine, _ in self.steps:
+            name = ENGINE_NAMES.get(engine, FILTER_MEMORY_NAME)
+            if name not in names:
+                names.append(name)
+        return "・".join(names)
+
+    def description(self) -> str:
+        lines = [f"抽出：{self.summary()}（推定{self.cost():,.0f}ms）"]
+        for expression, engine, cost in self.steps:
+            lines.append(f"  {ENGINE_NAMES.get(engine, FILTER_MEMORY_NAME)}（推定{cost:,.1f}ms）：{expression}")
+        return "\n".join(lines)
+
+
+class EasyAttributeFilterPlanner:
+    """
+    読み込みと抽出の方式を選ぶ
+    """
+
+    def __init__(self, layer: QgsVectorLayer):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        """
+        self.layer = layer
+        self.provider_name = layer.dataProvider().name() if layer.dataProvider() is not None else ""
+        self.row_bytes = None
+
+    def featureCount(self) -> int:
+        count = self.layer.featureCount()
+        # 件数が不明なプロバイダは大規模とみなす
+        return count if count >= 0 else 10 ** 7
+
+    def canSelectAtId(self) -> bool:
+        provider = self.layer.dataProvider()
+        return provider is not None and bool(QgsVectorDataProvider.SelectAtId & provider.capabilities())
+
+    def attributeWidth(self) -> int:
+        """
+        1行あたりの属性の数（文字列は長さに応じて重み付けする）
+        """
+        width = 0
+        for field in self.layer.fields():
+            if field.type() == QVariant.String:
+                width += max(1, min(field.length(), 256) // 16) if field.length() > 0 else 4
+            else:
+                width += 1
+        return max(width, 1)
+
+    def estimatedRowBytes(self) -> int:
+        """
+        レイヤキャッシュの1行あたりのメモリ使用量を推定する
+
+        先頭の行を読み込んで文字列の長さを実測する（行がない場合はフィールド定義から推定する）。
+        """
+        if self.row_bytes is not None:
+            return self.row_bytes
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setLimit(ROW_SAMPLE_COUNT)
+
+        total = 0
+        count = 0
+        for feature in self.layer.getFeatures(request):
+            total += FEATURE_BYTES
+            for value in feature.attributes():
+                total += VARIANT_BYTES
+                if isinstance(value, (str, bytes)):
+                    # 文字列はUTF-16で保持される
+                    total += 2 * len(value)
+            count += 1
+
+        if count > 0:
+            self.row_bytes = total // count
+        else:
+            self.row_bytes = FEATURE_BYTES + self.attributeWidth() * VARIANT_BYTES
+        return self.row_bytes
+
+    def adaptiveCacheSize(self, memory_budget: int) -> int:
+        """
+        メモリの上限と1行あたりの推定メモリ使用量からレイヤキャッシュの行数を求める
+
+        全行が上限に収まる場合は地物数を返す。
+
+        @param  memory_budget:メモリの上限（バイト）
+        """
+        rows = memory_budget // max(self.estimatedRowBytes(), 1)
+        return max(MIN_CACHE_ROWS, min(rows, self.featureCount()))
+
+    def planLoad(self, cache_size: int, preview_enabled: bool, preview_feature_count: int, preview_row_count: int,
+                 compact: bool=False) -> LoadPlan:
+        """
+        読み込みの方式を選ぶ
+
+        @param  cache_size:レイヤキャッシュの行数
+        @param  preview_enabled:プレビュー表示を使うか
+        @param  preview_feature_count:プレビュー表示を行う地物数
+        @param  preview_row_count:プレビュー表示する地物数
+        @param  compact:属性値を列ごとの型付き配列で保持するか
+        """
+        count = self.featureCount()
+        width = self.attributeWidth()
+        full_cost = count * width * ROW_FETCH_COST
+
+        if preview_enabled and count > preview_feature_count:
+            cost = preview_row_count * width * ROW_FETCH_COST
+            return LoadPlan(LOAD_PREVIEW, cost, False, f"{count:,}件は{preview_feature_count:,}件を超えるため")
+
+        if not self.canSelectAtId():
+            return LoadPlan(LOAD_MEMORY, full_cost, True, "地物IDでアクセスできないため")
+        if cache_size == 0:
+            return LoadPlan(LOAD_MEMORY, full_cost, True, "キャッシュサイズが0のため")
+        if compact and cache_size < count:
+            cost = count * ROW_FETCH_COST + cache_size * width * ROW_FETCH_COST
+            return LoadPlan(LOAD_PAGED, cost, False, "属性値は列ごとにコンパクトに保持するため")
+        if count <= cache_size:
+            return LoadPlan(LOAD_MEMORY, full_cost, True, f"{count:,}件はキャッシュに収まるため")
+
+        # 地物IDの一覧と表示中の行のみを読み込む
+        cost = count * ROW_FETCH_COST + cache_size * width * ROW_FETCH_COST
+        return LoadPlan(LOAD_PAGED, cost, False, f"{count:,}件はキャッシュの{cache_size:,}件を超えるため")
+
+    def canPushDown(self, expression: str) -> bool:
+        """
+        フィルター式をプロバイダ側で評価できるか判定する
+
+        式のコンパイル設定が有効で、プラグインが作成する単純な条件のみの場合に限る。
+        """
+        if self.provider_name not in PUSHDOWN_PROVIDERS:
+            return False
+        if not QgsSettings().value("qgis/compileExpressions", True, type=bool):
+            return False
+        return parsePredicate(expression) is not None
+
+    def planFilter(self, expressions: list, load_plan: LoadPlan, column_store=None, sql_backend=None, fts_index=None,
+                   virtual_columns=None) -> FilterPlan:
+        """
+        フィルター式ごとに抽出の方式を選ぶ
+
+        @param  expressions:フィルター式のリスト
+        @param  load_plan:読み込みの方式
+        @param  column_store:列データのディスクキャッシュ
+        @param  sql_backend:GeoPackage/SQLiteのSQL
+        @param  fts_index:全文索引
+        @param  virtual_columns:式によるフィールドの値の保持
+        """
+        plan = FilterPlan()
+        count = self.featureCount()
+        store_usable = column_store is not None and column_store.isUsable()
+        sql_usable = sql_backend is not None and sql_backend.isUsable()
+
+        for expression in expressions:
+            if fts_index is not None and fts_index.canAnswer(expression):
+                plan.add(expression, FILTER_INDEX, PROVIDER_QUERY_COST / 4)
+                continue
+
+            predicate = parsePredicate(expression)
+            if predicate is not None and store_usable and all(column_store.hasField(field) for field in predicate.fields()):
+                plan.add(expression, FILTER_COLUMNAR, count * COLUMN_SCAN_COST)
+                continue
+            if predicate is not None and sql_usable and sql_backend.translate(predicate) is not None:
+                plan.add(expression, FILTER_SQL, PROVIDER_QUERY_COST + count * PROVIDER_SCAN_COST)
+                continue
+            if predicate is not None and virtual_columns is not None and all(virtual_columns.isVirtualField(field) for field in predicate.fields()):
+                # 式によるフィールドは初回のみ全地物で評価し、以降は保持した値で判定する
+                cost = count * COLUMN_SCAN_COST
+                cost += sum(count * ROW_EVALUATE_COST for field in predicate.fields() if not virtual_columns.isMaterialized(field))
+                plan.add(expression, FILTER_MATERIALIZED, cost)
+                continue
+
+            # 読み込み済みの行で判定するか、プロバイダで抽出するかを推定コストで選ぶ
+            memory_cost = count * ROW_EVALUATE_COST
+            if not load_plan.full_cache:
+                # キャッシュにない行は読み込み直す
+                memory_cost += count * len(predicate.fields() if predicate is not None else [1]) * ROW_FETCH_COST
+            pushdown_cost = PROVIDER_QUERY_COST + count * PROVIDER_SCAN_COST
+            if self.canPushDown(expression) and pushdown_cost < memory_cost:
+                plan.add(expression, FILTER_PUSHDOWN, pushdown_cost)
+            else:
+                plan.add(expression, FILTER_MEMORY, memory_cost)
+
+        return plan
@@ -0,0 +1,391 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterPredicate
+                                 A QGIS plugin
+ フィルター式の解析
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+ プラグインが作成するフィルター式（値の一覧、比較、LIKE、日付の範囲）を解析し、
+ 構造化した条件に変換する。Qtに依存しないため、バックグラウンド処理からも使用できる。
+"""
+import re
+import datetime
+from abc import ABC, abstractmethod
+
+COMPARISON_OPERATORS = ("=", "!=", ">=", "<=", ">", "<")
+
+FIELD_PATTERN = r'"(?P<field>[^"]+)"'
+# 文字列リテラル（QGISの式と同じく''と\n・\t・\\・\'のエスケープを含む）
+STRING_LITERAL_PATTERN = r"'(?:[^'\\]|\\.|'')*'"
+LITERAL_PATTERN = f"{STRING_LITERAL_PATTERN}|[-+]?(?:\\d+\\.?\\d*|\\.\\d+)(?:[eE][-+]?\\d+)?"
+# エスケープされる文字
+STRING_ESCAPES = {"n": "\n", "t": "\t", "\\": "\\", "'": "'"}
+
+IN_PATTERN = re.compile(f"{FIELD_PATTERN} IN \\((?P<values>.*)\\)")
+IN_WITH_NULL_PATTERN = re.compile(f"\\({FIELD_PATTERN} IN \\((?P<values>.*)\\) OR \"(?P=field)\" IS NULL\\)")
+NULL_PATTERN = re.compile(f"{FIELD_PATTERN} IS NULL")
+COMPARISON_PATTERN = re.compile(f"{FIELD_PATTERN} (?P<operator>!=|>=|<=|=|>|<) (?P<value>{LITERAL_PATTERN})")
+LIKE_PATTERN = re.compile(f"{FIELD_PATTERN} (?P<operator>NOT LIKE|LIKE) (?P<value>{STRING_LITERAL_PATTERN})")
+DATE_RANGE_PATTERN = re.compile(f"\\({FIELD_PATTERN} >= to_date(?:time)?\\('(?P<start>\\d{{4}}-\\d{{2}}-\\d{{2}})[^']*'\\) AND \"(?P=field)\" < to_date(?:time)?\\('(?P<end>\\d{{4}}-\\d{{2}}-\\d{{2}})[^']*'\\)\\)")
+LITERAL_LIST_PATTERN = re.compile(f"(?:{LITERAL_PATTERN})(?:,(?:{LITERAL_PATTERN}))*")
+LITERAL_TOKEN_PATTERN = re.compile(LITERAL_PATTERN)
+
+
+def parseLiteral(text: str):
+    """
+    リテラルを値に変換する
+
+    @param  text:文字列リテラル（'...'）または数値
+    """
+    if text.startswith("'"):
+        # QGISの式と同じ順でエスケープを戻す（不明なエスケープは?とする）
+        text = text[1:-1].replace("''", "'")
+        return re.sub(r"\\(.)", lambda matched: STRING_ESCAPES.get(matched.group(1), "?"), text)
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def quoteLiteral(value) -> str:
+    """
+    値をリテラルに変換する（文字列はQgsExpression.quotedStringと同じくエスケープする）
+    """
+    if isinstance(value, str):
+        text = value.replace("'", "''").replace("\\", "\\\\").replace("\n", "\\n").replace("\t", "\\t")
+        return f"'{text}'"
+    return str(value)
+
+
+def likeToRegex(pattern: str):
+    """
+    LIKEのパターンを正規表現に変換する
+    """
+    parts = []
+    for char in pattern:
+        if char == "%":
+            parts.append(".*")
+        elif char == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(char))
+    return re.compile("".join(parts), re.DOTALL)
+
+
+def toComparable(value, other):
+    """
+    比較できるよう値の型を揃える
+    """
+    if isinstance(other, (int, float)) and isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    if isinstance(other, str) and not isinstance(value, str):
+        return str(value)
+    return value
+
+
+def compareValues(value, operator: str, other) -> bool:
+    """
+    比較演算を行う（NULLは常に不一致）
+    """
+    if value is None:
+        return False
+
+    value = toComparable(value, other)
+    try:
+        if operator == "=":
+            return value == other
+        if operator == "!=":
+            return value != other
+        if operator == ">":
+            return value > other
+        if operator == ">=":
+            return value >= other
+        if operator == "<":
+            return value < other
+        if operator == "<=":
+            return value <= other
+    except TypeError:
+        return False
+    return False
+
+
+class Predicate(ABC):
+    """
+    条件の基底クラス
+    """
+
+    def fields(self) -> set:
+        """
+        条件が参照するフィールド名
+        """
+        return set()
+
+    @abstractmethod
+    def matches(self, attributes: dict) -> bool:
+        """
+        属性値が条件に一致するか判定する
+
+        @param  attributes:{フィールド名: 値}（NULLはNone、日付はdatetime.date/datetime.datetime）
+        """
+
+    @abstractmethod
+    def expression(self) -> str:
+        """
+        QGISの式に変換する
+        """
+
+
+class FieldPredicate(Predicate):
+    """
+    1つのフィールドに対する条件
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+
+    def fields(self) -> set:
+        return {self.field}
+
+    def quotedField(self) -> str:
+        return f'"{self.field}"'
+
+
+class ValueSetPredicate(FieldPredicate):
+    """
+    値の一覧に含まれる（"フィールド" IN (...)）
+    """
+
+    def __init__(self, field: str, values: list, include_null: bool=False):
+        super(ValueSetPredicate, self).__init__(field)
+        self.values = values
+        self.include_null = include_null
+        self.value_set = set(values)
+
+    def matches(self, attributes: dict) -> bool:
+        value = attributes.get(self.field)
+        if value is None:
+            return self.include_null
+        if value in self.value_set:
+            return True
+        # 数値と文字列の表記ゆれ
+        return any(compareValues(value, "=", candidate) for candidate in self.values if type(candidate) != type(value))
+
+    def expression(self) -> str:
+        values_joined = ",".join(quoteLiteral(value) for value in self.values)
+        if len(self.values) == 0:
+            return f"{self.quotedField()} IS NULL" if self.include_null else "FALSE"
+        if self.include_null:
+            return f"({self.quotedField()} IN ({values_joined}) OR {self.quotedField()} IS NULL)"
+        return f"{self.quotedField()} IN ({values_joined})"
+
+
+class NullPredicate(FieldPredicate):
+    """
+    NULLである
+    """
+
+    def matches(self, attributes: dict) -> bool:
+        return attributes.get(self.field) is None
+
+    def expression(self) -> str:
+        return f"{self.quotedField()} IS NULL"
+
+
+class ComparisonPredicate(FieldPredicate):
+    """
+    比較（=, !=, >, >=, <, <=）
+    """
+
+    def __init__(self, field: str, operator: str, value):
+        super(ComparisonPredicate, self).__init__(field)
+        self.operator = operator
+        self.value = value
+
+    def matches(self, attributes: dict) -> bool:
+        return compareValues(attributes.get(self.field), self.operator, self.value)
+
+    def expression(self) -> str:
+        return f"{self.quotedField()} {self.operator} {quoteLiteral(self.value)}"
+
+
+class LikePredicate(FieldPredicate):
+    """
+    パターンに一致する（LIKE / NOT LIKE）
+    """
+
+    def __init__(self, field: str, pattern: str, negate: bool=False):
+        super(LikePredicate, self).__init__(field)
+        self.pattern = pattern
+        self.negate = negate
+        self.regex = likeToRegex(pattern)
+
+    def matchesText(self, text: str) -> bool:
+        """
+        文字列がパターンに一致するか判定する（NOT LIKEの場合は否定）
+        """
+        return (self.regex.fullmatch(text) is not None) != self.negate
+
+    def matches(self, attributes: dict) -> bool:
+        value = attributes.get(self.field)
+        if value is None:
+            return False
+        return self.matchesText(str(value))
+
+    def expression(self) -> str:
+        operator = "NOT LIKE" if self.negate else "LIKE"
+        return f"{self.quotedField()} {operator} {quoteLiteral(self.pattern)}"
+
+
+class DateRangePredicate(FieldPredicate):
+    """
+    日付の範囲（開始日以上、終了日未満）のいずれかに含まれる
+    """
+
+    def __init__(self, field: str, ranges: list, include_null: bool=False, is_datetime: bool=False):
+        super(DateRangePredicate, self).__init__(field)
+        self.ranges = ranges
+        self.include_null = include_null
+        self.is_datetime = is_datetime
+
+    def matches(self, attributes: dict) -> bool:
+        value = attributes.get(self.field)
+        if value is None:
+            return self.include_null
+        if isinstance(value, datetime.datetime):
+            value = value.date()
+        return any(start <= value < end for start, end in self.ranges)
+
+    def expression(self) -> str:
+        if self.is_datetime:
+            literal = lambda date: f"to_datetime('{date.isoformat()} 00:00:00')"
+        else:
+            literal = lambda date: f"to_date('{date.isoformat()}')"
+        conditions = [f"{self.quotedField()} >= {literal(start)} AND {self.quotedField()} < {literal(end)}" for start, end in self.ranges]
+        if self.include_null:
+            conditions.append(f"{self.quotedField()} IS NULL")
+        return "(" + " OR ".join(f"({condition})" for condition in conditions) + ")"
+
+
+class LogicalPredicate(Predicate):
+    """
+    条件の論理結合（AND / OR）
+    """
+
+    def __init__(self, operator: str, children: list):
+        self.operator = operator
+        self.children = children
+
+    def fields(self) -> set:
+        fields = set()
+        for child in self.children:
+            fields |= child.fields()
+        return fields
+
+    def matches(self, attributes: dict) -> bool:
+        if self.operator == "AND":
+            return all(child.matches(attributes) for child in self.children)
+        return any(child.matches(attributes) for child in self.children)
+
+    def expression(self) -> str:
+        return "(" + f" {self.operator} ".join(child.expression() for child in self.children) + ")"
+
+
+def parseSimplePredicate(expression: str):
+    """
+    比較・LIKE・NULLの条件を解析する
+    """
+    matched = COMPARISON_PATTERN.fullmatch(expression)
+    if matched:
+        return ComparisonPredicate(matched.group("field"), matched.group("operator"), parseLiteral(matched.group("value")))
+
+    matched = LIKE_PATTERN.fullmatch(expression)
+    if matched:
+        return LikePredicate(matched.group("field"), parseLiteral(matched.group("value")), matched.group("operator") == "NOT LIKE")
+
+    matched = NULL_PATTERN.fullmatch(expression)
+    if matched:
+        return NullPredicate(matched.group("field"))
+
+    return None
+
+
+def parseValueSetPredicate(expression: str):
+    """
+    値の一覧の条件を解析する
+    """
+    matched = IN_WITH_NULL_PATTERN.fullmatch(expression)
+    include_null = matched is not None
+    if matched is None:
+        matched = IN_PATTERN.fullmatch(expression)
+    if matched is None:
+        return None
+
+    values_text = matched.group("values")
+    if LITERAL_LIST_PATTERN.fullmatch(values_text) is None:
+        return None
+
+    values = [parseLiteral(token) for token in LITERAL_TOKEN_PATTERN.findall(values_text)]
+    return ValueSetPredicate(matched.group("field"), values, include_null)
+
+
+def parseDateRangePredicate(expression: str):
+    """
+    日付の範囲の条件を解析する
+    """
+    if not (expression.startswith("((") and expression.endswith(")")):
+        return None
+
+    conditions = expression[1:-1].split(" OR ")
+    field = None
+    ranges = []
+    include_null = False
+    for condition in conditions:
+        matched = DATE_RANGE_PATTERN.fullmatch(condition)
+        if matched:
+            if field is not None and field != matched.group("field"):
+                return None
+            field = matched.group("field")
+            ranges.append((datetime.date.fromisoformat(matched.group("start")), datetime.date.fromisoformat(matched.group("end"))))
+            continue
+
+        matched = re.fullmatch(f"\\({NULL_PATTERN.pattern}\\)", condition)
+        if matched and (field is None or field == matched.group("field")):
+            field = matched.group("field")
+            include_null = True
+            continue
+        return None
+
+    if field is None:
+        return None
+    return DateRangePredicate(field, ranges, include_null, "to_datetime(" in expression)
+
+
+def parsePredicate(expression: str):
+    """
+    プラグインが作成したフィルター式を解析する
+
+    @param  expression:フィルター式
+    @return 条件（解析できない式はNone）
+    """
+    expression = expression.strip()
+    if len(expression) == 0:
+        return None
+
+    for parser in (parseValueSetPredicate, parseDateRangePredicate, parseSimplePredicate):
+        predicate = parser(expression)
+        if predicate is not None:
+            return predicate
+
+    # 2つの条件の結合（テキストフィルター）
+    for matched in re.finditer(" (AND|OR) ", expression):
+        left = parseSimplePredicate(expression[:matched.start()])
+        right = parseSimplePredicate(expression[matched.end():])
+        if left is not None and right is not None:
+            return LogicalPredicate(matched.group(1), [left, right])
+
+    return None
@@ -0,0 +1,353 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterProvider
+                                 A QGIS plugin
+ 検索簡易フィルターのプロセシングアルゴリズム
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+ ダイアログと同じフィルターの評価（EasyAttributeFilterEngine）をプロセシングから使用する。
+ 複数の入力レイヤはスレッドで並行して評価するため、バッチ処理やqgis_processからも
+ ディスクキャッシュ・SQL・プロバイダでの抽出を利用できる。
+"""
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from qgis.PyQt.QtCore import QVariant, QThread
+from qgis.PyQt.QtGui import QIcon
+from qgis.core import (QgsProcessingProvider, QgsProcessingAlgorithm, QgsProcessingException, QgsProcessing,
+                       QgsProcessingParameterMultipleLayers, QgsProcessingParameterExpression, QgsProcessingParameterString,
+                       QgsProcessingParameterEnum, QgsProcessingParameterFolderDestination, QgsProcessingParameterFeatureSink,
+                       QgsProcessingOutputNumber, QgsFeatureRequest, QgsFeatureSink, QgsFeature, QgsField, QgsFields,
+                       QgsExpression, QgsVectorLayer, QgsVectorFileWriter, QgsCoordinateReferenceSystem, QgsWkbTypes)
+
+from .easy_attribute_filter_column_cache import isNullValue
+from .easy_attribute_filter_engine import (NUMERIC_OPERATORS, TEXT_OPERATORS, EasyAttributeFilterEngine, valueSetExpression,
+                                           comparisonExpression)
+
+# 演算子の選択肢
+OPERATOR_NAMES = list(NUMERIC_OPERATORS.keys()) + list(TEXT_OPERATORS.keys())
+# 1回のリクエストで書き出す地物数
+WRITE_BATCH_SIZE = 10000
+# ファイル名に使用できない文字
+INVALID_FILE_CHARACTERS = re.compile(r'[\\/:*?"<>|]')
+
+
+class EasyAttributeFilterProvider(QgsProcessingProvider):
+    """
+    検索簡易フィルターのプロセシングプロバイダ
+    """
+
+    def id(self) -> str:
+        return "easyattributefilter"
+
+    def name(self) -> str:
+        return "検索簡易フィルター"
+
+    def icon(self):
+        return QIcon(":/plugins/easy_attribute_filter/icon.png")
+
+    def loadAlgorithms(self):
+        for algorithm in (EasyAttributeFilterToLayerAlgorithm(), EasyAttributeFilterCountAlgorithm(),
+                          EasyAttributeFilterDistinctValuesAlgorithm()):
+            self.addAlgorithm(algorithm)
+
+
+class EasyAttributeFilterAlgorithm(QgsProcessingAlgorithm):
+    """
+    入力レイヤにフィルターを適用するアルゴリズムの基底クラス
+
+    フィルターは式（FILTER）と、ダイアログと同じ値の一覧（FILTER_FIELD・VALUES）、
+    比較・LIKE（FILTER_FIELD・OPERATOR・VALUE）の組み合わせ（AND）で指定する。
+    """
+
+    INPUT = "INPUT"
+    FILTER = "FILTER"
+    FILTER_FIELD = "FILTER_FIELD"
+    VALUES = "VALUES"
+    OPERATOR = "OPERATOR"
+    VALUE = "VALUE"
+    OUTPUT = "OUTPUT"
+
+    def __init__(self):
+        super(EasyAttributeFilterAlgorithm, self).__init__()
+        # prepareAlgorithmで作成したレイヤごとの評価
+        self.engines = []
+
+    def createInstance(self):
+        return type(self)()
+
+    def group(self) -> str:
+        return "フィルター"
+
+    def groupId(self) -> str:
+        return "filter"
+
+    def initFilterParameters(self):
+        """
+        入力レイヤとフィルターのパラメータを追加する
+        """
+        self.addParameter(QgsProcessingParameterMultipleLayers(self.INPUT, "入力レイヤ", QgsProcessing.TypeVector))
+        self.addParameter(QgsProcessingParameterExpression(self.FILTER, "フィルター式", optional=True))
+        self.addParameter(QgsProcessingParameterString(self.FILTER_FIELD, "フィルターする属性", optional=True))
+        self.addParameter(QgsProcessingParameterString(self.VALUES, "値の一覧（カンマ区切り、いずれかと等しい）", optional=True))
+        self.addParameter(QgsProcessingParameterEnum(self.OPERATOR, "演算内容", options=OPERATOR_NAMES, optional=True))
+        self.addParameter(QgsProcessingParameterString(self.VALUE, "判定値", optional=True))
+
+    def filterExpressions(self, layer, parameters: dict, context) -> list:
+        """
+        レイヤに適用するフィルター式のリストを作成する
+
+        値のリテラルは属性の型によって異なるため、レイヤごとに作成する。
+        """
+        expressions = []
+        expression = self.parameterAsExpression(parameters, self.FILTER, context)
+        if expression:
+            expressions.append(expression)
+
+        field_name = self.parameterAsString(parameters, self.FILTER_FIELD, context)
+        values = self.parameterAsString(parameters, self.VALUES, context)
+        operator_index = parameters.get(self.OPERATOR)
+        if not field_name:
+            if values or operator_index is not None:
+                raise QgsProcessingException("値の一覧・演算内容を指定する場合は、フィルターする属性を指定してください。")
+            return expressions
+
+        field_index = layer.fields().indexOf(field_name)
+        if field_index < 0:
+            raise QgsProcessingException(f"{layer.name()}に属性「{field_name}」がありません。")
+        is_numeric = layer.fields().at(field_index).isNumeric()
+
+        if values:
+            expressions.append(valueSetExpression(field_name, [value.strip() for value in values.split(",")], False, is_numeric))
+        if operator_index is not None:
+            operator = OPERATOR_NAMES[self.parameterAsEnum(parameters, self.OPERATOR, context)]
+            expressions.append(comparisonExpression(field_name, operator, self.parameterAsString(parameters, self.VALUE, context), is_numeric))
+        return expressions
+
+    def prepareAlgorithm(self, parameters: dict, context, feedback) -> bool:
+        """
+        レイヤごとの評価を作成する（メインスレッド）
+        """
+        self.engines = []
+        for layer in self.parameterAsLayerList(parameters, self.INPUT, context):
+            if not isinstance(layer, QgsVectorLayer):
+                continue
+            expressions = self.filterExpressions(layer, parameters, context)
+            for expression in expressions:
+                parsed = QgsExpression(expression)
+                if parsed.hasParserError():
+                    raise QgsProcessingException(f"フィルター式にエラーがあります：{parsed.parserErrorString()}")
+            self.engines.append(EasyAttributeFilterEngine(layer, expressions))
+
+        if len(self.engines) == 0:
+            raise QgsProcessingException("入力レイヤがありません。")
+        return True
+
+    def processEngines(self, function, feedback) -> list:
+        """
+        レイヤごとの処理をスレッドで並行して実行する
+
+        @param  function:評価を受け取り結果を返す関数
+        @return [(評価, 結果)]（入力レイヤの順）
+        """
+        results = [None] * len(self.engines)
+        workers = max(1, min(QThread.idealThreadCount(), len(self.engines)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(function, engine): index for index, engine in enumerate(self.engines)}
+            for finished, future in enumerate(as_completed(futures), start=1):
+                index = futures[future]
+                results[index] = future.result()
+                feedback.pushInfo(f"{self.engines[index].layer_name}：完了")
+                feedback.setProgress(100.0 * finished / len(self.engines))
+                if feedback.isCanceled():
+                    for pending in futures:
+                        pending.cancel()
+                    break
+        return [(engine, result) for engine, result in zip(self.engines, results)]
+
+    def createTableSink(self, parameters: dict, context, fields: QgsFields):
+        """
+        ジオメトリのない出力テーブルを作成する
+        """
+        sink, dest_id = self.parameterAsSink(parameters, self.OUTPUT, context, fields, QgsWkbTypes.NoGeometry, QgsCoordinateReferenceSystem())
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+        return (sink, dest_id)
+
+
+class EasyAttributeFilterToLayerAlgorithm(EasyAttributeFilterAlgorithm):
+    """
+    フィルターに一致する地物を入力レイヤごとに新しいレイヤへ出力する
+    """
+
+    FEATURE_COUNT = "FEATURE_COUNT"
+
+    def name(self) -> str:
+        return "filtertolayer"
+
+    def displayName(self) -> str:
+        return "フィルター結果をレイヤに出力"
+
+    def shortHelpString(self) -> str:
+        return "入力レイヤごとに、フィルターに一致する地物を出力フォルダのGeoPackage（レイヤ名.gpkg）に出力します。"
+
+    def initAlgorithm(self, config=None):
+        self.initFilterParameters()
+        self.addParameter(QgsProcessingParameterFolderDestination(self.OUTPUT, "出力フォルダ"))
+        self.addOutput(QgsProcessingOutputNumber(self.FEATURE_COUNT, "出力した地物数"))
+
+    def prepareAlgorithm(self, parameters: dict, context, feedback) -> bool:
+        super(EasyAttributeFilterToLayerAlgorithm, self).prepareAlgorithm(parameters, context, feedback)
+        self.transform_context = context.transformContext()
+        # レイヤ名が重複する場合は連番を付ける
+        self.file_names = []
+        for engine in self.engines:
+            base_name = INVALID_FILE_CHARACTERS.sub("_", engine.layer_name) or "layer"
+            file_name = base_name
+            number = 2
+            while file_name in self.file_names:
+                file_name = f"{base_name}_{number}"
+                number += 1
+            self.file_names.append(file_name)
+        self.layer_info = [(engine.layer.crs(), engine.layer.wkbType()) for engine in self.engines]
+        return True
+
+    def processAlgorithm(self, parameters: dict, context, feedback) -> dict:
+        folder = self.parameterAsString(parameters, self.OUTPUT, context)
+        os.makedirs(folder, exist_ok=True)
+        paths = {id(engine): os.path.join(folder, f"{file_name}.gpkg") for engine, file_name in zip(self.engines, self.file_names)}
+        layer_info = {id(engine): info for engine, info in zip(self.engines, self.layer_info)}
+
+        def write(engine: EasyAttributeFilterEngine) -> int:
+            crs, wkb_type = layer_info[id(engine)]
+            return self.writeMatches(engine, paths[id(engine)], crs, wkb_type, feedback)
+
+        total = 0
+        for engine, count in self.processEngines(write, feedback):
+            if count is not None:
+                feedback.pushInfo(f"{engine.layer_name}：{count:,}件を出力しました")
+                total += count
+        return {self.OUTPUT: folder, self.FEATURE_COUNT: total}
+
+    def writeMatches(self, engine: EasyAttributeFilterEngine, path: str, crs, wkb_type, feedback):
+        """
+        フィルターに一致する地物をファイルに書き出す（スレッド）
+
+        @return 書き出した地物数（中止した場合はNone）
+        """
+        fids = engine.matchingFids(feedback)
+        if feedback.isCanceled():
+            return None
+
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = "GPKG"
+        options.fileEncoding = "UTF-8"
+        writer = QgsVectorFileWriter.create(path, engine.fields, wkb_type, crs, self.transform_context, options)
+        if writer.hasError() != QgsVectorFileWriter.NoError:
+            message = writer.errorMessage()
+            del writer
+            raise QgsProcessingException(f"{path}を作成できません：{message}")
+
+        if fids is None:
+            requests = [QgsFeatureRequest()]
+        else:
+            # 地物IDは一定件数ごとに分割し、リクエスト毎のID集合が大きくなりすぎないようにする
+            sorted_fids = sorted(fids)
+            requests = [QgsFeatureRequest().setFilterFids(sorted_fids[start:start + WRITE_BATCH_SIZE])
+                        for start in range(0, len(sorted_fids), WRITE_BATCH_SIZE)]
+
+        count = 0
+        try:
+            for request in requests:
+                for feature in engine.source.getFeatures(request):
+                    if feedback.isCanceled():
+                        return None
+                    if not writer.addFeature(feature, QgsFeatureSink.FastInsert):
+                        raise QgsProcessingException(f"{path}に書き出せません：{writer.errorMessage()}")
+                    count += 1
+        finally:
+            del writer
+        return count
+
+
+class EasyAttributeFilterCountAlgorithm(EasyAttributeFilterAlgorithm):
+    """
+    フィルターに一致する件数を入力レイヤごとに求める
+    """
+
+    def name(self) -> str:
+        return "countmatches"
+
+    def displayName(self) -> str:
+        return "フィルターに一致する件数"
+
+    def shortHelpString(self) -> str:
+        return "入力レイヤごとに、フィルターに一致する地物の件数をテーブルに出力します。"
+
+    def initAlgorithm(self, config=None):
+        self.initFilterParameters()
+        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, "件数", QgsProcessing.TypeVector))
+
+    def processAlgorithm(self, parameters: dict, context, feedback) -> dict:
+        fields = QgsFields()
+        fields.append(QgsField("layer", QVariant.String))
+        fields.append(QgsField("count", QVariant.LongLong))
+        sink, dest_id = self.createTableSink(parameters, context, fields)
+
+        for engine, count in self.processEngines(lambda engine: engine.count(feedback), feedback):
+            if feedback.isCanceled():
+                break
+            feature = QgsFeature(fields)
+            feature.setAttributes([engine.layer_name, count])
+            sink.addFeature(feature, QgsFeatureSink.FastInsert)
+        return {self.OUTPUT: dest_id}
+
+
+class EasyAttributeFilterDistinctValuesAlgorithm(EasyAttributeFilterAlgorithm):
+    """
+    フィルターに一致する地物の固有値と件数を入力レイヤごとに求める
+    """
+
+    FIELD = "FIELD"
+
+    def name(self) -> str:
+        return "distinctvalues"
+
+    def displayName(self) -> str:
+        return "フィルターに一致する固有値"
+
+    def shortHelpString(self) -> str:
+        return "入力レイヤごとに、フィルターに一致する地物の指定した属性の固有値と件数をテーブルに出力します。属性がないレイヤは出力しません。"
+
+    def initAlgorithm(self, config=None):
+        self.initFilterParameters()
+        self.addParameter(QgsProcessingParameterString(self.FIELD, "固有値を求める属性"))
+        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, "固有値", QgsProcessing.TypeVector))
+
+    def processAlgorithm(self, parameters: dict, context, feedback) -> dict:
+        field_name = self.parameterAsString(parameters, self.FIELD, context)
+        fields = QgsFields()
+        fields.append(QgsField("layer", QVariant.String))
+        fields.append(QgsField("value", QVariant.String))
+        fields.append(QgsField("count", QVariant.LongLong))
+        sink, dest_id = self.createTableSink(parameters, context, fields)
+
+        for engine, result in self.processEngines(lambda engine: engine.valueCounts(field_name, feedback), feedback):
+            if feedback.isCanceled():
+                break
+            if result is None:
+                feedback.pushInfo(f"{engine.layer_name}に属性「{field_name}」がありません。")
+                continue
+
+            counts, null_count = result
+            rows = sorted(counts.items(), key=lambda item: (-item[1], str(item[0])))
+            if null_count > 0:
+                rows.append((None, null_count))
+            for value, count in rows:
+                feature = QgsFeature(fields)
+                feature.setAttributes([engine.layer_name, None if isNullValue(value) else str(value), count])
+                sink.addFeature(feature, QgsFeatureSink.FastInsert)
+        return {self.OUTPUT: dest_id}
@@ -0,0 +1,257 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterRelationDialog
+                                 A QGIS plugin
+ プロジェクトのリレーションを使った関連レイヤの条件によるフィルター
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+ 親レイヤのキーの列に、子レイヤ（参照するレイヤ）の条件でフィルターを設定する。
+ relation_aggregateのように親の地物ごとに子レイヤを検索せず、子レイヤの条件を1回だけ評価して
+ 一致した外部キーの集合を求め、親レイヤはキーがその集合に含まれるかで抽出する（準結合）。
+ 子レイヤがGeoPackage/SQLiteの場合は外部キーをSQLで求め、親レイヤが同じデータベースにある場合は
+ 親レイヤに存在するキーのみに絞り込む。
+ キーの集合はメモリに保持し、フィルター式にはリレーションIDと子レイヤの条件のみを含める。
+ 式の評価時は登録した式関数がキーの集合に含まれるかを判定する。
+"""
+import os
+import re
+
+from qgis.PyQt import uic
+from qgis.PyQt.QtWidgets import QDialog
+from qgis.core import (QgsProject, QgsTask, QgsRelation, QgsExpression, QgsExpressionFunction, QgsExpressionContext,
+                       QgsExpressionContextUtils, QgsFeatureRequest, QgsVectorLayer, QgsVectorLayerFeatureSource)
+
+from .easy_attribute_filter_column_cache import isNullValue
+from .easy_attribute_filter_predicate import STRING_LITERAL_PATTERN, FIELD_PATTERN, parseLiteral
+from .easy_attribute_filter_sql import EasyAttributeFilterSqlBackend
+
+FORM_CLASS, _ = uic.loadUiType(os.path.join(
+    os.path.dirname(__file__), 'easy_attribute_filter_relation_base.ui'))
+
+# キーの集合に含まれるかを判定する式関数の名前
+SEMI_JOIN_FUNCTION = "_easy_attribute_filter_semi_join"
+SEMI_JOIN_PATTERN = re.compile(f"{SEMI_JOIN_FUNCTION}\\((?P<relation>{STRING_LITERAL_PATTERN}), "
+                               f"(?P<child>{STRING_LITERAL_PATTERN}), {FIELD_PATTERN}\\)")
+
+# {(リレーションID, 子レイヤの条件): 外部キーの集合}
+semi_join_keys = dict()
+# 登録した式関数
+_semi_join_function = None
+
+
+class SemiJoinFunction(QgsExpressionFunction):
+    """
+    値が子レイヤの条件に一致した外部キーの集合に含まれるかを返す式関数
+
+    _easy_attribute_filter_semi_join(リレーションID, 子レイヤの条件, キーのフィールド)
+    キーの集合を求めていない場合はNULLを返す。
+    """
+
+    def __init__(self):
+        super(SemiJoinFunction, self).__init__(SEMI_JOIN_FUNCTION, 3, "Custom")
+
+    def func(self, values, context, parent, node):
+        keys = semi_join_keys.get((values[0], values[1]))
+        if keys is None:
+            return None
+        return not isNullValue(values[2]) and values[2] in keys
+
+    def usesGeometry(self, node) -> bool:
+        return False
+
+    def referencedColumns(self, node):
+        return []
+
+
+def registerSemiJoinFunction():
+    """
+    キーの集合に含まれるかを判定する式関数を登録する
+    """
+    global _semi_join_function
+    if _semi_join_function is None:
+        _semi_join_function = SemiJoinFunction()
+        QgsExpression.registerFunction(_semi_join_function)
+
+
+def unregisterSemiJoinFunction():
+    """
+    キーの集合に含まれるかを判定する式関数の登録を解除する
+    """
+    global _semi_join_function
+    if _semi_join_function is not None:
+        QgsExpression.unregisterFunction(SEMI_JOIN_FUNCTION)
+        _semi_join_function = None
+
+
+def parentRelations(layer: QgsVectorLayer, field_name: str) -> list:
+    """
+    レイヤが親として参照され、指定したフィールドをキーとするリレーション（単一フィールドのみ）
+
+    @param  layer:親レイヤ
+    @param  field_name:キーのフィールド名
+    @return QgsRelationのリスト
+    """
+    relations = []
+    for relation in QgsProject.instance().relationManager().referencedRelations(layer):
+        field_pairs = relation.fieldPairs()
+        if relation.isValid() and len(field_pairs) == 1 and list(field_pairs.values())[0] == field_name:
+            relations.append(relation)
+    return relations
+
+
+def semiJoinExpression(relation_id: str, child_expression: str, field_name: str) -> str:
+    """
+    キーの集合に含まれる地物を抽出するフィルター式を作成する
+
+    キーの値は式に含めず、semi_join_keysに保持した集合で判定する。
+
+    @param  relation_id:リレーションID
+    @param  child_expression:子レイヤの条件
+    @param  field_name:親レイヤのキーのフィールド名
+    """
+    return (f"{SEMI_JOIN_FUNCTION}({QgsExpression.quotedString(relation_id)}, "
+            f"{QgsExpression.quotedString(child_expression)}, {QgsExpression.quotedColumnRef(field_name)})")
+
+
+def parseSemiJoinExpression(expression: str):
+    """
+    semiJoinExpressionで作成したフィルター式を解析する
+
+    @return (リレーションID, 子レイヤの条件, キーのフィールド名)（準結合の式でない場合はNone）
+    """
+    matched = SEMI_JOIN_PATTERN.fullmatch(expression)
+    if matched is None:
+        return None
+    return (parseLiteral(matched.group("relation")), parseLiteral(matched.group("child")), matched.group("field"))
+
+
+class EasyAttributeFilterSemiJoinTask(QgsTask):
+    """
+    子レイヤの条件に一致する外部キーの集合を求めるタスク
+    """
+
+    def __init__(self, relation: QgsRelation, child_expression: str):
+        """
+        コンストラクタ
+
+        @param  relation:リレーション
+        @param  child_expression:子レイヤの条件（空の場合は子を持つ親を全て抽出する）
+        """
+        child_layer = relation.referencingLayer()
+        parent_layer = relation.referencedLayer()
+        super(EasyAttributeFilterSemiJoinTask, self).__init__(f"関連レイヤの抽出：{child_layer.name()}", QgsTask.CanCancel)
+
+        self.relation_id = relation.id()
+        self.foreign_key, self.parent_key = list(relation.fieldPairs().items())[0]
+        self.child_expression = child_expression
+        self.total = child_layer.featureCount()
+
+        # スレッドからはレイヤではなく地物ソースを経由して読み込む
+        self.source = QgsVectorLayerFeatureSource(child_layer)
+        self.fields = child_layer.fields()
+        self.context = QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(child_layer))
+
+        # 子レイヤがSQLを使用できる場合は外部キーをSQLで求める
+        # 使用できるかの判定とSQLの作成はメインスレッドで行い、実行のみこのタスクで行う
+        self.sql_backend = None
+        self.sql_query = None
+        if EasyAttributeFilterSqlBackend.isSupported(child_layer):
+            backend = EasyAttributeFilterSqlBackend(child_layer)
+            if backend.isUsable():
+                parent_backend = EasyAttributeFilterSqlBackend(parent_layer) if EasyAttributeFilterSqlBackend.isSupported(parent_layer) else None
+                expressions = [child_expression] if child_expression else []
+                self.sql_query = backend.joinKeysQuery(self.foreign_key, expressions, parent_backend, self.parent_key)
+                if self.sql_query is not None:
+                    self.sql_backend = backend
+
+        # 一致した外部キー
+        self.keys = None
+        self.error_message = ""
+
+    def run(self) -> bool:
+        if self.sql_query is not None:
+            rows = self.sql_backend.execute(*self.sql_query)
+            if rows is not None:
+                self.keys = {row[0] for row in rows}
+                return True
+
+        # 条件は地物リクエストに設定し、式をコンパイルできるプロバイダではプロバイダ側で抽出させる
+        request = QgsFeatureRequest()
+        referenced_columns = {self.foreign_key}
+        needs_geometry = False
+        if self.child_expression:
+            expression = QgsExpression(self.child_expression)
+            if expression.hasParserError():
+                self.error_message = expression.parserErrorString()
+                return False
+            request.setFilterExpression(self.child_expression)
+            request.setExpressionContext(self.context)
+            referenced_columns |= expression.referencedColumns()
+            needs_geometry = expression.needsGeometry()
+        if not needs_geometry:
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(list(referenced_columns), self.fields)
+
+        field_index = self.fields.indexOf(self.foreign_key)
+        keys = set()
+        count = 0
+        for feature in self.source.getFeatures(request):
+            if self.isCanceled():
+                return False
+            key = feature.attribute(field_index)
+            if not isNullValue(key):
+                keys.add(key)
+            count += 1
+            if count % 10000 == 0 and self.total > 0:
+                self.setProgress(100.0 * count / self.total)
+
+        self.keys = keys
+        return True
+
+
+class EasyAttributeFilterRelationDialog(QDialog, FORM_CLASS):
+    """
+    関連レイヤの条件を入力するダイアログ
+    """
+
+    def __init__(self, relations: list, parent=None):
+        """
+        コンストラクタ
+
+        @param  relations:選択できるリレーション
+        """
+        super(EasyAttributeFilterRelationDialog, self).__init__(parent)
+        self.setupUi(self)
+
+        self.relations = relations
+        for relation in relations:
+            self.relation_combobox.addItem(f"{relation.name()}（{relation.referencingLayer().name()}）")
+        self.relation_combobox.currentIndexChanged.connect(self.updateExpressionLayer)
+        self.updateExpressionLayer()
+
+    def updateExpressionLayer(self, *args):
+        relation = self.relation()
+        if relation is not None:
+            self.expression_widget.setLayer(relation.referencingLayer())
+
+    def relation(self):
+        """
+        選択したリレーション
+        """
+        index = self.relation_combobox.currentIndex()
+        return self.relations[index] if 0 <= index < len(self.relations) else None
+
+    def expression(self) -> str:
+        """
+        入力した子レイヤの条件
+        """
+        return self.expression_widget.expression().strip()
+
+    def accept(self):
+        expression = self.expression()
+        if expression and QgsExpression(expression).hasParserError():
+            self.expression_widget.setFocus()
+            return
+        super(EasyAttributeFilterRelationDialog, self).accept()
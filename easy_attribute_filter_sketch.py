@@ -0,0 +1,209 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterSketch
+                                 A QGIS plugin
+ 固有値の件数・頻出値の概算
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+ 固有値が多いフィールドについて、全ての固有値を保持せずに
+ 固有値の数（HyperLogLog）と頻出値（Space-Saving）を1回の読み込みで概算する。
+ Qtに依存しないため、バックグラウンド処理からも使用できる。
+"""
+import math
+import heapq
+
+# HyperLogLogのレジスタ数（2のべき乗）の指数
+HLL_PRECISION = 14
+# 頻出値として表示する件数
+TOP_VALUE_COUNT = 20
+# 頻出値の候補として保持する件数（表示件数より多く保持して誤差を抑える）
+TOP_VALUE_CAPACITY = 200
+
+MASK_64 = (1 << 64) - 1
+
+
+def hashValue(value) -> int:
+    """
+    値を64ビットのハッシュ値に変換する
+
+    Pythonのハッシュ値は整数ではほぼ値そのものとなるため、SplitMix64の攪拌を行う。
+    """
+    hashed = hash(value) & MASK_64
+    hashed = ((hashed ^ (hashed >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    hashed = ((hashed ^ (hashed >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return hashed ^ (hashed >> 31)
+
+
+class HyperLogLog:
+    """
+    HyperLogLogによる固有値の数の概算
+
+    標準誤差は約 1.04 / √(レジスタ数)（精度14で約0.8%）。
+    """
+
+    def __init__(self, precision: int=HLL_PRECISION):
+        """
+        コンストラクタ
+
+        @param  precision:レジスタ数の指数
+        """
+        self.precision = precision
+        self.register_count = 1 << precision
+        self.registers = bytearray(self.register_count)
+
+    def add(self, value):
+        """
+        値を追加する
+        """
+        hashed = hashValue(value)
+        index = hashed >> (64 - self.precision)
+        remaining = (hashed << self.precision) & MASK_64
+        # 先頭から最初の1までの桁数（全て0の場合は最大値）
+        rank = 64 - self.precision + 1 if remaining == 0 else 64 - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self) -> int:
+        """
+        固有値の数を概算する
+        """
+        m = self.register_count
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+
+        zero_count = self.registers.count(0)
+        if estimate <= 2.5 * m and zero_count > 0:
+            # 少ない場合は線形カウンティングで補正する
+            estimate = m * math.log(m / zero_count)
+        return int(round(estimate))
+
+
+class SpaceSaving:
+    """
+    Space-Savingによる頻出値の概算
+
+    保持する候補の数を超えた場合は、最も件数の少ない候補と入れ替える。
+    概算の件数は実際の件数以上となり、その差は誤差（入れ替え時の件数）以下となる。
+    """
+
+    def __init__(self, capacity: int=TOP_VALUE_CAPACITY):
+        """
+        コンストラクタ
+
+        @param  capacity:保持する候補の数
+        """
+        self.capacity = capacity
+        # {値: [件数, 誤差]}
+        self.counters = dict()
+        # (件数, 追加順, 値)の最小ヒープ（件数が古い要素は取り出し時に積み直す）
+        self.heap = []
+        self.sequence = 0
+
+    def add(self, value, count: int=1):
+        """
+        値を追加する
+
+        @param  value:値
+        @param  count:件数
+        """
+        counter = self.counters.get(value)
+        if counter is not None:
+            counter[0] += count
+            return
+
+        error = 0
+        if len(self.counters) >= self.capacity:
+            # 最も件数の少ない候補を取り除き、その件数を誤差として引き継ぐ
+            error = self.popMinimum()
+            count += error
+
+        self.counters[value] = [count, error]
+        self.pushCounter(value, count)
+
+    def pushCounter(self, value, count: int):
+        self.sequence += 1
+        heapq.heappush(self.heap, (count, self.sequence, value))
+
+    def popMinimum(self) -> int:
+        """
+        最も件数の少ない候補を取り除く
+
+        @return 取り除いた候補の件数
+        """
+        while True:
+            count, _, value = heapq.heappop(self.heap)
+            current = self.counters[value][0]
+            if current == count:
+                del self.counters[value]
+                return count
+            self.pushCounter(value, current)
+
+    def topValues(self, count: int) -> list:
+        """
+        頻出値を取得する
+
+        @param  count:件数
+        @return [(値, 概算の件数, 誤差)]（件数の多い順）
+        """
+        counters = sorted(self.counters.items(), key=lambda item: -item[1][0])
+        return [(value, counter[0], counter[1]) for value, counter in counters[0:count]]
+
+
+class ValueSketch:
+    """
+    固有値の数と頻出値の概算（NULLは件数のみ数える）
+    """
+
+    def __init__(self, precision: int=HLL_PRECISION, capacity: int=TOP_VALUE_CAPACITY):
+        self.distinct = HyperLogLog(precision)
+        self.frequent = SpaceSaving(capacity)
+        self.null_count = 0
+        self.total = 0
+
+    @classmethod
+    def fromCounts(cls, counts: dict):
+        """
+        固有値ごとの件数から作成する
+
+        件数の多い候補から保持するため、取り除かれる値の件数は保持した候補の件数以下となり、
+        Space-Savingの誤差の範囲に収まる。
+
+        @param  counts:{値: 件数}（NULLを除く）
+        """
+        sketch = cls()
+        for value, count in sorted(counts.items(), key=lambda item: -item[1]):
+            sketch.distinct.add(value)
+            sketch.frequent.add(value, count)
+            sketch.total += count
+        return sketch
+
+    def add(self, value):
+        """
+        値を追加する（NULLはNone）
+        """
+        self.total += 1
+        if value is None:
+            self.null_count += 1
+            return
+        try:
+            self.distinct.add(value)
+        except TypeError:
+            # ハッシュできない値は数えない
+            return
+        self.frequent.add(value)
+
+    def distinctCount(self) -> int:
+        """
+        固有値の数を概算する（NULLを除く）
+        """
+        return self.distinct.count()
+
+    def topValues(self, count: int=TOP_VALUE_COUNT) -> list:
+        """
+        頻出値を取得する
+
+        @return [(値, 概算の件数, 誤差)]（件数の多い順）
+        """
+        return self.frequent.topValues(count)
@@ -0,0 +1,592 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterSqlBackend
+                                 A QGIS plugin
+ GeoPackage/SQLiteレイヤのSQLによる抽出・集計
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+ プラグインが作成するフィルター式をSQLに変換し、データソースに読み取り専用で接続して
+ 地物ID・固有値と件数・並び順を求める。
+"""
+import os
+import copy
+import sqlite3
+import pathlib
+import datetime
+from array import array
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import QgsFields, QgsProviderRegistry, QgsVectorLayer
+
+from .easy_attribute_filter_predicate import (parsePredicate, ValueSetPredicate, NullPredicate, ComparisonPredicate,
+                                              LikePredicate, DateRangePredicate, LogicalPredicate)
+from .easy_attribute_filter_fts import escapeGlob
+
+# SQLで抽出できるストレージ
+SQL_STORAGE_TYPES = ("GPKG", "SQLite")
+# 固有値・並び順を求めるフィールドの型（値の型がQGISと一致するもの）
+SQL_VALUE_TYPES = (QVariant.Int, QVariant.LongLong, QVariant.Double, QVariant.String)
+SQL_DATE_TYPES = (QVariant.Date, QVariant.DateTime)
+# 比較演算子
+SQL_OPERATORS = {"=": "=", "!=": "<>", ">": ">", ">=": ">=", "<": "<", "<=": "<="}
+
+
+def quoteIdentifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def likeToGlob(pattern: str) -> str:
+    """
+    LIKEのパターンをGLOBのパターンに変換する（LIKEと異なり大文字・小文字を区別する）
+    """
+    return "".join("*" if char == "%" else "?" if char == "_" else escapeGlob(char) for char in pattern)
+
+
+class EasyAttributeFilterSqlBackend:
+    """
+    GeoPackage/SQLiteレイヤのデータソースに対するSQLの実行
+
+    コミット済みのデータを対象とするため、未コミットの編集がある場合は使用しない。
+    """
+
+    def __init__(self, layer: QgsVectorLayer):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        """
+        self.layer = layer
+        uri = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source())
+        self.source_path = uri.get("path", "")
+        self.table_name = uri.get("layerName", "") or ""
+        self.fid_column = None
+        # {サブセット: WHERE句として使用できるか}
+        self.subset_checks = dict()
+        # スナップショットで固定したレイヤの状態
+        self.layer_state = None
+
+    @staticmethod
+    def isSupported(layer: QgsVectorLayer) -> bool:
+        """
+        SQLで抽出できるレイヤか判定する
+        """
+        if layer is None or layer.providerType() != "ogr":
+            return False
+        if layer.dataProvider().storageType() not in SQL_STORAGE_TYPES:
+            return False
+        uri = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source())
+        return os.path.isfile(uri.get("path", ""))
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        データソースに読み取り専用で接続する
+        """
+        connection = sqlite3.connect(f"{pathlib.Path(os.path.abspath(self.source_path)).as_uri()}?mode=ro", uri=True, timeout=5)
+        if self.fid_column is None:
+            self.resolveTable(connection)
+        return connection
+
+    def resolveTable(self, connection: sqlite3.Connection):
+        """
+        テーブル名と地物IDの列を求める
+        """
+        if len(self.table_name) == 0:
+            # レイヤ名の指定がない場合は唯一のテーブル
+            try:
+                rows = connection.execute("SELECT table_name FROM gpkg_contents WHERE data_type IN ('features', 'attributes')").fetchall()
+            except sqlite3.Error:
+                rows = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchall()
+            if len(rows) != 1:
+                raise sqlite3.OperationalError("table not found")
+            self.table_name = rows[0][0]
+
+        # INTEGERの主キーが地物ID、ない場合はrowid
+        self.fid_column = "rowid"
+        for row in connection.execute(f"PRAGMA table_info({quoteIdentifier(self.table_name)})"):
+            if row[5] == 1 and row[2].upper() == "INTEGER":
+                self.fid_column = quoteIdentifier(row[1])
+
+    def layerState(self):
+        """
+        レイヤの状態を取得する
+
+        @return (フィールド, サブセット, 未コミットの編集があるか)（スナップショットでは作成時の状態）
+        """
+        if self.layer_state is not None:
+            return self.layer_state
+        return (self.layer.fields(), self.layer.subsetString(), self.layer.isEditable() and self.layer.isModified())
+
+    def snapshot(self):
+        """
+        レイヤの現在の状態を固定した複製を作成する
+
+        複製はレイヤを参照しないため、別のスレッドで使う場合はレイヤを所有するスレッドで作成して渡す。
+        テーブルの特定とサブセットの確認も作成時に済ませる。
+        """
+        backend = copy.copy(self)
+        backend.layer = None
+        backend.layer_state = (QgsFields(self.layer.fields()), self.layer.subsetString(), self.layer.isEditable() and self.layer.isModified())
+        backend.subset_checks = dict(self.subset_checks)
+        backend.isUsable()
+        return backend
+
+    def isUsable(self) -> bool:
+        """
+        SQLを使用できるか判定する
+        """
+        # 未コミットの編集はデータソースに反映されていない
+        if self.layerState()[2]:
+            return False
+
+        if self.fid_column is None:
+            # 初回はテーブルを特定する
+            try:
+                self.connect().close()
+            except sqlite3.Error:
+                return False
+        return self.isSubsetUsable()
+
+    def isSubsetUsable(self) -> bool:
+        """
+        レイヤの抽出条件（サブセット）をSQLiteのWHERE句として使用できるか判定する
+
+        サブセットはSQL文全体の場合や、GDALが登録する関数を使う場合があるため、
+        SQL文でないことと、WHERE句としてSQLiteで解釈できることをEXPLAINで確認する。
+        """
+        subset = self.layerState()[1].strip()
+        if len(subset) == 0:
+            return True
+        if subset not in self.subset_checks:
+            usable = (not subset.upper().startswith("SELECT")
+                      and self.execute(f"EXPLAIN SELECT 1 FROM {quoteIdentifier(self.table_name)}{self.whereClause()}") is not None)
+            self.subset_checks[subset] = usable
+        return self.subset_checks[subset]
+
+    def fieldType(self, field_name: str):
+        """
+        フィールドの型を取得する（SQLで扱えない場合はNone）
+        """
+        if not self.isUsable():
+            return None
+        fields = self.layerState()[0]
+        field_index = fields.indexOf(field_name)
+        if field_index < 0 or fields.fieldOrigin(field_index) != QgsFields.OriginProvider:
+            return None
+        field_type = fields.at(field_index).type()
+        return field_type if field_type in SQL_VALUE_TYPES + SQL_DATE_TYPES else None
+
+    def hasField(self, field_name: str) -> bool:
+        return self.fieldType(field_name) is not None
+
+    def execute(self, sql: str, parameters=()) -> list:
+        """
+        SQLを実行する
+
+        @return 結果の行のリスト（実行できない場合はNone）
+        """
+        try:
+            connection = self.connect()
+        except sqlite3.Error:
+            return None
+        try:
+            return connection.execute(sql, parameters).fetchall()
+        except sqlite3.Error:
+            return None
+        finally:
+            connection.close()
+
+    def whereClause(self, condition: str = None) -> str:
+        """
+        レイヤの抽出条件（サブセット）を含めたWHERE句を作成する
+        """
+        conditions = []
+        subset = self.layerState()[1]
+        if len(subset) > 0:
+            conditions.append(f"({subset})")
+        if condition is not None:
+            conditions.append(f"({condition})")
+        return " WHERE " + " AND ".join(conditions) if len(conditions) > 0 else ""
+
+    def translate(self, predicate):
+        """
+        条件をSQLに変換する
+
+        @return (SQLの条件, パラメータのリスト)（変換できない場合はNone）
+        """
+        if isinstance(predicate, LogicalPredicate):
+            translated = [self.translate(child) for child in predicate.children]
+            if any(child is None for child in translated):
+                return None
+            return (f" {predicate.operator} ".join(f"({sql})" for sql, _ in translated),
+                    [parameter for _, parameters in translated for parameter in parameters])
+
+        field_type = self.fieldType(predicate.field)
+        if field_type is None:
+            return None
+        column = quoteIdentifier(predicate.field)
+
+        if isinstance(predicate, NullPredicate):
+            return (f"{column} IS NULL", [])
+
+        if isinstance(predicate, DateRangePredicate):
+            if field_type not in SQL_DATE_TYPES:
+                return None
+            # GeoPackageの日付・日時はISO形式の文字列
+            conditions = [f"({column} >= ? AND {column} < ?)" for _ in predicate.ranges]
+            parameters = [date.isoformat() for start, end in predicate.ranges for date in (start, end)]
+            if predicate.include_null:
+                conditions.append(f"{column} IS NULL")
+            return (" OR ".join(conditions) if len(conditions) > 0 else "0", parameters)
+
+        if field_type in SQL_DATE_TYPES:
+            return None
+
+        if isinstance(predicate, ValueSetPredicate):
+            sql = f"{column} IN ({','.join('?' * len(predicate.values))})"
+            if predicate.include_null:
+                sql = f"{sql} OR {column} IS NULL"
+            return (sql, list(predicate.values))
+
+        if isinstance(predicate, ComparisonPredicate):
+            return (f"{column} {SQL_OPERATORS[predicate.operator]} ?", [predicate.value])
+
+        if isinstance(predicate, LikePredicate) and field_type == QVariant.String:
+            operator = "NOT GLOB" if predicate.negate else "GLOB"
+            return (f"{column} {operator} ?", [likeToGlob(predicate.pattern)])
+
+        return None
+
+    def matchingFids(self, expressions: list):
+        """
+        SQLに変換できるフィルター式をまとめて1回のSQLで抽出する
+
+        @param  expressions:フィルター式のリスト
+        @return (地物IDの集合（変換できる式がない場合はNone）, 変換できなかった式のリスト)
+        """
+        if not self.isUsable():
+            return (None, list(expressions))
+
+        conditions = []
+        parameters = []
+        remaining = []
+        for expression in expressions:
+            predicate = parsePredicate(expression)
+            translated = self.translate(predicate) if predicate is not None else None
+            if translated is None:
+                remaining.append(expression)
+                continue
+            conditions.append(translated[0])
+            parameters.extend(translated[1])
+
+        if len(conditions) == 0:
+            return (None, remaining)
+
+        rows = self.execute(f"SELECT {self.fid_column} FROM {quoteIdentifier(self.table_name)}"
+                            + self.whereClause(" AND ".join(f"({condition})" for condition in conditions)), parameters)
+        if rows is None:
+            return (None, list(expressions))
+        return ({row[0] for row in rows}, remaining)
+
+    def translateAll(self, expressions: list):
+        """
+        全てのフィルター式を1つのSQLの条件に変換する
+
+        @return (SQLの条件（式がない場合はNone）, パラメータのリスト)（変換できない式がある場合はNone）
+        """
+        conditions = []
+        parameters = []
+        for expression in expressions:
+            predicate = parsePredicate(expression)
+            translated = self.translate(predicate) if predicate is not None else None
+            if translated is None:
+                return None
+            conditions.append(translated[0])
+            parameters.extend(translated[1])
+
+        condition = " AND ".join(f"({condition})" for condition in conditions) if len(conditions) > 0 else None
+        return (condition, parameters)
+
+    def countQuery(self, expressions: list):
+        """
+        フィルター式に一致する件数を求めるSQLを作成する
+
+        SQLの実行はexecuteで行うため、作成したSQLはバックグラウンドのスレッドで実行できる。
+
+        @param  expressions:フィルター式のリスト
+        @return (SQL, パラメータのリスト)（SQLに変換できない式がある場合はNone）
+        """
+        if not self.isUsable():
+            return None
+        translated = self.translateAll(expressions)
+        if translated is None:
+            return None
+
+        condition, parameters = translated
+        return (f"SELECT COUNT(*) FROM {quoteIdentifier(self.table_name)}{self.whereClause(condition)}", parameters)
+
+    def countMatching(self, expressions: list):
+        """
+        フィルター式に一致する件数を1回のSQLで求める
+
+        @param  expressions:フィルター式のリスト
+        @return 件数（SQLに変換できない式がある場合はNone）
+        """
+        query = self.countQuery(expressions)
+        if query is None:
+            return None
+        rows = self.execute(*query)
+        if rows is None:
+            return None
+        return rows[0][0]
+
+    def valueCountsMatching(self, field_name: str, expressions: list):
+        """
+        フィルター式に一致する行の固有値ごとの件数を1回のSQLで求める
+
+        @param  expressions:フィルター式のリスト
+        @return ({値: 件数}, NULLの件数)（取得できない場合はNone）
+        """
+        if not self.isUsable():
+            return None
+        translated = self.translateAll(expressions)
+        if translated is None:
+            return None
+
+        # 上限なし（SQLiteのLIMIT -1）
+        rows = self.valueCounts(field_name, -1, translated[0], translated[1])
+        if rows is None:
+            return None
+        counts = {value: frequency for value, frequency in rows if value is not None}
+        null_count = sum(frequency for value, frequency in rows if value is None)
+        return (counts, null_count)
+
+    def isSameDatabase(self, other) -> bool:
+        """
+        他のレイヤと同じデータベースファイルか判定する
+        """
+        return os.path.normcase(os.path.abspath(self.source_path)) == os.path.normcase(os.path.abspath(other.source_path))
+
+    def joinKeysQuery(self, field_name: str, expressions: list, parent=None, parent_field: str=None):
+        """
+        フィルター式に一致する行の外部キーの固有値を求めるSQLを作成する
+
+        親レイヤが同じデータベースにある場合は、親レイヤに存在するキーのみに絞り込む。
+
+        @param  field_name:外部キーのフィールド名
+        @param  expressions:フィルター式のリスト
+        @param  parent:親レイヤのSQL
+        @param  parent_field:親レイヤのキーのフィールド名
+        @return (SQL, パラメータのリスト)（SQLに変換できない式がある場合はNone）
+        """
+        if self.fieldType(field_name) not in SQL_VALUE_TYPES:
+            return None
+        translated = self.translateAll(expressions)
+        if translated is None:
+            return None
+
+        condition, parameters = translated
+        column = quoteIdentifier(field_name)
+        conditions = [f"{column} IS NOT NULL"]
+        if condition is not None:
+            conditions.append(condition)
+        if (parent is not None and parent.isUsable() and self.isSameDatabase(parent)
+                and parent.fieldType(parent_field) in SQL_VALUE_TYPES):
+            conditions.append(f"{column} IN (SELECT {quoteIdentifier(parent_field)} FROM {quoteIdentifier(parent.table_name)}{parent.whereClause()})")
+
+        return (f"SELECT DISTINCT {column} FROM {quoteIdentifier(self.table_name)}"
+                + self.whereClause(" AND ".join(f"({condition})" for condition in conditions)), parameters)
+
+    def joinKeys(self, field_name: str, expressions: list, parent=None, parent_field: str=None):
+        """
+        フィルター式に一致する行の外部キーの固有値を1回のSQLで求める
+
+        @param  field_name:外部キーのフィールド名
+        @param  expressions:フィルター式のリスト
+        @param  parent:親レイヤのSQL
+        @param  parent_field:親レイヤのキーのフィールド名
+        @return キーの集合（NULLを除く）（SQLに変換できない式がある場合はNone）
+        """
+        query = self.joinKeysQuery(field_name, expressions, parent, parent_field)
+        if query is None:
+            return None
+        rows = self.execute(*query)
+        if rows is None:
+            return None
+        return {row[0] for row in rows}
+
+    def valueCounts(self, field_name: str, limit: int, condition: str = None, parameters=()):
+        """
+        固有値ごとの件数を取得する（値の昇順、NULLはNone）
+
+        @param  limit:上限件数
+        @param  condition:対象の地物を絞り込むSQLの条件
+        @return [(値, 件数)]（取得できない場合はNone）
+        """
+        if self.fieldType(field_name) not in SQL_VALUE_TYPES:
+            return None
+        column = quoteIdentifier(field_name)
+        return self.execute(f"SELECT {column}, COUNT(*) FROM {quoteIdentifier(self.table_name)}{self.whereClause(condition)}"
+                            f" GROUP BY {column} ORDER BY {column} LIMIT ?", list(parameters) + [limit])
+
+    def uniqueValues(self, field_name: str, limit: int):
+        """
+        固有値を取得する（NULLはNoneとして含める）
+
+        @return 固有値の集合（取得できない場合はNone）
+        """
+        rows = self.valueCounts(field_name, limit)
+        if rows is None:
+            return None
+        return {value for value, _ in rows}
+
+    def valueFrequencies(self, field_name: str, count: int):
+        """
+        固有値の数と頻出値を取得する（NULLを除く）
+
+        @param  count:頻出値の件数
+        @return (固有値の数, [(値, 件数)]（件数の多い順）, 正確な値か)（取得できない場合はNone）
+        """
+        if self.fieldType(field_name) not in SQL_VALUE_TYPES:
+            return None
+        column = quoteIdentifier(field_name)
+        table = quoteIdentifier(self.table_name)
+        distinct_rows = self.execute(f"SELECT COUNT(DISTINCT {column}) FROM {table}{self.whereClause()}")
+        top_rows = self.execute(f"SELECT {column}, COUNT(*) AS frequency FROM {table}{self.whereClause(f'{column} IS NOT NULL')}"
+                                f" GROUP BY {column} ORDER BY frequency DESC, {column} LIMIT ?", [count])
+        if distinct_rows is None or top_rows is None:
+            return None
+        return (distinct_rows[0][0], [(value, frequency) for value, frequency in top_rows], True)
+
+    def prefixQuery(self, field_name: str, prefix: str, limit: int):
+        """
+        前方一致する固有値を取得するSQLを作成する（文字列のみ、大文字・小文字を区別する）
+
+        SQLiteのLIKEは大文字・小文字を区別せず、QGISのLIKEと結果が異なるため、GLOBで前方一致させる。
+
+        @param  prefix:前方一致させる文字列
+        @param  limit:上限件数
+        @return (SQL, パラメータのリスト)（SQLで扱えない場合はNone）
+        """
+        if self.fieldType(field_name) != QVariant.String:
+            return None
+        column = quoteIdentifier(field_name)
+        return (f"SELECT DISTINCT {column} FROM {quoteIdentifier(self.table_name)}"
+                f"{self.whereClause(f'{column} GLOB ?')} ORDER BY {column} LIMIT ?", [escapeGlob(prefix) + "*", limit])
+
+    def prefixValues(self, field_name: str, prefix: str, limit: int):
+        """
+        前方一致する固有値を取得する
+
+        @param  prefix:前方一致させる文字列
+        @param  limit:上限件数
+        @return 固有値の昇順のリスト（取得できない場合はNone）
+        """
+        query = self.prefixQuery(field_name, prefix, limit)
+        if query is None:
+            return None
+        rows = self.execute(*query)
+        if rows is None:
+            return None
+        return [row[0] for row in rows]
+
+    def sampleFids(self, count: int):
+        """
+        無作為に選んだ地物IDを取得する
+
+        @param  count:件数
+        @return 地物IDのリスト（取得できない場合はNone）
+        """
+        if not self.isUsable():
+            return None
+        rows = self.execute(f"SELECT {self.fid_column} FROM {quoteIdentifier(self.table_name)}{self.whereClause()}"
+                            f" ORDER BY RANDOM() LIMIT ?", [count])
+        if rows is None:
+            return None
+        return sorted(row[0] for row in rows)
+
+    def numericColumnData(self, field_name: str, bins: int):
+        """
+        数値列の範囲フィルター用のデータを取得する
+
+        @param  bins:ヒストグラムの階級数
+        @return (昇順に並べた値, 最小値, 最大値, ヒストグラム, 地物ID, 地物IDごとの値)（取得できない場合はNone）
+        """
+        if self.fieldType(field_name) not in (QVariant.Int, QVariant.LongLong, QVariant.Double):
+            return None
+        column = quoteIdentifier(field_name)
+        rows = self.execute(f"SELECT {self.fid_column}, {column} FROM {quoteIdentifier(self.table_name)}"
+                            f"{self.whereClause(f'{column} IS NOT NULL')} ORDER BY {self.fid_column}")
+        if rows is None:
+            return None
+
+        fids = array("q", [fid for fid, _ in rows])
+        fid_values = array("d", [value for _, value in rows])
+        sorted_values = array("d", sorted(fid_values))
+        if len(sorted_values) == 0:
+            return (sorted_values, 0.0, 0.0, [0] * bins, fids, fid_values)
+
+        minimum = sorted_values[0]
+        maximum = sorted_values[-1]
+        histogram = [0] * bins
+        bin_width = (maximum - minimum) / bins
+        for value in sorted_values:
+            bin_index = int((value - minimum) / bin_width) if bin_width > 0 else 0
+            histogram[min(max(bin_index, 0), bins - 1)] += 1
+        return (sorted_values, minimum, maximum, histogram, fids, fid_values)
+
+    def dateColumnData(self, field_name: str):
+        """
+        日付ごとの件数を取得する（日時は日付単位に集計する）
+
+        @return ({datetime.date: 件数}, NULLの件数, 地物ID, 地物IDごとの日付の序数（NULLは0））（取得できない場合はNone）
+        """
+        if self.fieldType(field_name) not in SQL_DATE_TYPES:
+            return None
+        rows = self.execute(f"SELECT {self.fid_column}, substr({quoteIdentifier(field_name)}, 1, 10) FROM {quoteIdentifier(self.table_name)}"
+                            f"{self.whereClause()} ORDER BY {self.fid_column}")
+        if rows is None:
+            return None
+
+        counts = dict()
+        null_count = 0
+        fids = array("q")
+        ordinals = array("l")
+        for fid, text in rows:
+            try:
+                date = datetime.date.fromisoformat(text) if text is not None else None
+            except ValueError:
+                return None
+            fids.append(fid)
+            if date is None:
+                null_count += 1
+                ordinals.append(0)
+            else:
+                counts[date] = counts.get(date, 0) + 1
+                ordinals.append(date.toordinal())
+        return (counts, null_count, fids, ordinals)
+
+    def sortRanks(self, field_name: str, fids: list):
+        """
+        地物の並び順（同じ値は同じ順位）を求める
+
+        @param  fids:地物IDのリスト（元モデルの行順）
+        @return (順位ごとの値（NULLはNone）, 行ごとの順位)（求められない場合はNone）
+        """
+        if self.fieldType(field_name) not in SQL_VALUE_TYPES:
+            return None
+        column = quoteIdentifier(field_name)
+        table = quoteIdentifier(self.table_name)
+        uniques = self.execute(f"SELECT DISTINCT {column} FROM {table}{self.whereClause()} ORDER BY {column}")
+        rows = self.execute(f"SELECT {self.fid_column}, DENSE_RANK() OVER (ORDER BY {column}) - 1 FROM {table}{self.whereClause()}")
+        if uniques is None or rows is None:
+            return None
+
+        fid_ranks = dict(rows)
+        try:
+            ranks = array("d", [fid_ranks[fid] for fid in fids])
+        except KeyError:
+            # データソースにない地物がある
+            return None
+        return ([value for value, in uniques], ranks)
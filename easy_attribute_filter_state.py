@@ -0,0 +1,274 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterState
+                                 A QGIS plugin
+ レイヤごとのフィルターとフィルター結果の保存・復元
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+ フィルター（フィールド名ごとのフィルター式）はレイヤのカスタムプロパティとして
+ プロジェクトに保存する。フィルター結果の地物IDはプロジェクトファイルを大きくしないよう
+ QGISの設定ディレクトリにバックグラウンドで保存し、データの版（ファイルのサイズ・更新日時）が
+ 保存時と同じ場合のみ復元する。
+ プロジェクトを変更済みにしないよう、フィルターの操作ごとではなく、プロジェクトの保存時と
+ ダイアログを閉じる・レイヤを切り替える際に保存する。
+"""
+import os
+import json
+import hashlib
+from array import array
+
+from qgis.core import QgsApplication, QgsTask, QgsProject, QgsProviderRegistry, QgsSettings, QgsVectorLayer
+
+# フィルターを保存するカスタムプロパティ
+FILTERS_PROPERTY = "easy_attribute_filter/filters"
+# フィルター結果の情報を保存するカスタムプロパティ
+RESULT_PROPERTY = "easy_attribute_filter/result"
+
+# 保存中のタスク {ファイルのパス: タスク}
+result_tasks = dict()
+# 終了するまで参照を保持するタスク（中止したものを含む）
+running_result_tasks = set()
+
+
+def isResultPersistent() -> bool:
+    """
+    フィルター結果の地物IDを保存するか
+    """
+    return QgsSettings().value("easy_attribute_filter/persist_results", True, type=bool)
+
+
+def dataRevision(layer: QgsVectorLayer):
+    """
+    データの版を求める
+
+    ファイルのデータソースのみ、パス・抽出条件・地物数・ファイルのサイズと更新日時から求める。
+    SQLiteのWALファイルがある場合は、本体に反映される前の変更を含めるためWALファイルも含める。
+    データベースなど変更を検知できないデータソースや、未コミットの編集がある場合はNoneとする。
+
+    @param  layer:対象レイヤ
+    @return 版を表す文字列（求められない場合はNone）
+    """
+    if layer.isEditable() and layer.isModified():
+        return None
+
+    uri = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source())
+    path = uri.get("path", "")
+    if not path or not os.path.isfile(path):
+        return None
+
+    parts = [layer.providerType(), layer.source(), layer.subsetString(), str(layer.featureCount())]
+    files = [path]
+    dbf_path = os.path.splitext(path)[0] + ".dbf"
+    if dbf_path != path and os.path.exists(dbf_path):
+        files.append(dbf_path)
+    wal_path = path + "-wal"
+    if os.path.exists(wal_path):
+        files.append(wal_path)
+    for file in files:
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None
+        parts.append(f"{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def resultPath(layer: QgsVectorLayer):
+    """
+    フィルター結果の地物IDを保存するファイル
+
+    プロジェクトが切り替わった後に古いプロジェクトの結果を保存できるよう、レイヤの読み込み時に求めておく。
+
+    @return ファイルのパス（プロジェクトが保存されていない場合はNone）
+    """
+    project_path = QgsProject.instance().absoluteFilePath()
+    if not project_path:
+        return None
+    key = hashlib.sha1(f"{project_path}|{layer.id()}".encode("utf-8")).hexdigest()
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), "easy_attribute_filter", "results", f"{key}.fids")
+
+
+def storeFilters(layer: QgsVectorLayer, filters: dict):
+    """
+    フィルターをレイヤのカスタムプロパティに保存する
+
+    @param  layer:対象レイヤ
+    @param  filters:{フィールド名: フィルター式}（フィルターがない場合は空）
+    """
+    if len(filters) == 0:
+        layer.removeCustomProperty(FILTERS_PROPERTY)
+        return
+    layer.setCustomProperty(FILTERS_PROPERTY, json.dumps(filters, ensure_ascii=False))
+
+
+def loadFilters(layer: QgsVectorLayer) -> dict:
+    """
+    保存したフィルターを読み込む
+
+    @return {フィールド名: フィルター式}
+    """
+    try:
+        filters = json.loads(layer.customProperty(FILTERS_PROPERTY, "{}") or "{}")
+    except ValueError:
+        return dict()
+    return filters if isinstance(filters, dict) else dict()
+
+
+def resultKey(info: dict) -> int:
+    """
+    フィルター結果の情報から、ファイルの先頭に書き出す識別値を求める
+
+    書き出しが終わる前や、別の結果のファイルを読み込まないよう、読み込み時に照合する。
+    """
+    digest = hashlib.sha1(json.dumps(info, ensure_ascii=False, sort_keys=True).encode("utf-8")).digest()
+    return int.from_bytes(digest[0:8], "little", signed=True)
+
+
+class EasyAttributeFilterResultWriteTask(QgsTask):
+    """
+    フィルター結果の地物IDをファイルに書き出すタスク
+
+    書きかけのファイルを読み込まないよう、一時ファイルに書き出してから置き換える。
+    """
+
+    def __init__(self, layer: QgsVectorLayer, path: str, info: dict, fids):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        @param  path:保存するファイル
+        @param  info:カスタムプロパティに保存した情報
+        @param  fids:地物IDの集合
+        """
+        super(EasyAttributeFilterResultWriteTask, self).__init__(f"フィルター結果の保存：{layer.name()}", QgsTask.CanCancel)
+        self.layer_id = layer.id()
+        self.path = path
+        self.info = info
+        self.fids = list(fids)
+
+    def run(self) -> bool:
+        values = array("q", [resultKey(self.info)])
+        values.extend(sorted(self.fids))
+        self.fids = None
+        temporary_path = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temporary_path, "wb") as file:
+                values.tofile(file)
+            if self.isCanceled():
+                os.remove(temporary_path)
+                return False
+            os.replace(temporary_path, self.path)
+        except OSError:
+            if os.path.exists(temporary_path):
+                try:
+                    os.remove(temporary_path)
+                except OSError:
+                    pass
+            return False
+        return True
+
+    def finished(self, result: bool):
+        running_result_tasks.discard(self)
+        if result_tasks.get(self.path) is self:
+            del result_tasks[self.path]
+        layer = QgsProject.instance().mapLayer(self.layer_id)
+        if not result and not self.isCanceled() and layer is not None and storedResultInfo(layer) == self.info:
+            removeResult(layer, self.path)
+
+
+def storedResultInfo(layer: QgsVectorLayer) -> dict:
+    """
+    カスタムプロパティに保存したフィルター結果の情報を取得する
+    """
+    try:
+        info = json.loads(layer.customProperty(RESULT_PROPERTY, "{}") or "{}")
+    except ValueError:
+        return dict()
+    return info if isinstance(info, dict) else dict()
+
+
+def storeResult(layer: QgsVectorLayer, path, filter: str, fids):
+    """
+    フィルター結果の地物IDを保存する
+
+    情報はカスタムプロパティにすぐ保存し、地物IDのファイルはバックグラウンドで書き出す。
+    データの版が求められない場合や、保存しない設定の場合は保存済みの結果を削除する。
+
+    @param  layer:対象レイヤ
+    @param  path:保存するファイル（resultPathで求めたもの）
+    @param  filter:全体のフィルター式
+    @param  fids:地物IDの集合（フィルターがない場合はNone）
+    """
+    revision = dataRevision(layer)
+    if path is None or revision is None or fids is None or not isResultPersistent():
+        removeResult(layer, path)
+        return
+
+    info = {"revision": revision, "filter": filter, "count": len(fids)}
+    if storedResultInfo(layer) == info and (path in result_tasks or os.path.exists(path)):
+        # 保存済みの結果と同じ
+        return
+
+    cancelStoreResult(path)
+    layer.setCustomProperty(RESULT_PROPERTY, json.dumps(info, ensure_ascii=False))
+    task = EasyAttributeFilterResultWriteTask(layer, path, info, fids)
+    result_tasks[path] = task
+    running_result_tasks.add(task)
+    QgsApplication.taskManager().addTask(task)
+
+
+def cancelStoreResult(path):
+    """
+    保存中のフィルター結果の書き出しを中止する
+    """
+    task = result_tasks.pop(path, None)
+    if task is not None:
+        task.cancel()
+
+
+def loadResult(layer: QgsVectorLayer, path, filter: str):
+    """
+    保存したフィルター結果の地物IDを読み込む
+
+    @param  layer:対象レイヤ
+    @param  path:保存したファイル（resultPathで求めたもの）
+    @param  filter:全体のフィルター式
+    @return 地物IDの集合（保存時とフィルターやデータの版が異なる場合、書き出しが終わっていない場合はNone）
+    """
+    if not isResultPersistent():
+        return None
+    info = storedResultInfo(layer)
+    if path is None or info.get("filter") != filter:
+        return None
+    revision = dataRevision(layer)
+    if revision is None or info.get("revision") != revision:
+        return None
+
+    values = array("q")
+    try:
+        with open(path, "rb") as file:
+            values.fromfile(file, info.get("count", 0) + 1)
+    except (OSError, EOFError):
+        return None
+    if values[0] != resultKey(info):
+        return None
+    return set(values[1:])
+
+
+def removeResult(layer: QgsVectorLayer, path):
+    """
+    保存したフィルター結果を削除する
+
+    @param  layer:対象レイヤ
+    @param  path:保存したファイル（resultPathで求めたもの）
+    """
+    layer.removeCustomProperty(RESULT_PROPERTY)
+    cancelStoreResult(path)
+    if path is not None and os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,502 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterTableFilterModel
+                                 A QGIS plugin
+ 並び替え順をキャッシュする属性テーブルのフィルターモデル
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+"""
+import bisect
+import datetime
+import weakref
+from array import array
+
+from qgis.PyQt.QtCore import Qt, QDate, QDateTime, QSortFilterProxyModel, QTimer
+from qgis.core import QgsFeatureRequest, QgsExpression, QgsExpressionFunction
+from qgis.gui import QgsAttributeTableFilterModel, QgsAttributeTableModel, QgsMapCanvas
+
+from .easy_attribute_filter_column_cache import isNullValue
+from .easy_attribute_filter_cache_stats import PHASE_SORT
+
+# 行単位で順位を更新する上限行数（超える場合は作り直す）
+INCREMENTAL_ROW_LIMIT = 1000
+# 並び替えの順位を返す式関数（先頭が_の関数は式ビルダーに表示されない）
+SORT_RANK_FUNCTION = "_easy_attribute_filter_sort_rank"
+
+# {モデルのキー: フィルターモデル}
+sort_rank_models = weakref.WeakValueDictionary()
+# 登録した式関数
+_sort_rank_function = None
+
+
+class SortRankFunction(QgsExpressionFunction):
+    """
+    フィルターモデルが求めた地物の順位を返す式関数
+
+    _easy_attribute_filter_sort_rank(モデルのキー, $id)
+    元モデルの並び替え用の値（SortRole）を作成するために使用する。
+    """
+
+    def __init__(self):
+        super(SortRankFunction, self).__init__(SORT_RANK_FUNCTION, 2, "Custom")
+
+    def func(self, values, context, parent, node):
+        model = sort_rank_models.get(values[0])
+        return model.sortRankOf(values[1]) if model is not None else None
+
+    def usesGeometry(self, node) -> bool:
+        return False
+
+    def referencedColumns(self, node):
+        return []
+
+
+def registerSortRankFunction():
+    """
+    並び替えの順位を返す式関数を登録する
+    """
+    global _sort_rank_function
+    if _sort_rank_function is None:
+        _sort_rank_function = SortRankFunction()
+        QgsExpression.registerFunction(_sort_rank_function)
+
+
+def unregisterSortRankFunction():
+    """
+    並び替えの順位を返す式関数の登録を解除する
+    """
+    global _sort_rank_function
+    if _sort_rank_function is not None:
+        QgsExpression.unregisterFunction(SORT_RANK_FUNCTION)
+        _sort_rank_function = None
+
+
+def sortKey(value):
+    """
+    並び替え用の型付きキーを作成する
+
+    NULLは最小とし、異なる型の値は型ごとにまとめる。
+
+    @param  value:属性値
+    """
+    if isNullValue(value):
+        return (0,)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (1, float(value))
+    if isinstance(value, QDateTime):
+        return (2, value.toPyDateTime())
+    if isinstance(value, QDate):
+        return (2, datetime.datetime.combine(value.toPyDate(), datetime.time()))
+    if isinstance(value, datetime.datetime):
+        return (2, value)
+    if isinstance(value, datetime.date):
+        return (2, datetime.datetime.combine(value, datetime.time()))
+    if isinstance(value, str):
+        return (3, value)
+    return (4, str(value))
+
+
+class ColumnRanks:
+    """
+    列の順位（元モデルの行ごと）
+
+    同じ値は同じ順位とする。編集で新しい値が現れた場合は前後の値の順位の中間を割り当て、
+    他の行の順位を変えずに更新する。
+    """
+
+    def __init__(self, keys: list):
+        """
+        コンストラクタ
+
+        @param  keys:行ごとの並び替えキー
+        """
+        self.sorted_keys = sorted(set(keys))
+        self.key_ranks = {key: float(rank) for rank, key in enumerate(self.sorted_keys)}
+        self.ranks = array("d", [self.key_ranks[key] for key in keys])
+
+    @classmethod
+    def fromRanks(cls, sorted_keys: list, ranks: array):
+        """
+        求め済みの順位から作成する
+
+        @param  sorted_keys:昇順に並べた固有のキー（順位はリストの位置）
+        @param  ranks:行ごとの順位
+        """
+        column_ranks = cls([])
+        column_ranks.sorted_keys = sorted_keys
+        column_ranks.key_ranks = {key: float(rank) for rank, key in enumerate(sorted_keys)}
+        column_ranks.ranks = ranks
+        return column_ranks
+
+    def rankOf(self, key):
+        """
+        キーの順位を取得する（未登録のキーは前後の中間の順位を割り当てる）
+
+        @return 順位（割り当てられない場合はNone）
+        """
+        if key in self.key_ranks:
+            return self.key_ranks[key]
+
+        index = bisect.bisect_left(self.sorted_keys, key)
+        lower = self.key_ranks[self.sorted_keys[index - 1]] if index > 0 else None
+        upper = self.key_ranks[self.sorted_keys[index]] if index < len(self.sorted_keys) else None
+        if lower is None and upper is None:
+            rank = 0.0
+        elif lower is None:
+            rank = upper - 1.0
+        elif upper is None:
+            rank = lower + 1.0
+        else:
+            rank = (lower + upper) / 2.0
+            if rank == lower or rank == upper:
+                # 中間の値がなくなった場合
+                return None
+
+        self.sorted_keys.insert(index, key)
+        self.key_ranks[key] = rank
+        return rank
+
+    def setKey(self, row: int, key) -> bool:
+        """
+        行のキーを更新する
+
+        @return 更新できたか（Falseの場合は作り直しが必要）
+        """
+        rank = self.rankOf(key)
+        if rank is None:
+            return False
+        self.ranks[row] = rank
+        return True
+
+    def insertKeys(self, row: int, keys: list) -> bool:
+        """
+        行を挿入する
+
+        @return 更新できたか（Falseの場合は作り直しが必要）
+        """
+        ranks = [self.rankOf(key) for key in keys]
+        if None in ranks:
+            return False
+        self.ranks[row:row] = array("d", ranks)
+        return True
+
+    def removeRows(self, first: int, last: int):
+        """
+        行を削除する
+        """
+        del self.ranks[first:last + 1]
+
+
+class EasyAttributeFilterTableFilterModel(QgsAttributeTableFilterModel):
+    """
+    列ごとの並び順（順位）をキャッシュするフィルターモデル
+
+    順位は読み込み済みの行について型付きキーで一度だけ求め、昇順・降順の切り替えや
+    フィルター変更後の再並び替え、複数列の並び替えではキャッシュした順位を再利用する。
+    編集で変更・追加・削除された行は、その行の順位のみを更新する。
+
+    行の比較はPythonで行わず、順位を元モデルの並び替え用の値として1回だけ渡し、
+    QgsAttributeTableFilterModelの比較（C++）で並び替える。
+    """
+
+    def __init__(self, canvas: QgsMapCanvas, source_model: QgsAttributeTableModel, parent=None):
+        super(EasyAttributeFilterTableFilterModel, self).__init__(canvas, source_model, parent)
+
+        # 並び替えキー [(列番号, 昇順)]
+        self.sort_keys = []
+        # 元モデルの行ごとの順位（並び替えなしの場合はNone）
+        self.sort_ranks = None
+        # 元モデルの並び替え用の値として渡した順位（編集で変わった場合はNone）
+        self.applied_ranks = None
+        self.sort_rank_key = str(id(self))
+        sort_rank_models[self.sort_rank_key] = self
+        registerSortRankFunction()
+        # 元モデルの列ごとの順位
+        self.rank_cache = dict()
+        # 列データの取得元（ディスクキャッシュまたはSQL）
+        self.column_store = None
+        # 式によるフィールドの値の保持
+        self.virtual_columns = None
+        # 行の読み込みの統計
+        self.cache_stats = None
+
+        # 元モデルの行が変わった場合は順位を作り直す
+        self.resort_timer = QTimer(self)
+        self.resort_timer.setSingleShot(True)
+        self.resort_timer.timeout.connect(self.resort)
+        source_model.modelReset.connect(self.invalidateSortCache)
+        source_model.rowsInserted.connect(self.onSourceRowsInserted)
+        source_model.rowsRemoved.connect(self.onSourceRowsRemoved)
+        source_model.dataChanged.connect(self.onSourceDataChanged)
+
+    def sortRankOf(self, fid: int):
+        """
+        地物の順位を取得する（式関数から呼ばれる）
+
+        @return 順位（並び替えなし、または元モデルにない地物の場合はNone）
+        """
+        ranks = self.sort_ranks
+        if ranks is None:
+            return None
+        row = self.masterModel().idToRow(fid)
+        if row < 0 or row >= len(ranks):
+            return None
+        return ranks[row]
+
+    def applySortRanks(self):
+        """
+        順位を元モデルの並び替え用の値として渡す（渡し済みの場合は何もしない）
+
+        元モデルは地物IDごとに値を保持するため、フィルターの変更では渡し直さない。
+        """
+        if self.sort_ranks is self.applied_ranks:
+            return
+        self.masterModel().prefetchSortData(f"{SORT_RANK_FUNCTION}('{self.sort_rank_key}', $id)")
+        self.applied_ranks = self.sort_ranks
+
+    def invalidateSortCache(self, *args):
+        """
+        順位のキャッシュを破棄し、並び替え中であれば再度並び替える
+        """
+        self.rank_cache.clear()
+        self.sort_ranks = None
+        self.applied_ranks = None
+        if len(self.sort_keys) > 0:
+            self.resort_timer.start(0)
+
+    def rowKeys(self, source_column: int, first: int, last: int) -> list:
+        """
+        元モデルの行範囲の並び替えキーを取得する
+        """
+        master_model = self.masterModel()
+        field_index = master_model.fieldIdx(source_column)
+        fids = [master_model.rowToId(row) for row in range(first, last + 1)]
+
+        request = QgsFeatureRequest()
+        request.setFilterFids(fids)
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([field_index])
+        values = {feature.id(): feature.attribute(field_index) for feature in self.featureSource(len(fids)).getFeatures(request)}
+        return [sortKey(values.get(fid)) for fid in fids]
+
+    def featureSource(self, row_count: int):
+        """
+        並び替えキーの読み込み元を取得し、統計に加算する
+
+        全地物をキャッシュしている場合はレイヤキャッシュから、そうでない場合は
+        キャッシュの行を追い出さないようレイヤから直接読み込む。
+
+        @param  row_count:読み込む行数
+        """
+        layer_cache = self.layerCache()
+        if layer_cache.hasFullCache():
+            self.recordStats(row_count, 0)
+            return layer_cache
+        # キャッシュを経由しないため、ミスではなく直接読み込みとして数える
+        self.recordReads(row_count)
+        return self.layer()
+
+    def recordStats(self, hits: int, misses: int):
+        if self.cache_stats is not None:
+            self.cache_stats.record(PHASE_SORT, hits, misses)
+
+    def recordReads(self, reads: int):
+        if self.cache_stats is not None:
+            self.cache_stats.recordReads(PHASE_SORT, reads)
+
+    def onSourceRowsInserted(self, parent, first: int, last: int):
+        """
+        追加された行の順位を求める
+        """
+        if last - first + 1 > INCREMENTAL_ROW_LIMIT:
+            self.invalidateSortCache()
+            return
+
+        for source_column, column_ranks in list(self.rank_cache.items()):
+            if not column_ranks.insertKeys(first, self.rowKeys(source_column, first, last)):
+                del self.rank_cache[source_column]
+        self.updateSortRanks()
+
+    def onSourceRowsRemoved(self, parent, first: int, last: int):
+        """
+        削除された行の順位を削除する
+        """
+        for column_ranks in self.rank_cache.values():
+            column_ranks.removeRows(first, last)
+        self.updateSortRanks()
+
+    def onSourceDataChanged(self, top_left, bottom_right, roles=None):
+        """
+        変更された行の順位を求め直す
+        """
+        first = top_left.row()
+        last = bottom_right.row()
+        if last - first + 1 > INCREMENTAL_ROW_LIMIT:
+            self.invalidateSortCache()
+            return
+
+        for source_column in range(top_left.column(), bottom_right.column() + 1):
+            column_ranks = self.rank_cache.get(source_column)
+            if column_ranks is None:
+                continue
+            for row, key in zip(range(first, last + 1), self.rowKeys(source_column, first, last)):
+                if not column_ranks.setKey(row, key):
+                    del self.rank_cache[source_column]
+                    break
+        self.updateSortRanks()
+
+    def updateSortRanks(self):
+        """
+        キャッシュした列の順位から並び替えに使う順位を求め直す
+
+        行の表示位置は次の並び替えまで維持する。
+        """
+        if len(self.sort_keys) == 0:
+            return
+
+        source_keys = [(self.sourceColumn(column), ascending) for column, ascending in self.sort_keys]
+        if any(column not in self.rank_cache for column, _ in source_keys):
+            # 作り直しが必要な列がある
+            self.sort_ranks = None
+            self.applied_ranks = None
+            self.resort_timer.start(0)
+            return
+
+        self.sort_ranks = self.combinedRanks(source_keys)
+        # 渡し済みの値は次の並び替えで渡し直す
+        self.applied_ranks = None
+
+    def resort(self):
+        """
+        現在の並び替えキーで再度並び替える
+        """
+        if len(self.sort_keys) > 0:
+            self.sortColumns(self.sort_keys)
+
+    def sourceColumn(self, column: int) -> int:
+        """
+        表示列に対応する元モデルの列番号を取得する（表示行がない場合も求める）
+        """
+        return self.mapColumnToSource(column)
+
+    def columnRanks(self, source_column: int) -> array:
+        """
+        元モデルの列の順位を取得する（同じ値は同じ順位）
+
+        @param  source_column:元モデルの列番号
+        """
+        master_model = self.masterModel()
+        field_index = master_model.fieldIdx(source_column)
+        row_count = master_model.rowCount()
+
+        if source_column in self.rank_cache:
+            self.recordStats(row_count, 0)
+            return self.rank_cache[source_column].ranks
+
+        column_ranks = self.storedColumnRanks(field_index)
+        if column_ranks is not None:
+            self.recordStats(row_count, 0)
+            self.rank_cache[source_column] = column_ranks
+            return column_ranks.ranks
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([field_index])
+        values = {feature.id(): feature.attribute(field_index) for feature in self.featureSource(row_count).getFeatures(request)}
+
+        keys = [sortKey(values.get(master_model.rowToId(row))) for row in range(row_count)]
+
+        column_ranks = ColumnRanks(keys)
+        self.rank_cache[source_column] = column_ranks
+        return column_ranks.ranks
+
+    def setColumnStore(self, column_store):
+        """
+        列データの取得元を設定する
+
+        @param  column_store:ディスクキャッシュまたはSQL（使用しない場合はNone）
+        """
+        self.column_store = column_store
+        self.rank_cache.clear()
+
+    def setVirtualColumns(self, virtual_columns):
+        """
+        式によるフィールドの値の保持を設定する
+
+        @param  virtual_columns:式によるフィールドの値の保持（使用しない場合はNone）
+        """
+        self.virtual_columns = virtual_columns
+        self.rank_cache.clear()
+
+    def storedColumnRanks(self, field_index: int):
+        """
+        列データの取得元から順位を求める
+
+        @return 列の順位（取得元で解決できない場合はNone）
+        """
+        field_name = self.layer().fields().at(field_index).name()
+        store = self.column_store
+        if self.virtual_columns is not None and self.virtual_columns.materialize(field_name):
+            store = self.virtual_columns
+        if store is None:
+            return None
+
+        master_model = self.masterModel()
+        fids = [master_model.rowToId(row) for row in range(master_model.rowCount())]
+        result = store.sortRanks(field_name, fids)
+        if result is None:
+            return None
+
+        uniques, ranks = result
+        return ColumnRanks.fromRanks([sortKey(value) for value in uniques], ranks)
+
+    def combinedRanks(self, source_keys: list) -> array:
+        """
+        並び替えに使う順位を求める
+
+        @param  source_keys:並び替えキー [(元モデルの列番号, 昇順)]
+        """
+        if len(source_keys) == 1:
+            # 単一列は順位をそのまま使い、昇順・降順は並び替え方向で切り替える
+            return self.columnRanks(source_keys[0][0])
+
+        # 複数列は優先度の低い列から安定ソートを重ねて順位を合成する
+        rows = list(range(self.masterModel().rowCount()))
+        for source_column, ascending in reversed(source_keys):
+            rows.sort(key=self.columnRanks(source_column).__getitem__, reverse=not ascending)
+        ranks = array("d", [0.0]) * len(rows)
+        for position, row in enumerate(rows):
+            ranks[row] = position
+        return ranks
+
+    def sortColumns(self, sort_keys: list):
+        """
+        複数列で並び替える
+
+        @param  sort_keys:並び替えキー [(列番号, 昇順)]（先頭が優先）
+        """
+        self.sort_keys = list(sort_keys)
+
+        source_keys = [(self.sourceColumn(column), ascending) for column, ascending in self.sort_keys]
+        source_keys = [(column, ascending) for column, ascending in source_keys if column >= 0]
+        if len(source_keys) == 0:
+            self.sort_ranks = None
+            self.applied_ranks = None
+            QSortFilterProxyModel.sort(self, -1)
+            return
+
+        ranks = self.combinedRanks(source_keys)
+        order = Qt.AscendingOrder
+        if len(source_keys) == 1 and not source_keys[0][1]:
+            order = Qt.DescendingOrder
+
+        self.sort_ranks = ranks
+        self.applySortRanks()
+
+        column = self.sort_keys[0][0]
+        if self.sortColumn() == column and self.sortOrder() == order:
+            # 同じ列・方向では並び替えが行われないため、一度解除する
+            QSortFilterProxyModel.sort(self, -1, order)
+        QSortFilterProxyModel.sort(self, column, order)
@@ -10,17 +10,51 @@
 """
 import os
 import re
+import datetime
+import unicodedata
 
 from qgis.PyQt import uic
 from qgis.PyQt.QtWidgets import QWidget, QMessageBox, QStyle, QTreeView
-from qgis.PyQt.QtCore import pyqtSignal, Qt, QVariant, QSortFilterProxyModel, QModelIndex
+from qgis.PyQt.QtCore import pyqtSignal, Qt, QVariant, QSortFilterProxyModel, QModelIndex, QTimer
 from qgis.PyQt.QtGui import QStandardItemModel, QStandardItem
 
 from qgis.gui import QgsAttributeTableFilterModel
 
+from .easy_attribute_filter_column_cache import EasyAttributeFilterColumnCache, isNullValue
+from .easy_attribute_filter_sketch import TOP_VALUE_COUNT
+from .easy_attribute_filter_match import EasyAttributeFilterMatchEstimator
+from .easy_attribute_filter_engine import valueSetExpression, dateRangeExpression
+
 FORM_CLASS, _ = uic.loadUiType(os.path.join(
     os.path.dirname(__file__), 'easy_attribute_filter_values_base.ui'))
 
+# カタカナ→ひらがな変換表
+KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+# 空白文字
+WHITESPACE_PATTERN = re.compile(r"\s+")
+# 日付の階層表示を行う型
+TEMPORAL_TYPES = (QVariant.Date, QVariant.DateTime)
+
+def normalizeText(text: str) -> str:
+    """
+    あいまい検索用の正規化キーを作成する
+
+    全角/半角（NFKC）、カタカナ/ひらがな、大文字/小文字、空白の有無を同一視する。
+
+    @param  text:文字列
+    @return 正規化した文字列
+    """
+    normalized = unicodedata.normalize("NFKC", text).translate(KATAKANA_TO_HIRAGANA).lower()
+    return WHITESPACE_PATTERN.sub("", normalized)
+
+def valueSortKey(value):
+    """
+    固有値の並び替えキー（NULLは末尾）
+    """
+    if isNullValue(value):
+        return (1, 0)
+    return (0, value)
+
 class EasyAttributeFilterValues(QWidget, FORM_CLASS):
 
     canceld = pyqtSignal()
@@ -40,27 +74,49 @@ class EasyAttributeFilterValues(QWidget, FORM_CLASS):
 
         self.field_name = ""
         self.is_numeric = True
+        self.field_type = QVariant.Invalid
+        self.is_date_tree = False
         self.expression = ""
 
+        # 上限件数を超えた場合の固有値の数（正確な値か）
+        self.distinct_count = 0
+        self.is_distinct_exact = True
+
+        # 変更したチェックを子に反映している間は、親の状態を更新しない
+        self.propagating_check = False
+
         # 検索ラインエディット
         self.filter_value_edit.setShowSearchIcon(True)
         self.filter_value_edit.setPlaceholderText("検索")
 
         # 既定件数超過警告ラベル＆アイコン
-        label_textcolor = self.message_label.palette().windowText().color().name()
         self.message_label.setTextFormat(Qt.RichText)
-        self.message_label.setText(f'<a href="./"><span style="color:{label_textcolor};">一部のデータは表示されていません</span></a>')
+        self.setWarningText("一部のデータは表示されていません")
         self.message_label.setOpenExternalLinks(False)
         self.message_label.linkActivated.connect(self.openWarningLink)
         icon_size = self.icon_label.style().pixelMetric(QStyle.PM_SmallIconSize)
         self.icon_label.setPixmap(self.icon_label.style().standardIcon(QStyle.SP_MessageBoxWarning).pixmap(icon_size, icon_size))
         self.showWarning(False)
+        self.approximate_label.setVisible(False)
 
         self.sample_model = QStandardItemModel(self)
         self.sample_model.itemChanged.connect(self.checkAll)
 
+        # 一致する件数（チェックの変更が止まってから求める）
+        self.estimator = None
+        self.estimate_timer = QTimer(self)
+        self.estimate_timer.setSingleShot(True)
+        self.estimate_timer.setInterval(300)
+        self.estimate_timer.timeout.connect(self.updateMatchCount)
+        self.sample_model.itemChanged.connect(lambda: self.estimate_timer.start())
+
         self.proxy_model = TreeFilterSortProxyModel()
-        self.proxy_model.setFilterCaseSensitivity(Qt.CaseInsensitive)
+
+        # 入力中に毎回検索しないよう、入力が止まってから検索する
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(200)
+        self.search_timer.timeout.connect(self.applySearch)
 
         self.cancel_button.clicked.connect(lambda: self.canceld.emit())
         self.ok_button.clicked.connect(self.onOkClicked)
@@ -68,14 +124,28 @@ class EasyAttributeFilterValues(QWidget, FORM_CLASS):
         self.filter_value_edit.cleared.connect(self.onFilterCleared)
 
     def clear(self):
+        self.search_timer.stop()
+        self.estimate_timer.stop()
+        if self.estimator is not None:
+            self.estimator.cancel()
+        self.match_count_label.setText("")
+        self.approximate_label.setVisible(False)
+        self.is_date_tree = False
+        self.treeView.setRootIsDecorated(False)
+        self.treeView.setItemsExpandable(False)
         self.treeView.setModel(None)
         self.proxy_model.setSourceModel(None)
+        self.proxy_model.setSearchKeys([])
         self.sample_model.clear()
         self.filter_value_edit.clearValue()
 
-    def setValues(self, column: int, filter_model: QgsAttributeTableFilterModel, expression: str ):
+    def setValues(self, column: int, filter_model: QgsAttributeTableFilterModel, expression: str, column_cache: EasyAttributeFilterColumnCache=None, cross_filter: tuple=None):
         """
         地物の数値を取得して表示する
+
+        他の列にフィルターがある場合は、それを通過した地物の値のみを件数付きで表示する。
+
+        @param  cross_filter:(他の列のフィルター式のリスト, 通過した地物IDの集合（分からない場合はNone）)
         """
 
         self.clear()
@@ -87,16 +157,49 @@ class EasyAttributeFilterValues(QWidget, FORM_CLASS):
 
         self.field_name = field.name()
         self.is_numeric = field.isNumeric()
+        self.field_type = field.type()
+
+        # プレビュー中は標本からの概算であることを表示する
+        self.approximate_label.setVisible(column_cache is not None and column_cache.isApproximate(field_index))
+
+        if self.isTemporal() and column_cache is not None:
+            # 日付は年・月・日の階層で表示する
+            self.setDateValues(field_index, column_cache, expression, cross_filter)
+            return
 
         (prev_is_null, phrase_in, prev_values) = self.parseExpression(expression)
         defaul_checked = len(expression) == 0 or phrase_in == False or (len(prev_values) == 0 and prev_is_null==False)
 
-        # 対象レイヤーから指定列の固有値を取得する
-        uniques = filter_model.layer().uniqueValues(field_index, self.max_count + 1)
+        # 対象レイヤーから指定列の固有値を取得する（先読み済みの場合はその結果を使う）
+        value_counts = None
+        if column_cache is not None and cross_filter is not None:
+            # 他の列のフィルターを通過した地物の値のみ
+            value_counts, null_count = column_cache.crossValueCounts(field_index, *cross_filter)
+            uniques = set(value_counts.keys())
+            if null_count > 0:
+                uniques.add(None)
+        elif column_cache is not None:
+            uniques = column_cache.uniqueValues(field_index, self.max_count + 1)
+        else:
+            uniques = filter_model.layer().uniqueValues(field_index, self.max_count + 1)
 
         # データ件数超過の場合警告を表示する
         data_count = len(uniques) 
+        top_values = []
         if data_count > self.max_count:
+            if value_counts is not None:
+                self.distinct_count = len(value_counts)
+                top_values = sorted(value_counts.items(), key=lambda item: -item[1])[0:TOP_VALUE_COUNT]
+                self.is_distinct_exact = True
+                self.setWarningText(f"固有値 {self.distinct_count:,}件（頻出値を先頭に表示）")
+            elif column_cache is not None:
+                # 固有値の数と頻出値を求め、頻出値を先頭に表示する
+                self.distinct_count, top_values, self.is_distinct_exact = column_cache.valueFrequencies(field_index)
+                approximate = "" if self.is_distinct_exact else "約"
+                self.setWarningText(f"固有値 {approximate}{self.distinct_count:,}件（頻出値を先頭に表示）")
+            else:
+                self.distinct_count = 0
+                self.setWarningText("一部のデータは表示されていません")
             self.showWarning(True)
             data_count = self.max_count
         else:
@@ -109,43 +212,229 @@ class EasyAttributeFilterValues(QWidget, FORM_CLASS):
 
         self.sample_model.blockSignals(True)
 
+        # 検索用の正規化キー（子の行番号順）
+        search_keys = []
+
         # サンプル用のデータモデルを作成する
         root = self.createTreeItem("(すべて選択)", defaul_checked)
         root.setTristate(True)
         self.sample_model.appendRow(root)
 
-        values = sorted(list(uniques))
-        for row in range(0, data_count):
-            value = values[row]
-
+        # 頻出値（件数付き）の後に残りの値を昇順で並べる
+        frequencies = dict(top_values)
+        values = [value for value, _ in top_values]
+        values += [value for value in sorted(list(uniques), key=valueSortKey) if value not in frequencies][0:data_count - len(values)]
+        for value in values:
             if value is None or (isinstance(value, QVariant) and value.isNull()):
                 has_null = True
                 continue
             if self.is_numeric == False and len(str(value)) == 0:
                 has_blank = True
                 continue
-            item = self.createTreeItem(str(value), defaul_checked or (value in prev_values))
+            text = str(value)
+            if value_counts is not None:
+                text = f"{value} ({value_counts[value]:,})"
+            elif value in frequencies:
+                approximate = "" if self.is_distinct_exact else "約"
+                text = f"{value}（{approximate}{frequencies[value]:,}件）"
+            item = self.createTreeItem(text, defaul_checked or (value in prev_values))
             sub_item = QStandardItem(str(value))
             root.appendRow([item, sub_item])
+            search_keys.append(normalizeText(str(value)))
 
         if has_null:
             item = self.createTreeItem("(NULL)", defaul_checked or prev_is_null)
             sub_item = QStandardItem("IS NULL")
             root.appendRow([item, sub_item])
+            search_keys.append(normalizeText("(NULL)"))
 
         if has_blank:
             item = self.createTreeItem("(空白)", defaul_checked or ('' in prev_values))
             sub_item = QStandardItem("''")
             root.appendRow([item, sub_item])
+            search_keys.append(normalizeText("(空白)"))
 
         self.sample_model.blockSignals(False)
 
+        self.proxy_model.setSearchKeys(search_keys)
         self.proxy_model.setSourceModel(self.sample_model)
         self.treeView.setModel(self.proxy_model)
         self.treeView.setColumnHidden(1, True)
         self.treeView.expandAll()
 
 
+    def isTemporal(self) -> bool:
+        """
+        日付の階層表示を行うフィールドか判定する
+        """
+        return self.field_type in TEMPORAL_TYPES
+
+    def setDateValues(self, field_index: int, column_cache: EasyAttributeFilterColumnCache, expression: str, cross_filter: tuple=None):
+        """
+        日付を年・月・日の階層で表示する
+
+        @param  field_index:フィールドindex
+        @param  column_cache:列データのキャッシュ
+        @param  expression:前回のフィルター式
+        @param  cross_filter:(他の列のフィルター式のリスト, 通過した地物IDの集合（分からない場合はNone）)
+        """
+        if cross_filter is not None:
+            counts, null_count = column_cache.crossDateCounts(field_index, *cross_filter)
+        else:
+            counts, null_count = column_cache.dateCounts(field_index)
+        (prev_ranges, prev_is_null) = self.parseDateExpression(expression)
+        defaul_checked = len(expression) == 0 or (len(prev_ranges) == 0 and prev_is_null == False)
+
+        self.showWarning(False)
+        self.sample_model.setColumnCount(2)
+        self.sample_model.blockSignals(True)
+
+        search_keys = []
+
+        root = self.createTreeItem("(すべて選択)", defaul_checked)
+        root.setTristate(True)
+        self.sample_model.appendRow(root)
+
+        year_item = None
+        month_item = None
+        for date in sorted(counts.keys()):
+            if year_item is None or year_item.data(Qt.UserRole) != date.year:
+                year_item = self.createDateItem(f"{date.year}年", date.year, f"{date.year:04}")
+                root.appendRow([year_item, QStandardItem(f"{date.year:04}")])
+                search_keys.append(normalizeText(f"{date.year}年"))
+                month_item = None
+            if month_item is None or month_item.data(Qt.UserRole) != date.month:
+                month_item = self.createDateItem(f"{date.month}月", date.month, f"{date.year:04}-{date.month:02}")
+                year_item.appendRow([month_item, QStandardItem(f"{date.year:04}-{date.month:02}")])
+
+            checked = defaul_checked or any(start <= date < end for start, end in prev_ranges)
+            day_item = self.createTreeItem(f"{date.day}日 ({counts[date]:,})", checked)
+            month_item.appendRow([day_item, QStandardItem(date.isoformat())])
+
+        # 日付の件数は子から集計する
+        for year_row in range(root.rowCount()):
+            year_item = root.child(year_row)
+            year_count = 0
+            for month_row in range(year_item.rowCount()):
+                month_item = year_item.child(month_row)
+                month_count = sum(counts[datetime.date.fromisoformat(month_item.child(day_row, 1).text())] for day_row in range(month_item.rowCount()))
+                month_item.setText(f"{month_item.text()} ({month_count:,})")
+                month_item.setCheckState(self.aggregateCheckState(month_item))
+                year_count += month_count
+            year_item.setText(f"{year_item.text()} ({year_count:,})")
+            year_item.setCheckState(self.aggregateCheckState(year_item))
+
+        if null_count > 0:
+            item = self.createTreeItem(f"(NULL) ({null_count:,})", defaul_checked or prev_is_null)
+            root.appendRow([item, QStandardItem("IS NULL")])
+            search_keys.append(normalizeText("(NULL)"))
+
+        root.setCheckState(self.aggregateCheckState(root))
+
+        self.sample_model.blockSignals(False)
+
+        self.is_date_tree = True
+        self.proxy_model.setSearchKeys(search_keys)
+        self.proxy_model.setSourceModel(self.sample_model)
+        self.treeView.setModel(self.proxy_model)
+        self.treeView.setColumnHidden(1, True)
+        self.treeView.setRootIsDecorated(True)
+        self.treeView.setItemsExpandable(True)
+        self.treeView.collapseAll()
+        self.treeView.expand(self.proxy_model.index(0, 0, QModelIndex()))
+
+    def createDateItem(self, text: str, value: int, key: str):
+        """
+        年・月のQStandardItemを生成する
+
+        @param  text:表示文字列
+        @param  value:年または月
+        @param  key:年月の文字列
+        """
+        item = self.createTreeItem(text, False)
+        item.setTristate(True)
+        item.setData(value, Qt.UserRole)
+        return item
+
+    def aggregateCheckState(self, item: QStandardItem):
+        """
+        子のチェック状態から親のチェック状態を求める
+        """
+        states = {item.child(row).checkState() for row in range(item.rowCount())}
+        if len(states) == 1:
+            return states.pop()
+        return Qt.PartiallyChecked if len(states) > 1 else item.checkState()
+
+    def parseDateExpression(self, expression: str):
+        """
+        日付の範囲式を解析する
+
+        @return (範囲(開始日, 終了日(含まない))のリスト, NULLを含むか)
+        """
+        if len(expression) == 0:
+            return ([], False)
+
+        field = re.escape(f'"{self.field_name}"')
+        pattern_range = re.compile(f"{field} >= to_date(?:time)?\\('(\\d{{4}}-\\d{{2}}-\\d{{2}})[^']*'\\) AND {field} < to_date(?:time)?\\('(\\d{{4}}-\\d{{2}}-\\d{{2}})[^']*'\\)")
+        ranges = [(datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)) for start, end in pattern_range.findall(expression)]
+        is_null = f'"{self.field_name}" IS NULL' in expression
+        return (ranges, is_null)
+
+    def dateRange(self, key: str):
+        """
+        年・年月・年月日の文字列から範囲を求める
+
+        @param  key:年（yyyy）、年月（yyyy-mm）、年月日（yyyy-mm-dd）
+        @return (開始日, 終了日(含まない))
+        """
+        parts = [int(part) for part in key.split("-")]
+        if len(parts) == 1:
+            return (datetime.date(parts[0], 1, 1), datetime.date(parts[0] + 1, 1, 1))
+        if len(parts) == 2:
+            start = datetime.date(parts[0], parts[1], 1)
+            end = datetime.date(parts[0] + 1, 1, 1) if parts[1] == 12 else datetime.date(parts[0], parts[1] + 1, 1)
+            return (start, end)
+        start = datetime.date(parts[0], parts[1], parts[2])
+        return (start, start + datetime.timedelta(days=1))
+
+    def checkedDateRanges(self, item: QStandardItem, ranges: list):
+        """
+        チェックされた日付の範囲を収集する
+
+        全てチェックされた年・月はまとめて１つの範囲とする。
+
+        @param  item:年・月・日のQStandardItem
+        @param  ranges:範囲の格納先
+        """
+        key = item.parent().child(item.row(), 1).text()
+        if item.checkState() == Qt.Checked:
+            start, end = self.dateRange(key)
+            if len(ranges) > 0 and ranges[-1][1] == start:
+                # 隣接する範囲は結合する
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        elif item.checkState() == Qt.PartiallyChecked:
+            for row in range(item.rowCount()):
+                self.checkedDateRanges(item.child(row), ranges)
+
+    def createDateExpression(self) -> str:
+        """
+        チェックされた日付から範囲の式を作成する
+        """
+        ranges = []
+        has_null = False
+
+        root_index = self.proxy_model.index(0, 0, QModelIndex())
+        for row in range(self.proxy_model.rowCount(root_index)):
+            item = self.sample_model.itemFromIndex(self.proxy_model.mapToSource(self.proxy_model.index(row, 0, root_index)))
+            if item.parent().child(item.row(), 1).text() == "IS NULL":
+                has_null = item.checkState() == Qt.Checked
+                continue
+            self.checkedDateRanges(item, ranges)
+
+        return dateRangeExpression(self.field_name, ranges, has_null, self.field_type == QVariant.DateTime)
+
     def createTreeItem(self, text: str, checked: bool):
         """
         QStandardItemを生成する
@@ -230,28 +519,89 @@ class EasyAttributeFilterValues(QWidget, FORM_CLASS):
 
     def onFilterChanged(self, text: str):
         """
-        Float判定
+        検索文字列変更
         """
-        if len(text) > 0:
-            self.proxy_model.setFilterRegExp(f".*{text}.*")
-        else:
-            self.proxy_model.setFilterRegExp("")
+        self.search_timer.start()
 
     def onFilterCleared(self):
         """
-        Float判定
+        検索文字列クリア
+        """
+        self.search_timer.stop()
+        self.proxy_model.setSearchText("")
+
+    def applySearch(self):
+        """
+        あいまい検索を実行する
+        """
+        self.proxy_model.setSearchText(self.filter_value_edit.value())
+        self.treeView.expandAll()
+        self.estimate_timer.start()
+
+    def setMatchEstimator(self, estimator: EasyAttributeFilterMatchEstimator):
+        """
+        一致する件数を求めるオブジェクトを設定する
+
+        @param  estimator:件数を求めるオブジェクト（表示しない場合はNone）
         """
-        self.proxy_model.setFilterRegExp("")
-        
+        self.estimate_timer.stop()
+        if self.estimator is not None:
+            self.estimator.cancel()
+            self.estimator.estimated.disconnect(self.onEstimated)
+            self.estimator.deleteLater()
+        self.estimator = estimator
+        self.match_count_label.setText("")
+        if estimator is not None:
+            estimator.estimated.connect(self.onEstimated)
+            self.estimate_timer.start()
+
+    def updateMatchCount(self):
+        """
+        チェックした値に一致する件数を求める
+        """
+        if self.estimator is None:
+            return
+
+        expression = self.currentExpression()
+        if len(expression) == 0:
+            self.estimator.cancel()
+            self.match_count_label.setText("")
+            return
+
+        self.match_count_label.setText("一致する件数を集計中…")
+        self.estimator.estimate(expression)
+
+    def onEstimated(self, count: int, is_exact: bool):
+        """
+        一致する件数を表示する
+        """
+        if is_exact:
+            self.match_count_label.setText(f"{count:,}件が一致します")
+        else:
+            self.match_count_label.setText(f"約{count:,}件が一致します（概算）")
+
     def onOkClicked(self):
         """
         Float判定
         """
+        self.expression = self.currentExpression()
+        if len(self.expression) == 0:
+            return
+
+        self.filterSet.emit(self.expression)
 
-        "式の作成"
+    def currentExpression(self) -> str:
+        """
+        チェックした値から式を作成する
+
+        @return 式（チェックした値がない場合は空）
+        """
         if self.proxy_model.rowCount() == 0:
-            self.expression = ""
-            return
+            return ""
+
+        if self.is_date_tree:
+            # 年・月・日の階層表示の場合
+            return self.createDateExpression()
 
         values = []
         has_null = False
@@ -271,28 +621,9 @@ class EasyAttributeFilterValues(QWidget, FORM_CLASS):
                     if child1 == "(NULL)" and child2 == "IS NULL":
                         has_null = True
                     else:
-                        value_text = child2
-                        if self.is_numeric or value_text == "''":
-                            values.append(value_text)
-                        else:
-                            values.append(f"'{value_text}'")
-
-        if len(values) == 0:
-            self.expression = ""
-            return
-        
-        values_joined = ",".join(values)
-
-        if len(values) > 0:
-            if has_null:
-                self.expression = f'("{self.field_name}" IN ({values_joined}) OR "{self.field_name}" IS NULL)'
-            else:
-                self.expression = f'"{self.field_name}" IN ({values_joined})'
-        else:
-            if has_null:
-                self.expression = f'"{self.field_name}" IS NULL'
+                        values.append(child2)
 
-        self.filterSet.emit(self.expression)
+        return valueSetExpression(self.field_name, values, has_null, self.is_numeric)
 
 
     def checkAll(self, item):
@@ -300,16 +631,17 @@ class EasyAttributeFilterValues(QWidget, FORM_CLASS):
         すべてチェック
         """
         checked = item.checkState()
-        if item.hasChildren():
-            if item.checkState() == Qt.PartiallyChecked:
-                return
-
-            # 全ての子供のチェックを同じにする
+        if item.hasChildren() and checked != Qt.PartiallyChecked:
+            # 全ての子供のチェックを同じにする（孫以下も連動する）
+            propagating_check = self.propagating_check
+            self.propagating_check = True
             row_count = item.rowCount()
             for row in range(0, row_count):
                 if item.child(row).checkState() != checked:
                     item.child(row).setCheckState(checked)
-        else:
+            self.propagating_check = propagating_check
+
+        if self.propagating_check == False:
             # 親のチェックを連動させる
             parent = item.parent()
             if parent:
@@ -343,21 +675,74 @@ class EasyAttributeFilterValues(QWidget, FORM_CLASS):
         self.icon_label.setVisible(flg)
     
 
+    def setWarningText(self, text: str):
+        """
+        警告メッセージ（リンク）を設定する
+        """
+        label_textcolor = self.message_label.palette().windowText().color().name()
+        self.message_label.setText(f'<a href="./"><span style="color:{label_textcolor};">{text}</span></a>')
+
+
     def openWarningLink(self, link: str):
         """
         warning表示
         """
+        if self.distinct_count > 0:
+            approximate = "" if self.is_distinct_exact else "約"
+            QMessageBox.warning(self.parentWidget(), "警告", f"このフィールドには、固有のアイテムが{approximate}{self.distinct_count:,}個存在します。\n"
+                                f"件数の多いアイテム（件数付き）の後に、{self.max_count:,}番目までのアイテムが表示されます。")
+            return
         QMessageBox.warning(self.parentWidget(), "警告", f"このフィールドには、{self.max_count:,}個を超える固有のアイテムが存在します。\n{self.max_count:,}番目までのアイテムが表示されます。")
 
 
 class TreeFilterSortProxyModel(QSortFilterProxyModel):
+    """
+    正規化キーによるあいまい検索を行うプロキシモデル
+
+    一致した値は編集距離（部分一致のため、キーと検索文字列の長さの差）の小さい順に並べる。
+    """
+    def __init__(self, parent=None):
+        super(TreeFilterSortProxyModel, self).__init__(parent)
+        self.search_keys = []
+        # 一致した子の行番号と編集距離（検索なしの場合はNone）
+        self.matched_rows = None
+
+    def setSearchKeys(self, search_keys: list):
+        """
+        子の行番号順の正規化キーを設定する
+        """
+        self.search_keys = search_keys
+        self.matched_rows = None
+
+    def setSearchText(self, text: str):
+        """
+        検索文字列を設定する
+        """
+        search_key = normalizeText(text)
+        if len(search_key) == 0:
+            self.matched_rows = None
+        else:
+            self.matched_rows = {row: len(key) - len(search_key) for row, key in enumerate(self.search_keys) if search_key in key}
+
+        self.invalidate()
+        self.sort(0 if self.matched_rows is not None else -1)
+
     def filterAcceptsRow(self, source_row, source_parent):
-        if self.filterRegExp().isEmpty():
+        if self.matched_rows is None:
             return True
 
-        index = self.sourceModel().index(source_row, 0, source_parent)
+        if not source_parent.isValid():
+            # (すべて選択)
+            return True
 
-        if self.sourceModel().hasChildren(index):
+        if source_parent.parent().isValid():
+            # 日付の月・日は年で検索する
             return True
 
-        return super().filterAcceptsRow(source_row, source_parent)
\ No newline at end of file
+        return source_row in self.matched_rows
+
+    def lessThan(self, left, right):
+        if self.matched_rows is None or not left.parent().isValid() or left.parent().parent().isValid():
+            return left.row() < right.row()
+
+        return (self.matched_rows.get(left.row(), 0), left.row()) < (self.matched_rows.get(right.row(), 0), right.row())
\ No newline at end of file
@@ -0,0 +1,282 @@
+"""
+/***************************************************************************
+ EasyAttributeFilterVirtualColumns
+                                 A QGIS plugin
+ 式によるフィールド（仮想フィールド）の値の保持
+                              -------------------
+        copyright            : (C) 2023 by orbitalnet.inc
+ ***************************************************************************/
+
+ 式によるフィールドは読み込みのたびに地物ごとに式を評価するため、フィルター・並び替え・
+ 固有値の一覧で繰り返し使うと保存されたフィールドより遅くなる。
+ フィルター・並び替え・固有値の一覧で初めて使われた際に全地物の値を1回だけ評価して
+ 列ごとの型付き配列に保持し、以降は保存されたフィールドと同じく配列で判定する。
+ 式が参照するフィールド・ジオメトリ（式によるフィールドを参照する場合はその参照先も含む）が
+ 変更された場合は、その列を破棄して次に使われた際に評価し直す。
+ 時刻・乱数・変数や、他の地物・レイヤを参照する関数（集計など）を含む式は、地物の編集なしに
+ 値が変わるため保持しない。
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from qgis.PyQt.QtCore import QObject, pyqtSignal
+from qgis.core import QgsExpression, QgsFeatureRequest, QgsFields, QgsVectorLayer
+
+from .easy_attribute_filter_columnar import ColumnarSource, COLUMN_KINDS, toColumnValue, isNumpyAvailable
+from .easy_attribute_filter_compact import CompactColumnBuilder
+from .easy_attribute_filter_planner import logPlan
+
+# 評価のたびに値が変わる、または他の地物・レイヤを参照する関数
+IMPURE_FUNCTIONS = {"now", "rand", "randf", "uuid", "var", "eval", "eval_template", "env", "get_feature", "get_feature_by_id",
+                    "aggregate", "relation_aggregate", "layer_property", "represent_value", "sqlite_fetch_and_increment"}
+# 他の地物を参照する関数のグループ
+IMPURE_FUNCTION_GROUPS = {"Aggregates"}
+
+
+def isDeterministic(expression: QgsExpression) -> bool:
+    """
+    式の値が地物自身の属性・ジオメトリのみで決まるか判定する
+
+    @param  expression:式
+    """
+    if len(expression.referencedVariables()) > 0:
+        return False
+    functions = QgsExpression.Functions()
+    for name in expression.referencedFunctions():
+        if name in IMPURE_FUNCTIONS or name.startswith("overlay_"):
+            return False
+        function_index = QgsExpression.functionIndex(name)
+        if function_index >= 0 and len(IMPURE_FUNCTION_GROUPS.intersection(functions[function_index].groups())) > 0:
+            return False
+    return True
+
+
+class EasyAttributeFilterVirtualColumns(QObject, ColumnarSource):
+    """
+    式によるフィールドの値を列ごとの型付き配列で保持する
+
+    列はmaterializeで作成し、作成済みの列のみを列データの取得元として使用する。
+    """
+
+    # 列を破棄した
+    invalidated = pyqtSignal()
+
+    def __init__(self, layer: QgsVectorLayer, parent=None):
+        """
+        コンストラクタ
+
+        @param  layer:対象レイヤ
+        """
+        super(EasyAttributeFilterVirtualColumns, self).__init__(parent)
+        self.layer = layer
+
+        # 全ての列で共通の地物ID（昇順）
+        self.fid_array = None
+        # {フィールド名: (列の種類, 値の配列, NULLのビット列, 辞書)}
+        self.columns = dict()
+        # {フィールド名: (参照するフィールド名の集合, ジオメトリを参照するか)}
+        self.dependencies = dict()
+        # 変換できない値があり保持できなかった列（破棄まで評価し直さない）
+        self.failed = set()
+        # NULLの配列（ビット列から展開したもの）は直近の1列のみ保持する
+        self.null_cache = (None, None)
+
+    @staticmethod
+    def isSupported(layer: QgsVectorLayer) -> bool:
+        """
+        式によるフィールドを持ち、保持できるレイヤか判定する
+        """
+        if not isNumpyAvailable() or layer is None:
+            return False
+        fields = layer.fields()
+        return any(fields.fieldOrigin(field_index) == QgsFields.OriginExpression for field_index in range(fields.count()))
+
+    def isVirtualField(self, field_name: str) -> bool:
+        """
+        保持の対象となる式によるフィールドか判定する
+        """
+        fields = self.layer.fields()
+        field_index = fields.indexOf(field_name)
+        return (field_index >= 0 and fields.fieldOrigin(field_index) == QgsFields.OriginExpression
+                and fields.at(field_index).type() in COLUMN_KINDS)
+
+    def isMaterialized(self, field_name: str) -> bool:
+        return field_name in self.columns
+
+    def materialize(self, field_name: str) -> bool:
+        """
+        式によるフィールドの値を全地物について評価して保持する（保持済みの場合は何もしない）
+
+        @param  field_name:フィールド名
+        @return 保持しているか
+        """
+        if field_name in self.columns:
+            return True
+        if field_name in self.failed or not self.isVirtualField(field_name):
+            return False
+
+        referenced, needs_geometry, deterministic = self.resolveDependencies(field_name, set())
+        if not deterministic:
+            # 保持すると古い値のままになる
+            self.failed.add(field_name)
+            logPlan(f"{self.layer.name()}\n計算列のキャッシュ：{field_name} 評価のたびに値が変わる式のため保持しません")
+            return False
+
+        fields = self.layer.fields()
+        field_index = fields.indexOf(field_name)
+        kind = COLUMN_KINDS[fields.at(field_index).type()]
+
+        # 式が参照するフィールドはレイヤの読み込みで追加される
+        request = QgsFeatureRequest()
+        if not needs_geometry:
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([field_index])
+
+        fids = []
+        builder = CompactColumnBuilder(kind)
+        for feature in self.layer.getFeatures(request):
+            try:
+                builder.append(toColumnValue(kind, feature.attribute(field_index)))
+            except (ValueError, TypeError, OverflowError):
+                self.failed.add(field_name)
+                return False
+            fids.append(feature.id())
+
+        fid_values = numpy.array(fids, dtype=numpy.int64)
+        order = None
+        if len(fid_values) > 1 and not numpy.all(fid_values[1:] > fid_values[:-1]):
+            order = numpy.argsort(fid_values, kind="stable")
+            fid_values = fid_values[order]
+
+        if self.fid_array is not None and not numpy.array_equal(self.fid_array, fid_values):
+            # 地物が変わっている場合は他の列も作り直す
+            self.columns = dict()
+            self.dependencies = dict()
+        self.fid_array = fid_values
+
+        values, null_bits, dictionary = builder.finish(order)
+        self.columns[field_name] = (kind, values, null_bits, dictionary)
+        self.dependencies[field_name] = (referenced, needs_geometry)
+        self.null_cache = (None, None)
+        logPlan(f"{self.layer.name()}\n計算列のキャッシュ：{field_name} {len(fid_values):,}行")
+        return True
+
+    def resolveDependencies(self, field_name: str, visiting: set):
+        """
+        式によるフィールドが参照するフィールドを求める
+
+        参照する式によるフィールドは、その式が参照するフィールドまでたどって含める。
+
+        @param  field_name:式によるフィールドの名前
+        @param  visiting:たどっている途中のフィールド名（循環参照の検出用）
+        @return (参照するフィールド名の集合, ジオメトリを参照するか, 値が地物自身のみで決まるか)
+        """
+        fields = self.layer.fields()
+        expression = QgsExpression(self.layer.expressionField(fields.indexOf(field_name)))
+        referenced = set(expression.referencedColumns())
+        needs_geometry = expression.needsGeometry()
+        deterministic = isDeterministic(expression)
+
+        visiting.add(field_name)
+        for name in list(referenced):
+            field_index = fields.indexOf(name)
+            if field_index < 0 or fields.fieldOrigin(field_index) != QgsFields.OriginExpression:
+                continue
+            if name in visiting:
+                deterministic = False
+                continue
+            nested_referenced, nested_geometry, nested_deterministic = self.resolveDependencies(name, visiting)
+            referenced |= nested_referenced
+            needs_geometry = needs_geometry or nested_geometry
+            deterministic = deterministic and nested_deterministic
+        visiting.discard(field_name)
+        return (referenced, needs_geometry, deterministic)
+
+    def dropColumns(self, field_names: list):
+        """
+        列を破棄する
+        """
+        if len(field_names) == 0:
+            return
+        for field_name in field_names:
+            self.columns.pop(field_name, None)
+            self.dependencies.pop(field_name, None)
+        if len(self.columns) == 0:
+            self.fid_array = None
+        self.null_cache = (None, None)
+        self.invalidated.emit()
+
+    def invalidate(self, *args):
+        """
+        全ての列を破棄する（地物の追加・削除やフィールド構成の変更時）
+        """
+        self.failed.clear()
+        self.dropColumns(list(self.columns.keys()))
+
+    def onAttributeValueChanged(self, fid: int, field_index: int, value):
+        """
+        変更されたフィールドを参照する列を破棄する
+        """
+        field_name = self.layer.fields().at(field_index).name()
+        self.dropColumns([name for name, (referenced, _) in self.dependencies.items()
+                          if field_name in referenced or QgsFeatureRequest.ALL_ATTRIBUTES in referenced])
+
+    def onGeometryChanged(self, *args):
+        """
+        ジオメトリを参照する列を破棄する
+        """
+        self.dropColumns([name for name, (_, needs_geometry) in self.dependencies.items() if needs_geometry])
+
+    def invalidateSignals(self) -> list:
+        """
+        全ての列を破棄するシグナル
+        """
+        return [self.layer.featureAdded, self.layer.featureDeleted, self.layer.subsetStringChanged,
+                self.layer.dataSourceChanged, self.layer.updatedFields, self.layer.afterRollBack,
+                self.layer.afterCommitChanges]
+
+    def connectLayer(self):
+        """
+        データ変更時に列を破棄するよう接続する
+        """
+        for signal in self.invalidateSignals():
+            signal.connect(self.invalidate)
+        self.layer.attributeValueChanged.connect(self.onAttributeValueChanged)
+        self.layer.geometryChanged.connect(self.onGeometryChanged)
+
+    def disconnectLayer(self):
+        """
+        接続を解除する
+        """
+        for signal in self.invalidateSignals():
+            signal.disconnect(self.invalidate)
+        self.layer.attributeValueChanged.disconnect(self.onAttributeValueChanged)
+        self.layer.geometryChanged.disconnect(self.onGeometryChanged)
+
+    def isUsable(self) -> bool:
+        return self.fid_array is not None
+
+    def fieldKind(self, field_name: str) -> str:
+        column = self.columns.get(field_name)
+        if column is None:
+            return None
+        field_index = self.layer.fields().indexOf(field_name)
+        if field_index < 0 or COLUMN_KINDS.get(self.layer.fields().at(field_index).type()) != column[0]:
+            return None
+        return column[0]
+
+    def fids(self):
+        return self.fid_array
+
+    def column(self, field_name: str):
+        _, values, null_bits, _ = self.columns[field_name]
+        cached_name, nulls = self.null_cache
+        if cached_name != field_name:
+            nulls = numpy.unpackbits(null_bits, count=len(self.fid_array)).view(numpy.bool_)
+            self.null_cache = (field_name, nulls)
+        return (values, nulls)
+
+    def dictionary(self, field_name: str) -> list:
+        return self.columns[field_name][3]